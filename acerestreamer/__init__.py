@@ -2,10 +2,14 @@
 
 from pathlib import Path
 from pprint import pformat
+from typing import TYPE_CHECKING
 
 from . import authentication_bp, config, info_bp, logger, stream_bp
 from .flask_helpers import FlaskAceReStreamer
 
+if TYPE_CHECKING:
+    from .stream_asgi import AsyncStreamProxy
+
 __version__ = "0.2.0"  # This is the version of the app, used in pyproject.toml, enforced in a test.
 PROGRAM_NAME = "Ace ReStreamer"  # This is the name of the app, used in the config file.
 URL = "https://github.com/kism/ace-restreamer"
@@ -62,9 +66,25 @@ def create_app(
 
     with app.app_context():
         stream_bp.start_scraper()
+        stream_bp.start_reverse_proxy()
+        stream_bp.start_prober()
         authentication_bp.start_allowlist()
 
     app.logger.info("Starting Web Server")
     app.logger.info("%s version: %s", PROGRAM_NAME, __version__)
 
     return app
+
+
+def create_asgi_app(
+    test_config: config.AceReStreamerConf | None = None,
+    instance_path: str | None = None,
+) -> "AsyncStreamProxy":
+    """Create the app for ASGI servers, /hls/ and /ace/c/ are proxied asynchronously. Needs the 'asgi' extra."""
+    try:
+        from .stream_asgi import AsyncStreamProxy
+    except ImportError as e:
+        msg = "ASGI mode needs the 'asgi' extra installed: httpx, asgiref and an ASGI server such as uvicorn"
+        raise ImportError(msg) from e
+
+    return AsyncStreamProxy(create_app(test_config=test_config, instance_path=instance_path))
@@ -0,0 +1,172 @@
+"""Helpers for talking to the AceStream engine."""
+
+import bisect
+import hashlib
+import re
+import threading
+from collections import OrderedDict
+from http import HTTPStatus
+from http.cookiejar import DefaultCookiePolicy
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from .config import AppConf
+from .logger import get_logger
+
+logger = get_logger(__name__)
+
+ENGINE_RING_VIRTUAL_NODES = 64  # Points per engine on the hash ring, to spread content ids evenly
+ENGINE_MAX_SESSIONS = 10000  # Playback sessions to remember the engine of
+ENGINE_HEALTH_CHECK_PATH = "/webui/api/service?method=get_version"
+ENGINE_HEALTH_CHECK_TIMEOUT = 3
+ACE_SESSION_REGEX = re.compile(r"/ace/c/([^/\s]+)/")
+
+
+def create_ace_session(app_conf: AppConf) -> requests.Session:
+    """Create a keep-alive session with a connection pool for the engine, shared between request threads.
+
+    urllib3's connection pool is thread-safe, the only per-session state requests would otherwise mutate
+    is the cookie jar, so cookies are blocked entirely since the engine doesn't need them.
+    """
+    session = requests.Session()
+    session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+
+    adapter = HTTPAdapter(
+        pool_connections=len(app_conf.get_ace_addresses()),  # Number of hosts to keep pools for
+        pool_maxsize=app_conf.ace_pool_size,  # Connections kept alive per host
+        max_retries=0,
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+
+    logger.debug("Created AceStream engine session, pool size: %d", app_conf.ace_pool_size)
+
+    return session
+
+
+class AceEnginePool:
+    """A pool of AceStream engines, a content_id always goes to the same engine while it is healthy.
+
+    Content ids are placed on a consistent hash ring, so adding or removing an engine only moves the
+    streams of that engine. Engines that fail a request are skipped until a health check (or a request)
+    succeeds again, the next engine on the ring is used instead.
+    """
+
+    def __init__(self, addresses: list[str], session: requests.Session, health_check_interval: float) -> None:
+        """Init AceEnginePool."""
+        self.addresses = addresses
+        self.session = session
+        self.health_check_interval = health_check_interval
+
+        self._healthy: dict[str, bool] = dict.fromkeys(addresses, True)
+        self._sessions: OrderedDict[str, tuple[str, str]] = OrderedDict()  # Session id -> (engine address, content_id)
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._health_check_thread: threading.Thread | None = None
+
+        self._ring: list[tuple[int, str]] = sorted(
+            (_hash(f"{address}#{n}"), address) for address in addresses for n in range(ENGINE_RING_VIRTUAL_NODES)
+        )
+        self._ring_hashes = [ring_hash for ring_hash, _ in self._ring]
+
+    def get_engines(self, content_id: str) -> list[str]:
+        """Get the engines to try for a content_id, the engine it belongs to first, unhealthy engines last."""
+        start = bisect.bisect(self._ring_hashes, _hash(content_id))
+        engines: list[str] = []
+        for n in range(len(self._ring)):
+            address = self._ring[(start + n) % len(self._ring)][1]
+            if address not in engines:
+                engines.append(address)
+            if len(engines) == len(self.addresses):
+                break
+
+        with self._lock:
+            return sorted(engines, key=lambda address: not self._healthy[address])
+
+    def get_engines_for_content(self, path: str) -> list[str]:
+        """Get the engines to try for /ace/c/ content, the engine that served the manifest has the session."""
+        session_id = path.split("/", 1)[0]
+        with self._lock:
+            address, _ = self._sessions.get(session_id, ("", ""))
+
+        engines = self.get_engines(session_id)
+        if address:
+            engines.remove(address)
+            engines.insert(0, address)
+        return engines
+
+    def get_content_id(self, path: str) -> str:
+        """Get the content_id that the playback session of /ace/c/ content is for, if it is known."""
+        session_id = path.split("/", 1)[0]
+        with self._lock:
+            _, content_id = self._sessions.get(session_id, ("", ""))
+        return content_id
+
+    def record_sessions(self, manifest: str, address: str, content_id: str = "") -> None:
+        """Remember which engine, and which content_id, the playback sessions in a manifest belong to."""
+        with self._lock:
+            for session_id in set(ACE_SESSION_REGEX.findall(manifest)):
+                self._sessions[session_id] = (address, content_id)
+                self._sessions.move_to_end(session_id)
+            while len(self._sessions) > ENGINE_MAX_SESSIONS:
+                self._sessions.popitem(last=False)
+
+    def mark_success(self, address: str) -> None:
+        """Mark an engine as healthy."""
+        with self._lock:
+            if not self._healthy[address]:
+                logger.info("AceStream engine %s is healthy again", address)
+            self._healthy[address] = True
+
+    def mark_failure(self, address: str) -> None:
+        """Mark an engine as unhealthy, it will be skipped until it recovers."""
+        with self._lock:
+            if self._healthy[address] and len(self.addresses) > 1:
+                logger.warning("AceStream engine %s is unhealthy, failing over", address)
+            self._healthy[address] = False
+
+    def check_health(self) -> None:
+        """Check every engine is reachable."""
+        for address in self.addresses:
+            try:
+                resp = self.session.get(f"{address}{ENGINE_HEALTH_CHECK_PATH}", timeout=ENGINE_HEALTH_CHECK_TIMEOUT)
+                resp.close()
+            except requests.RequestException:
+                self.mark_failure(address)
+                continue
+
+            if resp.status_code >= HTTPStatus.INTERNAL_SERVER_ERROR:
+                self.mark_failure(address)
+            else:
+                self.mark_success(address)
+
+    def start_health_checks(self) -> None:
+        """Start the background health check thread."""
+        if self._health_check_thread or self.health_check_interval <= 0:
+            return
+
+        self._health_check_thread = threading.Thread(
+            target=self._health_check_loop,
+            name="ace_engine_health_check",
+            daemon=True,
+        )
+        self._health_check_thread.start()
+
+    def stop_health_checks(self) -> None:
+        """Stop the background health check thread."""
+        self._stop_event.set()
+
+    def get_stats(self) -> dict[str, bool]:
+        """Get the health of each engine."""
+        with self._lock:
+            return dict(self._healthy)
+
+    def _health_check_loop(self) -> None:
+        while not self._stop_event.wait(self.health_check_interval):
+            self.check_health()
+
+
+def _hash(value: str) -> int:
+    """Hash a string onto the ring."""
+    return int.from_bytes(hashlib.blake2b(value.encode(), digest_size=8).digest())
@@ -1,8 +1,10 @@
 """Main Stream Site Blueprint."""
 
 import hmac
+from collections.abc import Mapping
 from http import HTTPStatus
 from pathlib import Path
+from typing import Any
 
 from flask import Blueprint, Response, jsonify, redirect, request, send_file
 from werkzeug.wrappers import Response as WerkzeugResponse
@@ -32,11 +34,13 @@ def start_allowlist() -> None:
 
 def get_ip_from_request() -> str:
     """Get the IP address from the request."""
+    return get_ip_from_environ(request.environ)
+
+
+def get_ip_from_environ(environ: Mapping[str, Any]) -> str:
+    """Get the IP address from a WSGI environ, or anything that looks like one."""
     request_ip_raw = (
-        request.environ.get("HTTP_X_FORWARDED_FOR")
-        or request.environ.get("HTTP_X_REAL_IP")
-        or request.environ.get("REMOTE_ADDR")
-        or ""
+        environ.get("HTTP_X_FORWARDED_FOR") or environ.get("HTTP_X_REAL_IP") or environ.get("REMOTE_ADDR") or ""
     )
 
     logger.debug("Raw request IP: %s", request_ip_raw)
@@ -2,11 +2,12 @@
 
 import datetime
 import json
+import re
 from pathlib import Path
 from typing import Self
 
 import tomlkit
-from pydantic import BaseModel, model_validator
+from pydantic import BaseModel, PrivateAttr, model_validator
 from pydantic_settings import BaseSettings
 
 from .logger import get_logger
@@ -15,6 +16,9 @@ from .logger import get_logger
 # Modules should all setup logging like this so the log messages include the modules name.
 logger = get_logger(__name__)
 
+HTML_PARSERS = ["html.parser", "lxml"]  # BeautifulSoup tree builders, lxml needs the lxml extra installed
+QUALITY_BACKENDS = ["json", "sqlite"]
+
 
 class FlaskConf(BaseModel):
     """Flask configuration definition."""
@@ -24,6 +28,58 @@ class FlaskConf(BaseModel):
     SERVER_NAME: str = "http://127.0.0.1:5100"
 
 
+def _compile_words(words: list[str]) -> re.Pattern[str] | None:
+    """Compile a list of words into one pattern that finds any of them in a lower case title."""
+    if not words:
+        return None
+    return re.compile("|".join(re.escape(word.lower()) for word in words))
+
+
+class TitleMatcher:
+    """A TitleFilter compiled for checking many titles, each word list is one scan of a title."""
+
+    __slots__ = ("always_exclude", "always_include", "exclude", "include", "regex_postprocessing")
+
+    def __init__(self, title_filter: "TitleFilter") -> None:
+        """Compile the word lists and the postprocessing regex of a TitleFilter."""
+        self.always_exclude = _compile_words(title_filter.always_exclude_words)
+        self.always_include = _compile_words(title_filter.always_include_words)
+        self.exclude = _compile_words(title_filter.exclude_words)
+        self.include = _compile_words(title_filter.include_words)
+
+        try:
+            self.regex_postprocessing = (
+                re.compile(title_filter.regex_postprocessing) if title_filter.regex_postprocessing else None
+            )
+        except re.error as e:
+            msg = f"regex_postprocessing '{title_filter.regex_postprocessing}' is not a valid regex: {e}"
+            raise ValueError(msg) from e
+
+    def check_title_allowed(self, title: str) -> bool:
+        """Check if a title is allowed by the word lists."""
+        title = title.lower()
+
+        if self.always_exclude and self.always_exclude.search(title):
+            return False
+
+        if self.always_include and self.always_include.search(title):
+            return True
+
+        if self.exclude and self.exclude.search(title):
+            return False
+
+        if self.include:
+            return self.include.search(title) is not None
+
+        return True
+
+    def postprocess_title(self, title: str) -> str:
+        """Remove anything that matches regex_postprocessing from a title."""
+        if not self.regex_postprocessing:
+            return title
+        return self.regex_postprocessing.sub("", title).strip()
+
+
 class TitleFilter(BaseModel):
     """Model for title filtering."""
 
@@ -33,6 +89,20 @@ class TitleFilter(BaseModel):
     include_words: list[str] = []
     regex_postprocessing: str = ""
 
+    _matcher: TitleMatcher | None = PrivateAttr(default=None)
+
+    @model_validator(mode="after")
+    def compile_filters(self) -> Self:
+        """Compile the filter when the config is loaded, it's checked against every title."""
+        self._matcher = TitleMatcher(self)
+        return self
+
+    def get_matcher(self) -> TitleMatcher:
+        """Get the compiled filter, get this once rather than per title."""
+        if not self._matcher:  # Only if validation was skipped
+            self._matcher = TitleMatcher(self)
+        return self._matcher
+
 
 class ScrapeSiteHTML(BaseModel):
     """Model for a site to scrape."""
@@ -42,6 +112,8 @@ class ScrapeSiteHTML(BaseModel):
     target_class: str = ""  # Target html class
     check_sibling: bool = False
     title_filter: TitleFilter = TitleFilter()
+    html_parser: str = ""  # Overrides the scraper's html_parser for this site if set
+    prefilter_links: bool = False  # Only search links that look like AceStream links, with a CSS selector
 
     @model_validator(mode="after")
     def valid_url(self) -> Self:
@@ -52,6 +124,14 @@ class ScrapeSiteHTML(BaseModel):
             raise ValueError(msg)
         return self
 
+    @model_validator(mode="after")
+    def valid_html_parser(self) -> Self:
+        """Validate the HTML parser."""
+        if self.html_parser and self.html_parser not in HTML_PARSERS:
+            msg = f"html_parser for {self.name} must be one of {HTML_PARSERS}"
+            raise ValueError(msg)
+        return self
+
 
 class ScrapeSiteIPTV(BaseModel):
     """Model for a site to scrape IPTV streams."""
@@ -67,6 +147,72 @@ class AceScrapeConf(BaseModel):
     html: list[ScrapeSiteHTML] = []
     iptv_m3u8: list[ScrapeSiteIPTV] = []
     scrape_interval: int = 7200  # 2 hours
+    max_workers: int = 8  # Sites scraped at once
+    max_workers_per_host: int = 2  # Sites on the same host scraped at once
+    scrape_deadline: int = 120  # Seconds, sites that haven't finished by then are skipped this run
+    html_parser: str = "html.parser"  # Parser for html sites, "lxml" is faster
+    iptv_max_size: int = 100 * 1024 * 1024  # Bytes, larger IPTV playlists are skipped
+    quality_backend: str = "json"  # Where stream qualities are saved, "sqlite" also keeps their history
+    quality_retention_scrapes: int = 0  # sqlite only, forget streams not found in this many scrapes, 0 to keep them
+
+    @model_validator(mode="after")
+    def valid_workers(self) -> Self:
+        """Validate the worker counts."""
+        if self.max_workers <= 0 or self.max_workers_per_host <= 0:
+            msg = "max_workers and max_workers_per_host must be greater than 0"
+            raise ValueError(msg)
+        return self
+
+    @model_validator(mode="after")
+    def valid_html_parser(self) -> Self:
+        """Validate the HTML parser."""
+        if self.html_parser not in HTML_PARSERS:
+            msg = f"html_parser must be one of {HTML_PARSERS}"
+            raise ValueError(msg)
+        return self
+
+    @model_validator(mode="after")
+    def valid_quality_backend(self) -> Self:
+        """Validate the quality backend and retention."""
+        if self.quality_backend not in QUALITY_BACKENDS:
+            msg = f"quality_backend must be one of {QUALITY_BACKENDS}"
+            raise ValueError(msg)
+        if self.quality_retention_scrapes < 0:
+            msg = "quality_retention_scrapes must be 0 or greater"
+            raise ValueError(msg)
+        return self
+
+
+class TimeoutConf(BaseModel):
+    """Connect and read timeouts for a request, in seconds."""
+
+    connect: float = 3.0
+    read: float = 10.0
+
+    def as_tuple(self) -> tuple[float, float]:
+        """Get the timeout in the format that requests uses."""
+        return (self.connect, self.read)
+
+
+class ProberConf(BaseModel):
+    """Settings for probing streams in the background, so their quality is known before anyone watches them."""
+
+    interval: int = 0  # Seconds between probe runs, 0 to disable
+    batch_size: int = 20  # Streams probed per run
+    concurrency: int = 2  # Probes running at once, keep it low so viewers get the engine
+    delay: float = 5.0  # Seconds between starting probes
+    stale_after: int = 6 * 60 * 60  # Seconds, streams not tried for this long are probed again
+
+    @model_validator(mode="after")
+    def valid_prober(self) -> Self:
+        """Validate the prober settings."""
+        if self.interval < 0 or self.delay < 0 or self.stale_after < 0:
+            msg = "prober interval, delay and stale_after must be 0 or greater"
+            raise ValueError(msg)
+        if self.batch_size <= 0 or self.concurrency <= 0:
+            msg = "prober batch_size and concurrency must be greater than 0"
+            raise ValueError(msg)
+        return self
 
 
 class AppConf(BaseModel):
@@ -74,6 +220,16 @@ class AppConf(BaseModel):
 
     password: str = ""
     ace_address: str = "http://localhost:6878"
+    ace_addresses: list[str] = []  # Multiple engines to spread streams across, ace_address is used if empty
+    ace_health_check_interval: int = 30  # Seconds
+    ace_content_chunk_size: int = 64 * 1024  # Bytes per chunk when streaming /ace/c/ content to the client
+    segment_cache_max_bytes: int = 64 * 1024 * 1024  # Shared /ace/c/ segment cache size, 0 to disable
+    segment_cache_ttl: int = 30  # Seconds
+    manifest_cache_max_ttl: float = 5.0  # Seconds, manifests are cached for half their target duration, 0 to disable
+    ace_pool_size: int = 32  # Keep-alive connections to the engine
+    manifest_timeout: TimeoutConf = TimeoutConf(connect=3.0, read=10.0)  # For /hls/ manifest requests
+    content_timeout: TimeoutConf = TimeoutConf(connect=3.0, read=10.0)  # For /ace/c/ segment requests
+    prober: ProberConf = ProberConf()  # Background quality probes, off by default
 
     @model_validator(mode="after")
     def valid_ace_address(self) -> Self:
@@ -85,6 +241,36 @@ class AppConf(BaseModel):
         msg = "ace_address must start with 'http://'"
         raise ValueError(msg)
 
+    @model_validator(mode="after")
+    def valid_ace_addresses(self) -> Self:
+        """Validate the list of engine addresses."""
+        self.ace_addresses = [address.strip().rstrip("/") for address in self.ace_addresses]
+        for address in self.ace_addresses:
+            if not address.startswith("http://") and not address.startswith("https://"):
+                msg = f"ace_addresses entry {address} must start with 'http://' or 'https://'"
+                raise ValueError(msg)
+        return self
+
+    def get_ace_addresses(self) -> list[str]:
+        """Get the addresses of all configured engines."""
+        return list(dict.fromkeys(self.ace_addresses)) or [self.ace_address]
+
+    @model_validator(mode="after")
+    def valid_ace_content_chunk_size(self) -> Self:
+        """Validate the chunk size used for streaming content."""
+        if self.ace_content_chunk_size <= 0:
+            msg = "ace_content_chunk_size must be greater than 0"
+            raise ValueError(msg)
+        return self
+
+    @model_validator(mode="after")
+    def valid_ace_pool_size(self) -> Self:
+        """Validate the engine connection pool size."""
+        if self.ace_pool_size <= 0:
+            msg = "ace_pool_size must be greater than 0"
+            raise ValueError(msg)
+        return self
+
 
 class LoggingConf(BaseModel):
     """Logging configuration definition."""
@@ -1,13 +1,22 @@
 """Scraper object."""
 
+import datetime
+import heapq
+import threading
+import time
+from functools import partial
 from pathlib import Path
 
 from .config import AceScrapeConf
 from .logger import get_logger
+from .scraper_cache import ScrapeCache
 from .scraper_health import AceQuality
-from .scraper_html import scrape_streams_html_sites
-from .scraper_iptv import scrape_streams_iptv_sites
-from .scraper_objects import FlatFoundAceStream, FoundAceStreams
+from .scraper_health_db import AceQualityDB
+from .scraper_html import scrape_streams_html_site
+from .scraper_iptv import scrape_streams_iptv_site
+from .scraper_objects import FlatFoundAceStream, FoundAceStreams, ScraperStatus
+from .scraper_pool import ScrapeJob, run_scrape_jobs
+from .scraper_registry import StreamRegistry
 
 logger = get_logger(__name__)
 
@@ -15,41 +24,178 @@ logger = get_logger(__name__)
 class AceScraper:
     """Scraper object."""
 
-    def __init__(self, ace_scrape_settings: AceScrapeConf, ace_quality_cache_path: Path | None) -> None:
-        """Init MyCoolObject."""
-        self.streams: list[FoundAceStreams] = []
+    def __init__(
+        self,
+        ace_scrape_settings: AceScrapeConf,
+        ace_quality_cache_path: Path | None,
+        ace_scrape_cache_path: Path | None = None,
+    ) -> None:
+        """Init MyCoolObject, loads the streams from the last run if they were saved. Call run_scrape() for new ones."""
+        self._registry = StreamRegistry()
+        self.status = ScraperStatus()
 
         self.scrape_interval = ace_scrape_settings.scrape_interval
 
-        self._ace_quality = AceQuality(ace_quality_cache_path)
+        quality_db = None
+        if ace_scrape_settings.quality_backend == "sqlite" and ace_quality_cache_path:
+            quality_db = AceQualityDB(
+                ace_quality_cache_path.with_suffix(".db"),
+                default_quality=AceQuality.default_quality,
+                retention_scrapes=ace_scrape_settings.quality_retention_scrapes,
+            )
+        self._ace_quality = AceQuality(ace_quality_cache_path, quality_db)
 
         self.html = ace_scrape_settings.html
         self.iptv_m3u8 = ace_scrape_settings.iptv_m3u8
-        self.run_scrape()
-        self.print_streams()
+        self.max_workers = ace_scrape_settings.max_workers
+        self.max_workers_per_host = ace_scrape_settings.max_workers_per_host
+        self.scrape_deadline = ace_scrape_settings.scrape_deadline
+        self.html_parser = ace_scrape_settings.html_parser
+        self.iptv_max_size = ace_scrape_settings.iptv_max_size
+
+        self._stop_event = threading.Event()
+        self._scrape_thread: threading.Thread | None = None
+        self._scrape_lock = threading.Lock()
+
+        self._scrape_cache = ScrapeCache(ace_scrape_cache_path)
+        self._load_streams_from_cache()
 
     def run_scrape(self) -> None:
-        """Run the scraper to find AceStreams."""
+        """Run the scraper to find AceStreams, replacing the current streams once it is done."""
+        if not self._scrape_lock.acquire(blocking=False):
+            logger.warning("AceStream scraper is already running, skipping")
+            return
+
+        try:
+            self.status.scrape_in_progress = True
+            self.status.last_scrape_started = datetime.datetime.now(tz=datetime.UTC)
+            self._run_scrape()
+            self.status.last_scrape_finished = datetime.datetime.now(tz=datetime.UTC)
+            self.status.streams_from_cache = False
+        finally:
+            self.status.scrape_in_progress = False
+            self._scrape_lock.release()
+
+    def _run_scrape(self) -> None:
         logger.info("Running AceStream scraper...")
 
-        self.streams.extend(
-            scrape_streams_html_sites(
-                sites=self.html,
-            )
+        jobs = [
+            *(
+                ScrapeJob(
+                    site_name=site.name,
+                    url=site.url,
+                    scrape=partial(
+                        scrape_streams_html_site,
+                        site,
+                        self._scrape_cache.get(site.name),
+                        self.html_parser,
+                    ),
+                )
+                for site in self.html
+            ),
+            *(
+                ScrapeJob(
+                    site_name=site.name,
+                    url=site.url,
+                    scrape=partial(
+                        scrape_streams_iptv_site,
+                        site,
+                        self._scrape_cache.get(site.name),
+                        self.iptv_max_size,
+                    ),
+                )
+                for site in self.iptv_m3u8
+            ),
+        ]
+
+        results = run_scrape_jobs(
+            jobs,
+            max_workers=self.max_workers,
+            max_per_host=self.max_workers_per_host,
+            deadline=self.scrape_deadline,
         )
 
-        self.streams.extend(
-            scrape_streams_iptv_sites(
-                sites=self.iptv_m3u8,
-            )
+        n_parse_skipped = 0
+        parse_time_saved = 0.0
+        for job, scraped_site in zip(jobs, results, strict=True):
+            if scraped_site:
+                if scraped_site.parse_skipped:
+                    n_parse_skipped += 1
+                    parse_time_saved += scraped_site.parse_time
+                self._scrape_cache.update(job.site_name, scraped_site)
+                continue
+
+            last_scrape = self._scrape_cache.get(job.site_name)
+            if last_scrape:
+                logger.warning(
+                    "Scrape of %s failed, using the last successful scrape from %s",
+                    job.site_name,
+                    last_scrape.fetched_at.isoformat(),
+                )
+
+        if n_parse_skipped:
+            logger.info("Skipped parsing %d unchanged sites, saved %.3fs", n_parse_skipped, parse_time_saved)
+
+        site_names = [job.site_name for job in jobs]
+        self._scrape_cache.remove_other_sites(site_names)
+        self._scrape_cache.save_cache()
+
+        # Build the new registry off to the side so the current one is served until the scrape is done
+        new_registry = StreamRegistry(self._scrape_cache.get_streams(site_names))
+        self._ace_quality.record_scrape(
+            {stream.ace_id: stream.site_name for stream in reversed(new_registry.flat_streams)}  # First site wins
         )
 
+        self._registry = new_registry  # Swap, assignment is atomic
+        self.print_streams()
+
+    def start_scrape_thread(self) -> None:
+        """Start the background thread that scrapes now, then every scrape_interval."""
+        if self._scrape_thread:
+            return
+
+        self.status.scrape_in_progress = True  # Report it straight away, even before the thread gets going
+
+        self._scrape_thread = threading.Thread(target=self._scrape_loop, name="ace_scraper", daemon=True)
+        self._scrape_thread.start()
+
+    def stop_scrape_thread(self) -> None:
+        """Stop the background scrape thread, after the current scrape if one is running."""
+        self._stop_event.set()
+
+    def _scrape_loop(self) -> None:
+        while True:
+            try:
+                self.run_scrape()
+            except Exception:
+                logger.exception("Error running the AceStream scraper, will try again next interval")
+
+            if self.scrape_interval <= 0 or self._stop_event.wait(self.scrape_interval):
+                return
+
+    def _load_streams_from_cache(self) -> None:
+        """Serve the streams from the last run while the first scrape runs."""
+        site_names = [site.name for site in self.html] + [site.name for site in self.iptv_m3u8]
+        self._registry = StreamRegistry(self._scrape_cache.get_streams(site_names))
+        if not self.streams:
+            return
+
+        self._ace_quality.load_qualities(stream.ace_id for stream in self._registry.flat_streams)
+
+        self.status.streams_from_cache = True
+        logger.info("Loaded streams from the last scrape, serving them until a new scrape is done")
+        self.print_streams()
+
+    @property
+    def streams(self) -> list[FoundAceStreams]:
+        """The found streams, by site."""
+        return self._registry.streams
+
     def get_stream_by_ace_id(self, ace_id: str) -> FlatFoundAceStream:
-        """Get a stream by its Ace ID, will use the first found matching FlatFoundAceStream by ace_id."""
-        streams = self.get_streams_flat()
-        for found_stream in streams:
-            if found_stream.ace_id == ace_id:
-                return found_stream
+        """Get a stream by its Ace ID, will use the first site that found the stream."""
+        stream = self._registry.get_by_ace_id(ace_id)
+        if stream:
+            return self._with_quality(stream)
 
         return FlatFoundAceStream(
             site_name="Unknown",
@@ -60,37 +206,60 @@ class AceScraper:
 
     def get_streams(self) -> list[FoundAceStreams]:
         """Get the found streams as a list of dicts, ready to be turned into json."""
-        streams = list(self.streams)
-
-        for found_stream in streams:
-            for stream in found_stream.stream_list:
-                stream.quality = self._ace_quality.get_quality(stream.ace_id)
-
-        return streams
+        return [
+            found_streams.model_copy(
+                update={
+                    "stream_list": [
+                        stream.model_copy(update={"quality": self._ace_quality.get_quality(stream.ace_id)})
+                        for stream in found_streams.stream_list
+                    ]
+                }
+            )
+            for found_streams in self.streams
+        ]
 
     def get_streams_flat(self) -> list[FlatFoundAceStream]:
         """Get a list of streams, as a list of dicts."""
-        streams = [stream.model_dump() for stream in self.streams]
-
-        flat_streams: list[FlatFoundAceStream] = []
-        for found_stream in streams:
-            for stream in found_stream["stream_list"]:
-                new_stream: FlatFoundAceStream = FlatFoundAceStream(
-                    site_name=found_stream["site_name"],
-                    quality=self._ace_quality.get_quality(stream["ace_id"]),
-                    title=stream["title"],
-                    ace_id=stream["ace_id"],
-                )
-                flat_streams.append(new_stream)
-        return flat_streams
+        return [self._with_quality(stream) for stream in self._registry.flat_streams]
+
+    def _with_quality(self, stream: FlatFoundAceStream) -> FlatFoundAceStream:
+        """Get a copy of a stream from the registry with its current quality."""
+        return stream.model_copy(update={"quality": self._ace_quality.get_quality(stream.ace_id)})
+
+    def get_streams_version(self) -> tuple[int, ...]:
+        """Get a version that changes whenever the streams or their quality change, for caching responses."""
+        return (self._registry.generation, *self._ace_quality.get_version())
+
+    def get_ace_ids_to_probe(self, stale_after: float, limit: int) -> list[str]:
+        """Get the streams that haven't been tried in stale_after seconds, the never tried ones then the oldest."""
+        last_tried: dict[str, float] = {}
+        for stream in self._registry.flat_streams:
+            if stream.ace_id not in last_tried:
+                last_tried[stream.ace_id] = self._ace_quality.get_last_tried(stream.ace_id)
+
+        stale_before = time.time() - stale_after
+        stale = [(tried, ace_id) for ace_id, tried in last_tried.items() if tried <= stale_before]
+        return [ace_id for _, ace_id in heapq.nsmallest(limit, stale)]
+
+    def get_status(self) -> ScraperStatus:
+        """Get the status of the scraper."""
+        return self.status.model_copy()
 
     def get_streams_health(self) -> dict[str, int]:
-        """Get the health of the streams."""
-        return self._ace_quality.ace_streams
+        """Get the health of the streams, a copy that is safe to serialize while the qualities change."""
+        return self._ace_quality.get_snapshot()
+
+    def record_success(self, ace_id: str, latency: float) -> None:
+        """Record that a stream's manifest was fetched, and how many seconds it took."""
+        self._ace_quality.record_success(ace_id, latency)
+
+    def record_failure(self, ace_id: str) -> None:
+        """Record that a stream's manifest couldn't be fetched, or wasn't valid."""
+        self._ace_quality.record_failure(ace_id)
 
-    def increment_quality(self, ace_id: str, rating: int) -> None:
-        """Increment the quality of a stream by ace_id."""
-        self._ace_quality.increment_quality(ace_id, rating)
+    def record_segment_latency(self, ace_id: str, latency: float) -> None:
+        """Record how many seconds a segment of a stream took to start arriving."""
+        self._ace_quality.record_segment_latency(ace_id, latency)
 
     def print_streams(self) -> None:
         """Print the found streams."""
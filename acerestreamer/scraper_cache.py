@@ -0,0 +1,60 @@
+"""ScrapeCache, the last successful scrape of each site, persisted for warm restarts."""
+
+from pathlib import Path
+
+from pydantic import TypeAdapter, ValidationError
+
+from .logger import get_logger
+from .scraper_objects import FoundAceStreams, ScrapedSite
+
+logger = get_logger(__name__)
+
+_SITES_ADAPTER = TypeAdapter(dict[str, ScrapedSite])
+
+
+class ScrapeCache:
+    """For keeping the last successful scrape of each site."""
+
+    def __init__(self, cache_file: Path | None) -> None:
+        """Init ScrapeCache."""
+        self.cache_file = cache_file
+        self.sites: dict[str, ScrapedSite] = {}
+        self._load_cache()
+
+    def _load_cache(self) -> None:
+        if self.cache_file and self.cache_file.exists():
+            try:
+                with self.cache_file.open("rb") as f:
+                    self.sites = _SITES_ADAPTER.validate_json(f.read())
+            except (ValidationError, OSError):
+                logger.exception("Error loading scrape cache file: %s", self.cache_file)
+                return
+
+    def save_cache(self) -> None:
+        """Save the scrape cache to a file, written to a temp file first so a crash can't leave half a file."""
+        if not self.cache_file:
+            return
+
+        temp_file = self.cache_file.with_suffix(".tmp")
+        try:
+            with temp_file.open("wb") as f:
+                f.write(_SITES_ADAPTER.dump_json(self.sites))
+            temp_file.replace(self.cache_file)
+        except OSError:
+            logger.exception("Error saving scrape cache file: %s", self.cache_file)
+
+    def get(self, site_name: str) -> ScrapedSite | None:
+        """Get the last successful scrape of a site."""
+        return self.sites.get(site_name)
+
+    def update(self, site_name: str, scraped_site: ScrapedSite) -> None:
+        """Record a successful scrape of a site."""
+        self.sites[site_name] = scraped_site
+
+    def remove_other_sites(self, site_names: list[str]) -> None:
+        """Forget sites that are no longer configured."""
+        self.sites = {site_name: site for site_name, site in self.sites.items() if site_name in site_names}
+
+    def get_streams(self, site_names: list[str]) -> list[FoundAceStreams]:
+        """Get the streams of the sites, in the same order as site_names."""
+        return [self.sites[site_name].streams for site_name in site_names if site_name in self.sites]
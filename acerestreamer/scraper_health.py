@@ -1,93 +1,367 @@
 """AceQuality, for tracking quality of Ace URIs."""
 
+import atexit
 import json
+import sqlite3
+import threading
+import time
+from collections.abc import Iterable
 from pathlib import Path
 
 from .logger import get_logger
+from .scraper_health_db import AceQualityDB, StreamStats
 from .scraper_helpers import check_valid_ace_id
 
 logger = get_logger(__name__)
 
 
 class AceQuality:
-    """For tracking quality of Streams."""
+    """For tracking quality of Streams.
 
-    default_quality: int = -1
-    quality_on_first_success: int = 20
+    Each stream has compact counters (StreamStats): successes and failures that decay with a half life, and
+    moving averages of how long the manifest and segments take to fetch. The quality is scored from them when
+    it is read, so it keeps up with time passing without anything having to update it.
+
+    The counters are split into stripes, each with its own lock, so updates to different streams don't contend.
+    Each stripe keeps its own version and unsaved changes, so recording a result only takes its stripe's lock.
+    Reads don't lock or write, get_snapshot() gives a consistent copy of every quality.
+
+    With a quality_db the counters are saved there instead of the cache file, and only the counters of the
+    streams in use are kept in memory, see load_qualities() and record_scrape().
+    """
+
+    default_quality: int = -1  # Streams that haven't been tried
     min_quality: int = 0
     max_quality: int = 99
+    half_life: float = 24 * 60 * 60  # Seconds for a success or failure to count half as much
+    prior_success_rate: float = 0.5  # Where the success rate starts, and drifts back to as the history decays
+    prior_weight: float = 1.0  # How many results the prior counts as
+    failure_floor: float = 0.1  # Streams that succeed less often than this score min_quality, they're broken
+    latency_smoothing: float = 0.3  # Weight of the newest latency in the moving averages
+    slow_manifest_latency: float = 10.0  # Seconds, manifests this slow get the whole latency penalty
+    slow_segment_latency: float = 5.0  # Seconds, segments this slow get the whole latency penalty
+    latency_penalty: float = 0.25  # The most of the quality that slowness can take away
+    score_refresh_interval: int = 60  # Seconds, how often the version changes for the qualities to decay
+    save_interval: float = 30  # Seconds between saving changes to the cache file
+    save_threshold: int = 100  # Changes that trigger a save before the interval is up
+    n_stripes: int = 16
 
-    def __init__(self, cache_file: Path | None) -> None:
-        """Init AceQuality."""
+    def __init__(self, cache_file: Path | None, quality_db: AceQualityDB | None = None) -> None:
+        """Init AceQuality, changes are saved by a background thread that starts with the first change."""
         self.cache_file = cache_file
-        self.ace_streams: dict[str, int] = {}
-        self._load_cache()
-        self._clean_cache()
+        self.quality_db = quality_db
 
-    def _clean_cache(self) -> None:
-        """Ensure that the cache only contains valid Ace IDs."""
-        logger.debug("Cleaning AceQuality cache")
-        if not self.ace_streams:
+        # Each stripe has its own lock, and keeps its own version and unsaved changes under it
+        self._stripes: list[dict[str, StreamStats]] = [{} for _ in range(self.n_stripes)]
+        self._stripe_locks = [threading.Lock() for _ in range(self.n_stripes)]
+        self._stripe_versions = [0] * self.n_stripes  # Incremented whenever a stream succeeds or fails
+        self._stripe_n_unsaved = [0] * self.n_stripes
+        # ace_id: (successes, failures) since the last save, for the quality_db
+        self._stripe_unsaved_counts: list[dict[str, tuple[int, int]]] = [{} for _ in range(self.n_stripes)]
+
+        self._lock = threading.Lock()  # For starting the save thread
+        self._save_event = threading.Event()
+        self._save_thread: threading.Thread | None = None
+
+        if self.quality_db:
+            self._import_cache_to_db(self.quality_db)
+            return
+
+        for ace_id, stats in self._clean_cache(self._load_cache()).items():
+            self._get_stripe(ace_id)[ace_id] = stats
+
+    def _import_cache_to_db(self, quality_db: AceQualityDB) -> None:
+        """Import the cache file into a new quality_db, so switching backends keeps the qualities."""
+        if not quality_db.is_empty():
             return
 
+        ace_streams = self._clean_cache(self._load_cache())
+        if ace_streams:
+            logger.info("Importing %d qualities from %s into %s", len(ace_streams), self.cache_file, quality_db.db_file)
+            quality_db.save_stats(
+                {ace_id: (self.get_score(stats), stats, 0, 0) for ace_id, stats in ace_streams.items()}
+            )
+
+    def _clean_cache(self, ace_streams: dict[str, dict[str, float] | int]) -> dict[str, StreamStats]:
+        """Ensure that the cache only contains valid Ace IDs, and convert qualities from older versions."""
+        logger.debug("Cleaning AceQuality cache")
+
         cleaned_cache = {}
-        for ace_id, quality in self.ace_streams.items():
-            if check_valid_ace_id(ace_id):
-                cleaned_cache[ace_id] = quality
-            else:
+        for ace_id, cached_stats in ace_streams.items():
+            if not check_valid_ace_id(ace_id):
                 logger.warning("Invalid Ace ID found in cache: %s", ace_id)
+                continue
+
+            if isinstance(cached_stats, int):
+                if cached_stats != self.default_quality:
+                    cleaned_cache[ace_id] = self._stats_from_quality(cached_stats)
+                continue
+
+            try:
+                cleaned_cache[ace_id] = StreamStats(**cached_stats)
+            except TypeError:
+                logger.warning("Invalid stats found in cache for: %s", ace_id)
 
-        self.ace_streams = cleaned_cache
+        return cleaned_cache
 
-    def _load_cache(self) -> None:
+    def _stats_from_quality(self, quality: int) -> StreamStats:
+        """Approximate counters for a quality saved by an older version, as if it came from four results."""
+        success_rate = min(max(quality, self.min_quality), self.max_quality) / self.max_quality
+        return StreamStats(
+            successes=4 * success_rate,
+            failures=4 * (1 - success_rate),
+            manifest_latency=0.0,
+            segment_latency=0.0,
+            updated_at=time.time(),
+        )
+
+    def _load_cache(self) -> dict[str, dict[str, float] | int]:
         if self.cache_file and self.cache_file.exists():
             try:
                 with self.cache_file.open("r") as f:
                     cache_json_raw = f.read()
 
-                self.ace_streams = json.loads(cache_json_raw)
+                ace_streams: dict[str, dict[str, float] | int] = json.loads(cache_json_raw)
             except (json.JSONDecodeError, OSError):
                 logger.exception("Error loading cache file: %s", self.cache_file)
-                return
+            else:
+                return ace_streams
+
+        return {}
+
+    def _get_stripe_index(self, ace_id: str) -> int:
+        return hash(ace_id) % self.n_stripes
+
+    def _get_stripe(self, ace_id: str) -> dict[str, StreamStats]:
+        return self._stripes[self._get_stripe_index(ace_id)]
+
+    def _get_stats_snapshot(self) -> dict[str, StreamStats]:
+        """Get a copy of every stream's counters, taken with all the stripes locked so it is consistent."""
+        for lock in self._stripe_locks:
+            lock.acquire()
+        try:
+            snapshot: dict[str, StreamStats] = {}
+            for stripe in self._stripes:
+                snapshot.update(stripe)
+            return snapshot
+        finally:
+            for lock in self._stripe_locks:
+                lock.release()
+
+    def get_snapshot(self) -> dict[str, int]:
+        """Get the current quality of every stream that has been tried."""
+        now = time.time()
+        return {ace_id: self.get_score(stats, now) for ace_id, stats in self._get_stats_snapshot().items()}
+
+    def get_version(self) -> tuple[int, int]:
+        """Get a version that changes whenever a stream succeeds or fails, and as the qualities decay."""
+        return (sum(self._stripe_versions), int(time.time() // self.score_refresh_interval))
+
+    def load_qualities(self, ace_ids: Iterable[str]) -> None:
+        """Load the counters of streams from the quality_db, if they aren't already loaded."""
+        if not self.quality_db:
+            return
+
+        missing = [ace_id for ace_id in ace_ids if ace_id not in self._get_stripe(ace_id)]
+        try:
+            loaded_stats = self.quality_db.get_stats(missing)
+        except sqlite3.Error:
+            logger.exception("Error loading qualities from: %s", self.quality_db.db_file)
+            return
+
+        for ace_id, stats in loaded_stats.items():
+            stripe_index = self._get_stripe_index(ace_id)
+            with self._stripe_locks[stripe_index]:
+                self._stripes[stripe_index].setdefault(ace_id, stats)  # Don't clobber a newer result
+
+    def record_scrape(self, seen_streams: dict[str, str]) -> None:
+        """Record the streams found by a scrape (ace_id: site_name) in the quality_db, and load their qualities."""
+        if not self.quality_db:
+            return
+
+        try:
+            evicted = self.quality_db.record_scrape(seen_streams)
+        except sqlite3.Error:
+            logger.exception("Error recording scrape in: %s", self.quality_db.db_file)
+            evicted = []
+
+        for ace_id in evicted:
+            stripe_index = self._get_stripe_index(ace_id)
+            with self._stripe_locks[stripe_index]:
+                self._stripes[stripe_index].pop(ace_id, None)
+
+        self.load_qualities(seen_streams)
 
     def save_cache(self) -> None:
-        """Save the current quality cache to a file."""
+        """Save the current quality cache to a file, written to a temp file first so a crash can't leave half a file."""
+        if self.quality_db:
+            self._save_to_db(self.quality_db)
+            return
+
         if not self.cache_file:
             return
 
+        for stripe_index in range(self.n_stripes):
+            with self._stripe_locks[stripe_index]:
+                self._stripe_n_unsaved[stripe_index] = 0
+        ace_streams = {ace_id: stats._asdict() for ace_id, stats in self._get_stats_snapshot().items()}
+
+        temp_file = self.cache_file.with_suffix(".tmp")
         try:
-            with self.cache_file.open("w") as f:
-                json.dump(self.ace_streams, f, indent=4)
+            with temp_file.open("w") as f:
+                json.dump(ace_streams, f, indent=4)
+            temp_file.replace(self.cache_file)
         except OSError:
             logger.exception("Error saving cache file: %s", self.cache_file)
 
+    def _save_to_db(self, quality_db: AceQualityDB) -> None:
+        """Save only the streams that changed since the last save."""
+        now = time.time()
+        changes = {}
+        for stripe_index, stripe in enumerate(self._stripes):
+            with self._stripe_locks[stripe_index]:
+                self._stripe_n_unsaved[stripe_index] = 0
+                unsaved_counts = self._stripe_unsaved_counts[stripe_index]
+                self._stripe_unsaved_counts[stripe_index] = {}
+                unsaved_stats = {ace_id: stripe[ace_id] for ace_id in unsaved_counts if ace_id in stripe}
+
+            for ace_id, stats in unsaved_stats.items():
+                successes, failures = unsaved_counts[ace_id]
+                changes[ace_id] = (self.get_score(stats, now), stats, successes, failures)
+
+        try:
+            quality_db.save_stats(changes)
+        except sqlite3.Error:
+            logger.exception("Error saving qualities to: %s", quality_db.db_file)
+
+    def flush(self) -> None:
+        """Save the cache if there are unsaved changes."""
+        if any(self._stripe_n_unsaved):
+            self.save_cache()
+
+    def _save_loop(self) -> None:
+        while True:
+            self._save_event.wait(self.save_interval)
+            self._save_event.clear()
+            self.flush()
+
+    def _start_save_thread(self) -> None:
+        """Start the thread that saves changes, if it isn't running."""
+        if self._save_thread or not (self.cache_file or self.quality_db):
+            return
+
+        with self._lock:
+            if self._save_thread:  # Started by another thread while waiting for the lock
+                return
+            self._save_thread = threading.Thread(target=self._save_loop, name="ace_quality_save", daemon=True)
+            self._save_thread.start()
+        atexit.register(self.flush)  # The thread is a daemon, save anything it hasn't at shutdown
+
+    def get_score(self, stats: StreamStats, now: float | None = None) -> int:
+        """Score a stream's counters, the decayed success rate with a penalty for being slow.
+
+        Streams that only fail, or almost only fail, score min_quality rather than being lifted by the prior.
+        """
+        if not stats.successes and not stats.failures:
+            return self.default_quality
+
+        decay = self._get_decay(stats, time.time() if now is None else now)
+        successes = stats.successes * decay
+        failures = stats.failures * decay
+        if successes < self.failure_floor * (successes + failures):
+            return self.min_quality
+
+        success_rate = (successes + self.prior_success_rate * self.prior_weight) / (
+            successes + failures + self.prior_weight
+        )
+        slowness = max(
+            min(stats.manifest_latency / self.slow_manifest_latency, 1),
+            min(stats.segment_latency / self.slow_segment_latency, 1),
+        )
+        quality = round(self.max_quality * success_rate * (1 - self.latency_penalty * slowness))
+        return min(max(quality, self.min_quality), self.max_quality)
+
     def get_quality(self, ace_id: str) -> int:
-        """Get the quality of a stream by ace_id."""
+        """Get the quality of a stream by ace_id, streams that haven't been tried get the default."""
         if not check_valid_ace_id(ace_id):
             return -1
 
-        if ace_id not in self.ace_streams:
-            self._ensure_entry(ace_id)
-        return self.ace_streams[ace_id]
+        stats = self._get_stripe(ace_id).get(ace_id)
+        if not stats:
+            return self.default_quality
+        return self.get_score(stats)
+
+    def get_last_tried(self, ace_id: str) -> float:
+        """Get when a stream last had a result recorded, as unix time, 0 if it hasn't been tried."""
+        stats = self._get_stripe(ace_id).get(ace_id)
+        return stats.updated_at if stats else 0.0
+
+    def record_success(self, ace_id: str, latency: float) -> None:
+        """Record that a stream's manifest was fetched, and how many seconds it took."""
+        self._record(ace_id, success=1, manifest_latency=latency)
+
+    def record_failure(self, ace_id: str) -> None:
+        """Record that a stream's manifest couldn't be fetched, or wasn't valid."""
+        self._record(ace_id, failure=1)
 
-    def _ensure_entry(self, ace_id: str) -> None:
-        """Creates an entry with defaults if it doen't exist."""
-        if ace_id not in self.ace_streams:
-            self.ace_streams[ace_id] = self.default_quality
+    def record_segment_latency(self, ace_id: str, latency: float) -> None:
+        """Record how many seconds a segment of a stream took to start arriving."""
+        self._record(ace_id, segment_latency=latency)
 
-    def increment_quality(self, ace_id: str, rating: int) -> None:
-        """Increment the quality of a stream by ace_id."""
+    def _record(
+        self,
+        ace_id: str,
+        *,
+        success: int = 0,
+        failure: int = 0,
+        manifest_latency: float | None = None,
+        segment_latency: float | None = None,
+    ) -> None:
+        """Update a stream's counters, decaying the old results to now."""
         if not check_valid_ace_id(ace_id):
             return
 
-        logger.debug("Setting quality for AceStream %s by %d", ace_id, rating)
-        if ace_id not in self.ace_streams:
-            self.ace_streams[ace_id] = self.default_quality
+        logger.debug("Recording result for AceStream %s, success %d failure %d", ace_id, success, failure)
+        stripe_index = self._get_stripe_index(ace_id)
+        stripe = self._stripes[stripe_index]
+        if ace_id not in stripe:
+            self.load_qualities([ace_id])  # Streams that weren't in the last scrape
+
+        now = time.time()
+        with self._stripe_locks[stripe_index]:
+            stats = stripe.get(ace_id) or StreamStats(0.0, 0.0, 0.0, 0.0, 0.0)
+            if success or failure:  # Latency alone isn't a result, it doesn't count as the stream being tried
+                decay = self._get_decay(stats, now)
+                stats = stats._replace(
+                    successes=stats.successes * decay + success,
+                    failures=stats.failures * decay + failure,
+                    updated_at=now,
+                )
+            stripe[ace_id] = stats._replace(
+                manifest_latency=self._smooth_latency(stats.manifest_latency, manifest_latency),
+                segment_latency=self._smooth_latency(stats.segment_latency, segment_latency),
+            )
+
+            if success or failure:  # Latency alone shows up in the next score_refresh_interval
+                self._stripe_versions[stripe_index] += 1
+            if self.quality_db:
+                unsaved_counts = self._stripe_unsaved_counts[stripe_index]
+                successes, failures = unsaved_counts.get(ace_id, (0, 0))
+                unsaved_counts[ace_id] = (successes + success, failures + failure)
+            self._stripe_n_unsaved[stripe_index] += 1
+
+        self._start_save_thread()
+        if sum(self._stripe_n_unsaved) >= self.save_threshold:  # Read without the locks, close enough
+            self._save_event.set()
 
-        if self.ace_streams[ace_id] == self.default_quality and rating > 0:
-            rating = self.quality_on_first_success
+    def _get_decay(self, stats: StreamStats, now: float) -> float:
+        """Get how much a stream's results count for now, they halve every half_life."""
+        return float(0.5 ** (max(now - stats.updated_at, 0) / self.half_life))
 
-        self.ace_streams[ace_id] += rating
-        self.ace_streams[ace_id] = max(self.ace_streams[ace_id], self.min_quality)
-        self.ace_streams[ace_id] = min(self.ace_streams[ace_id], self.max_quality)
-        self.save_cache()
+    def _smooth_latency(self, average: float, latency: float | None) -> float:
+        """Update a latency moving average, the first measurement is taken as is."""
+        if latency is None:
+            return average
+        if not average:
+            return latency
+        return average + self.latency_smoothing * (latency - average)
@@ -0,0 +1,193 @@
+"""AceQualityDB, SQLite storage for AceQuality, with the history of each stream."""
+
+import datetime
+import sqlite3
+import threading
+from collections.abc import Iterable
+from pathlib import Path
+from typing import NamedTuple
+
+from .logger import get_logger
+
+logger = get_logger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS ace_quality (
+    ace_id TEXT PRIMARY KEY,
+    quality INTEGER NOT NULL,
+    successes INTEGER NOT NULL DEFAULT 0,
+    failures INTEGER NOT NULL DEFAULT 0,
+    site_name TEXT NOT NULL DEFAULT '',
+    last_seen TEXT,
+    last_seen_scrape INTEGER NOT NULL DEFAULT 0,
+    decayed_successes REAL NOT NULL DEFAULT 0,
+    decayed_failures REAL NOT NULL DEFAULT 0,
+    manifest_latency REAL NOT NULL DEFAULT 0,
+    segment_latency REAL NOT NULL DEFAULT 0,
+    updated_at REAL NOT NULL DEFAULT 0
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS ace_quality_last_seen_scrape ON ace_quality (last_seen_scrape);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+) WITHOUT ROWID;
+"""
+
+SELECT_STATS = """
+SELECT ace_id, decayed_successes, decayed_failures, manifest_latency, segment_latency, updated_at
+FROM ace_quality
+WHERE updated_at > 0
+"""
+
+UPSERT_STATS = """
+INSERT INTO ace_quality (
+    ace_id, quality, successes, failures, last_seen_scrape,
+    decayed_successes, decayed_failures, manifest_latency, segment_latency, updated_at
+)
+VALUES (?, ?, ?, ?, (SELECT COALESCE(MAX(value), 0) FROM meta WHERE key = 'scrapes'), ?, ?, ?, ?, ?)
+ON CONFLICT (ace_id) DO UPDATE SET
+    quality = excluded.quality,
+    successes = successes + excluded.successes,
+    failures = failures + excluded.failures,
+    decayed_successes = excluded.decayed_successes,
+    decayed_failures = excluded.decayed_failures,
+    manifest_latency = excluded.manifest_latency,
+    segment_latency = excluded.segment_latency,
+    updated_at = excluded.updated_at
+"""
+
+UPSERT_SEEN = """
+INSERT INTO ace_quality (ace_id, quality, site_name, last_seen, last_seen_scrape)
+VALUES (?, ?, ?, ?, ?)
+ON CONFLICT (ace_id) DO UPDATE SET
+    site_name = excluded.site_name,
+    last_seen = excluded.last_seen,
+    last_seen_scrape = excluded.last_seen_scrape
+"""
+
+INCREMENT_SCRAPES = """
+INSERT INTO meta (key, value) VALUES ('scrapes', 1)
+ON CONFLICT (key) DO UPDATE SET value = value + 1
+"""
+
+SQLITE_MAX_VARIABLES = 900  # Lower than the limit of older SQLite versions
+
+
+class StreamStats(NamedTuple):
+    """The counters that a stream's quality is scored from, see AceQuality."""
+
+    successes: float  # Decayed to updated_at
+    failures: float  # Decayed to updated_at
+    manifest_latency: float  # Seconds, moving average, 0 until measured
+    segment_latency: float  # Seconds, moving average, 0 until measured
+    updated_at: float  # Unix time of the last success or failure, 0 if there hasn't been one
+
+
+class AceQualityDB:
+    """SQLite (WAL mode) storage for stream qualities.
+
+    Only the rows that changed are written. Nothing is loaded up front, qualities are read for the streams that
+    are in use. Streams that haven't been seen in retention_scrapes scrapes are deleted, 0 keeps them forever.
+    """
+
+    def __init__(self, db_file: Path, default_quality: int, retention_scrapes: int = 0) -> None:
+        """Init AceQualityDB, creating the database if it doesn't exist."""
+        self.db_file = db_file
+        self.default_quality = default_quality
+        self.retention_scrapes = retention_scrapes
+
+        self._lock = threading.Lock()  # One connection, shared by the request threads and the save thread
+        self._connection = sqlite3.connect(db_file, check_same_thread=False, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")  # Safe with WAL, a crash can lose the last commit
+        self._connection.executescript(SCHEMA)
+
+    def count(self) -> int:
+        """Get the number of streams stored."""
+        with self._lock:
+            (count,) = self._connection.execute("SELECT COUNT(*) FROM ace_quality").fetchone()
+            return int(count)
+
+    def is_empty(self) -> bool:
+        """Check if no streams are stored, without counting them all."""
+        with self._lock:
+            return self._connection.execute("SELECT 1 FROM ace_quality LIMIT 1").fetchone() is None
+
+    def get_stats(self, ace_ids: Iterable[str]) -> dict[str, StreamStats]:
+        """Get the counters of the streams that have been tried."""
+        ace_ids = list(ace_ids)
+        stats: dict[str, StreamStats] = {}
+        with self._lock:
+            for start in range(0, len(ace_ids), SQLITE_MAX_VARIABLES):
+                batch = ace_ids[start : start + SQLITE_MAX_VARIABLES]
+                placeholders = ",".join("?" * len(batch))
+                rows = self._connection.execute(f"{SELECT_STATS} AND ace_id IN ({placeholders})", batch)
+                stats.update((ace_id, StreamStats(*row)) for ace_id, *row in rows)
+        return stats
+
+    def get_all_stats(self) -> dict[str, StreamStats]:
+        """Get the counters of every stream that has been tried."""
+        with self._lock:
+            return {ace_id: StreamStats(*row) for ace_id, *row in self._connection.execute(SELECT_STATS)}
+
+    def get_history(self, ace_id: str) -> dict[str, str | int] | None:
+        """Get everything stored about a stream."""
+        with self._lock:
+            cursor = self._connection.execute("SELECT * FROM ace_quality WHERE ace_id = ?", (ace_id,))
+            row = cursor.fetchone()
+            if not row:
+                return None
+            return {column[0]: value for column, value in zip(cursor.description, row, strict=True)}
+
+    def save_stats(self, changes: dict[str, tuple[int, StreamStats, int, int]]) -> None:
+        """Save changed streams, changes are ace_id: (quality, stats, new successes, new failures)."""
+        if not changes:
+            return
+
+        with self._lock, self._connection:
+            self._connection.execute("BEGIN")
+            self._connection.executemany(
+                UPSERT_STATS,
+                [
+                    (ace_id, quality, successes, failures, *stats)
+                    for ace_id, (quality, stats, successes, failures) in changes.items()
+                ],
+            )
+
+    def record_scrape(self, seen_streams: dict[str, str]) -> list[str]:
+        """Record the streams found by a scrape (ace_id: site_name), returns the ace_ids that were evicted."""
+        now = datetime.datetime.now(tz=datetime.UTC).isoformat()
+
+        with self._lock, self._connection:
+            self._connection.execute("BEGIN")
+            self._connection.execute(INCREMENT_SCRAPES)
+            (scrape_number,) = self._connection.execute("SELECT value FROM meta WHERE key = 'scrapes'").fetchone()
+
+            self._connection.executemany(
+                UPSERT_SEEN,
+                [
+                    (ace_id, self.default_quality, site_name, now, scrape_number)
+                    for ace_id, site_name in seen_streams.items()
+                ],
+            )
+
+            if self.retention_scrapes <= 0:
+                return []
+
+            oldest_kept = scrape_number - self.retention_scrapes + 1
+            evicted = [
+                ace_id
+                for (ace_id,) in self._connection.execute(
+                    "SELECT ace_id FROM ace_quality WHERE last_seen_scrape < ?", (oldest_kept,)
+                )
+            ]
+            self._connection.execute("DELETE FROM ace_quality WHERE last_seen_scrape < ?", (oldest_kept,))
+
+        if evicted:
+            logger.info("Evicted %d streams not seen in %d scrapes", len(evicted), self.retention_scrapes)
+        return evicted
+
+    def close(self) -> None:
+        """Close the database."""
+        with self._lock:
+            self._connection.close()
@@ -1,16 +1,22 @@
 """Helper functions for scrapers."""
 
+import datetime
+import hashlib
 import re
 
-from .config import TitleFilter
+import requests
+
+from .config import ScrapeSiteHTML, ScrapeSiteIPTV, TitleMatcher
 from .logger import get_logger
-from .scraper_objects import FlatFoundAceStream
+from .scraper_objects import FlatFoundAceStream, FoundAceStreams, ScrapedSite
 
 logger = get_logger(__name__)
 
 STREAM_TITLE_MAX_LENGTH = 50
 ACE_ID_LENGTH = 40
 ACE_URL_PREFIXES = ["http://127.0.0.1:6878/ace/getstream?id=", "acestream://"]
+ACE_ID_REGEX = re.compile(r"^[0-9a-fA-F]+$")
+ACE_ID_IN_TITLE_REGEX = re.compile(r"\b[0-9a-fA-F]{40}\b")
 
 
 def cleanup_candidate_title(title: str) -> str:
@@ -22,18 +28,18 @@ def cleanup_candidate_title(title: str) -> str:
 
     title = title.split("\n")[0].strip()  # Remove any newlines
     # Remove any ace 40 digit hex ids from the title
-    return re.sub(r"\b[0-9a-fA-F]{40}\b", "", title).strip()
+    return ACE_ID_IN_TITLE_REGEX.sub("", title).strip()
 
 
-def candidates_regex_cleanup(candidate_titles: list[str], regex: str) -> list[str]:
-    """Cleanup the title using a regex."""
-    if regex == "":
+def candidates_regex_cleanup(candidate_titles: list[str], title_matcher: TitleMatcher) -> list[str]:
+    """Cleanup the title using the title filter's regex."""
+    if not title_matcher.regex_postprocessing:
         return candidate_titles
 
     new_candidate_titles = []
 
     for title in candidate_titles:
-        title_new = re.sub(regex, "", title).strip()
+        title_new = title_matcher.postprocess_title(title)
         if title_new != "":
             new_candidate_titles.append(title_new)
 
@@ -41,16 +47,28 @@ def candidates_regex_cleanup(candidate_titles: list[str], regex: str) -> list[st
 
 
 def get_streams_as_iptv(streams: list[FlatFoundAceStream], base_url_hls: str) -> str:
-    """Get the found streams as an IPTV M3U8 string."""
-    m3u8_content = "#EXTM3U\n"
-
-    for stream in streams:
-        logger.debug(stream)
-        if stream.quality > 0:
-            m3u8_content += f"#EXTINF:-1 ,{stream.title}\n"
-            m3u8_content += f"{base_url_hls}{stream.ace_id}\n"
-
-    return m3u8_content
+    """Get the found streams as an IPTV M3U8 string, the best quality streams first."""
+    lines = ["#EXTM3U"]
+    for stream in sorted(streams, key=lambda stream: stream.quality, reverse=True):
+        lines.append(f"#EXTINF:-1 {get_extinf_attributes(stream)},{stream.title}")
+        lines.append(f"{base_url_hls}{stream.ace_id}")
+
+    return "\n".join(lines) + "\n"
+
+
+def get_extinf_attributes(stream: FlatFoundAceStream) -> str:
+    """Get the #EXTINF attributes of a stream, so IPTV clients can match it to their guide data and group it."""
+    attributes = {
+        "tvg-id": stream.tvg_id,
+        "tvg-logo": stream.tvg_logo,
+        "group-title": stream.group_title or stream.site_name,
+    }
+    attribute_strs = []
+    for name, value in attributes.items():
+        if value:
+            quote_safe_value = value.replace('"', "'")  # There is no escaping in M3U attributes
+            attribute_strs.append(f'{name}="{quote_safe_value}"')
+    return " ".join(attribute_strs)
 
 
 def check_valid_ace_id(ace_id: str) -> bool:
@@ -59,7 +77,7 @@ def check_valid_ace_id(ace_id: str) -> bool:
         logger.warning("AceStream ID is not the expected length (%d), skipping: %s", ACE_ID_LENGTH, ace_id)
         return False
 
-    if not re.match(r"^[0-9a-fA-F]+$", ace_id):
+    if not ACE_ID_REGEX.match(ace_id):
         logger.warning("AceStream ID contains invalid characters: %s", ace_id)
         return False
 
@@ -83,25 +101,75 @@ def check_valid_ace_url(url: str) -> bool:
     return any(url.startswith(prefix) for prefix in ACE_URL_PREFIXES)
 
 
-def check_title_allowed(title: str, title_filter: TitleFilter) -> bool:
+def check_title_allowed(title: str, title_matcher: TitleMatcher) -> bool:
     """Check if the title contains any disallowed words."""
     if not title:
         return False
 
-    title = title.lower()
-
-    if any(word.lower() in title for word in title_filter.always_exclude_words):
+    if not title_matcher.check_title_allowed(title):
         logger.trace("Title '%s' is not allowed, skipping", title)
         return False
 
-    if any(word.lower() in title for word in title_filter.always_include_words):
-        return True
-
-    if any(word.lower() in title for word in title_filter.exclude_words):
-        logger.trace("Title '%s' is not allowed, skipping", title)
-        return False
+    return True
 
-    if title_filter.include_words:
-        return any(word.lower() in title for word in title_filter.include_words)
 
-    return True
+def get_conditional_headers(site: ScrapeSiteHTML | ScrapeSiteIPTV, last_scrape: ScrapedSite | None) -> dict[str, str]:
+    """Get the headers for a conditional request, so the site can tell us if nothing has changed.
+
+    If the site config has changed since the last scrape the page needs to be parsed again, so there are none.
+    """
+    headers: dict[str, str] = {}
+    if not last_scrape or last_scrape.url != site.url or last_scrape.config_hash != get_config_hash(site):
+        return headers
+
+    if last_scrape.etag:
+        headers["If-None-Match"] = last_scrape.etag
+    if last_scrape.last_modified:
+        headers["If-Modified-Since"] = last_scrape.last_modified
+
+    return headers
+
+
+def get_config_hash(site: ScrapeSiteHTML | ScrapeSiteIPTV) -> str:
+    """Get the hash of a site config, anything in it can change what is parsed."""
+    return hashlib.sha256(site.model_dump_json().encode()).hexdigest()
+
+
+def get_content_hash(site: ScrapeSiteHTML | ScrapeSiteIPTV, content: bytes) -> str:
+    """Get the hash of a fetched page, the site config is included since it changes what is parsed."""
+    content_hash = hashlib.sha256(site.model_dump_json().encode())
+    content_hash.update(content)
+    return content_hash.hexdigest()
+
+
+def create_scraped_site(
+    site: ScrapeSiteHTML | ScrapeSiteIPTV,
+    response: requests.Response,
+    streams: FoundAceStreams,
+    content_hash: str,
+    parse_time: float,
+) -> ScrapedSite:
+    """Create the record of a successful scrape, including the validators for the next conditional request."""
+    return ScrapedSite(
+        url=site.url,
+        fetched_at=datetime.datetime.now(tz=datetime.UTC),
+        streams=streams,
+        etag=response.headers.get("ETag", ""),
+        last_modified=response.headers.get("Last-Modified", ""),
+        content_hash=content_hash,
+        config_hash=get_config_hash(site),
+        parse_time=parse_time,
+    )
+
+
+def reuse_scraped_site(last_scrape: ScrapedSite, response: requests.Response | None = None) -> ScrapedSite:
+    """Reuse the last scrape of a site that hasn't changed since, updating the validators if there is a response."""
+    update: dict[str, object] = {
+        "fetched_at": datetime.datetime.now(tz=datetime.UTC),
+        "parse_skipped": True,
+    }
+    if response is not None:
+        update["etag"] = response.headers.get("ETag", "")
+        update["last_modified"] = response.headers.get("Last-Modified", "")
+
+    return last_scrape.model_copy(update=update)
@@ -1,5 +1,11 @@
 """Helper functions and functions for searching in beautiful soup tags."""
 
+import functools
+import importlib.util
+import time
+from collections import Counter
+from http import HTTPStatus
+
 import requests
 from bs4 import BeautifulSoup, Tag
 
@@ -12,32 +18,43 @@ from .scraper_helpers import (
     check_valid_ace_id,
     check_valid_ace_url,
     cleanup_candidate_title,
+    create_scraped_site,
     extract_ace_id_from_url,
+    get_conditional_headers,
+    get_content_hash,
+    reuse_scraped_site,
 )
-from .scraper_objects import CandidateAceStream, FoundAceStream, FoundAceStreams
+from .scraper_objects import CandidateAceStream, FoundAceStream, FoundAceStreams, ScrapedSite
 
 logger = get_logger(__name__)
 
+# Links that could be AceStream links, check_valid_ace_url() is still used on what this finds
+ACE_LINK_SELECTOR = 'a[href^="acestream://"], a[href*="/ace/getstream"]'
 
-def scrape_streams_html_sites(sites: list[ScrapeSiteHTML]) -> list[FoundAceStreams]:
-    """Scrape the streams from the configured sites."""
-    found_streams: list[FoundAceStreams] = []
 
-    for site in sites:
-        streams = scrape_streams_html_site(site)
-        if streams:
-            found_streams.append(streams)
+@functools.cache
+def get_html_parser(html_parser: str) -> str:
+    """Get the HTML parser to use, falling back to html.parser if lxml isn't installed."""
+    if html_parser == "lxml" and importlib.util.find_spec("lxml") is None:
+        logger.warning("lxml isn't installed, using html.parser instead, install the lxml extra to use it")
+        return "html.parser"
+    return html_parser
 
-    return found_streams
 
+def scrape_streams_html_site(
+    site: ScrapeSiteHTML,
+    last_scrape: ScrapedSite | None = None,
+    html_parser: str = "html.parser",
+) -> ScrapedSite | None:
+    """Scrape the streams from the configured sites, the last scrape is reused if the site hasn't changed.
 
-def scrape_streams_html_site(site: ScrapeSiteHTML) -> FoundAceStreams | None:
-    """Scrape the streams from the configured sites."""
-    streams_candidates: list[CandidateAceStream] = []
+    html_parser is used if the site doesn't set its own.
+    """
+    site = site.model_copy(update={"html_parser": get_html_parser(site.html_parser or html_parser)})
 
     logger.debug("Scraping streams from site: %s", site)
     try:
-        response = requests.get(site.url, timeout=10)
+        response = requests.get(site.url, headers=get_conditional_headers(site, last_scrape), timeout=10)
         response.raise_for_status()
         response.encoding = "utf-8"  # Ensure the response is decoded correctly
     except requests.RequestException as e:
@@ -45,9 +62,40 @@ def scrape_streams_html_site(site: ScrapeSiteHTML) -> FoundAceStreams | None:
         logger.error("Error scraping site %s, %s", site.url, error_short)  # noqa: TRY400 Naa this should be shorter
         return None
 
-    soup = BeautifulSoup(response.text, "html.parser")
+    if last_scrape and response.status_code == HTTPStatus.NOT_MODIFIED:
+        logger.debug("Site %s not modified, reusing the last scrape", site.name)
+        return reuse_scraped_site(last_scrape)
+
+    content_hash = get_content_hash(site, response.content)
+    if last_scrape and last_scrape.content_hash == content_hash:
+        logger.debug("Site %s content unchanged, reusing the last scrape", site.name)
+        return reuse_scraped_site(last_scrape, response)
+
+    parse_start = time.perf_counter()
+    found_streams = parse_streams_html(site, response.text)
+    return create_scraped_site(
+        site,
+        response,
+        FoundAceStreams(
+            site_name=site.name,
+            stream_list=found_streams,
+        ),
+        content_hash=content_hash,
+        parse_time=time.perf_counter() - parse_start,
+    )
+
+
+def parse_streams_html(site: ScrapeSiteHTML, html: str) -> list[FoundAceStream]:
+    """Parse the streams from the html of a site."""
+    streams_candidates: list[CandidateAceStream] = []
+    seen_ace_urls: set[str] = set()
+
+    soup = BeautifulSoup(html, site.html_parser)
+    title_search = TitleCandidateSearch(site.target_class, check_sibling=site.check_sibling)
+    title_matcher = site.title_filter.get_matcher()
 
-    for link in soup.find_all("a", href=True):
+    links = soup.select(ACE_LINK_SELECTOR) if site.prefilter_links else soup.find_all("a", href=True)
+    for link in links:
         # Appease mypy
         if not isinstance(link, Tag):
             continue
@@ -57,39 +105,23 @@ def scrape_streams_html_site(site: ScrapeSiteHTML) -> FoundAceStreams | None:
 
         # We are iterating through all links, we only want AceStream links
         if check_valid_ace_url(link_href):
-            candidate_titles: list[str] = []
             ace_stream_url: str = link_href.strip()
 
             # Skip URLs that are already added, maybe this can check if the second instance has a different title
-            if ace_stream_url in [stream.ace_id for stream in streams_candidates]:
+            if ace_stream_url in seen_ace_urls:
                 continue
+            seen_ace_urls.add(ace_stream_url)
 
-            # Recurse through the parent tags to find a suitable title
-            candidate_titles.extend(
-                search_for_candidate(
-                    candidate_titles=candidate_titles.copy(),
-                    target_html_class=site.target_class,
-                    html_tag=link,
-                )
-            )
-
-            # Recurse through parent tags and check their siblings for a suitable title
-            if site.check_sibling:
-                candidate_titles.extend(
-                    search_sibling_for_candidate(
-                        candidate_titles=candidate_titles.copy(),
-                        target_html_class=site.target_class,
-                        html_tag=link,
-                    )
-                )
+            # Check the parent tags, and their siblings, for a suitable title
+            candidate_titles = title_search.get_candidates(link)
 
             # Through all title candidates, clean them up if there is a regex defined
             candidate_titles = candidates_regex_cleanup(
                 candidate_titles,
-                site.title_filter.regex_postprocessing,
+                title_matcher,
             )
 
-            candidate_titles = list(set(candidate_titles))  # Remove duplicates
+            candidate_titles = list(dict.fromkeys(candidate_titles))  # Remove duplicates, keeping the order
 
             streams_candidates.append(
                 CandidateAceStream(
@@ -98,29 +130,23 @@ def scrape_streams_html_site(site: ScrapeSiteHTML) -> FoundAceStreams | None:
                 )
             )
 
-    found_streams = process_candidates(streams_candidates, site)
-    return FoundAceStreams(
-        site_name=site.name,
-        stream_list=found_streams,
-    )
+    return process_candidates(streams_candidates, site)
 
 
 def process_candidates(candidates: list[CandidateAceStream], site: ScrapeSiteHTML) -> list[FoundAceStream]:
     """Process candidate streams to find valid AceStreams."""
     found_streams: list[FoundAceStream] = []
+    title_matcher = site.title_filter.get_matcher()
 
-    all_titles = []
-
-    # Collect a list of all candidate titles to find duplicates including duplicates
-    for candidate in candidates:
-        all_titles.extend(candidate.title_candidates)
+    # Count the candidate titles across all candidates, to find the ones that every candidate has
+    title_counts = Counter(title for candidate in candidates for title in candidate.title_candidates)
 
     for candidate in candidates:
         new_title_candidates = []
         for title in candidate.title_candidates:
             new_title = title
             # Anything that gets found for every candidate gets ignored
-            if all_titles.count(title) >= len(candidates):
+            if title_counts[title] >= len(candidates):
                 continue
 
             if len(title) > STREAM_TITLE_MAX_LENGTH:
@@ -140,7 +166,7 @@ def process_candidates(candidates: list[CandidateAceStream], site: ScrapeSiteHTM
 
         if not check_title_allowed(
             title=title,
-            title_filter=site.title_filter,
+            title_matcher=title_matcher,
         ):
             continue
 
@@ -177,52 +203,52 @@ def check_candidate(target_html_class: str, html_tag: Tag | None) -> list[str]:
     return candidate_titles
 
 
-def search_for_candidate(
-    candidate_titles: list[str], target_html_class: str = "", html_tag: Tag | None = None
-) -> list[str]:
-    """Search the parent of the given tag for a title."""
-    if not html_tag or not isinstance(html_tag, Tag):
-        return candidate_titles
-
-    # Search Parents
-    more = search_for_candidate(
-        candidate_titles=candidate_titles,
-        target_html_class=target_html_class,
-        html_tag=html_tag.parent,
-    )
-    candidate_titles.extend(more)
-
-    if target_html_class != "":
-        html_classes = html_tag.get("class", None)
-        if not html_classes:
-            return candidate_titles
-
-    # Search Self
-    candidates = check_candidate(target_html_class, html_tag)
-    candidate_titles.extend(candidates)
-
-    return candidate_titles
-
-
-def search_sibling_for_candidate(
-    candidate_titles: list[str], target_html_class: str = "", html_tag: Tag | None = None
-) -> list[str]:
-    """Search the previous sibling of the given tag for a title."""
-    if not html_tag or not isinstance(html_tag, Tag):
-        return candidate_titles
-
-    # Recurse through the parent tags
-    more = search_sibling_for_candidate(
-        candidate_titles=candidate_titles.copy(),
-        target_html_class=target_html_class,
-        html_tag=html_tag.parent,
-    )
-    candidate_titles.extend(more)
-
-    # Find and search previous sibling
-    previous_sibling = html_tag.find_previous_sibling()
-    if previous_sibling and isinstance(previous_sibling, Tag):
-        more = check_candidate(target_html_class, previous_sibling)
-        candidate_titles.extend(more)
-
-    return candidate_titles
+class TitleCandidateSearch:
+    """Find the title candidates of links in a page, each tag is only searched once.
+
+    A link's candidates are the matching text of itself and every tag above it, and if check_sibling is set,
+    the previous sibling of each of those. The candidates of each tag are cached, so links that share
+    ancestors don't walk (and call get_text() on) the same tags again. Tags are cached by id, so an instance
+    should only be used for one document, while it is alive.
+    """
+
+    def __init__(self, target_html_class: str = "", *, check_sibling: bool = False) -> None:
+        """Init TitleCandidateSearch."""
+        self.target_html_class = target_html_class
+        self.check_sibling = check_sibling
+        # id(tag): candidates of the tag and its ancestors, tags compare equal by their content so can't be the key
+        self._candidates: dict[int, tuple[str, ...]] = {}
+
+    def get_candidates(self, html_tag: Tag) -> list[str]:
+        """Get the title candidates for a tag."""
+        # Walk up until we reach a tag that has already been searched, or the top of the document
+        uncached_tags: list[Tag] = []
+        candidates: tuple[str, ...] = ()
+        current_tag: Tag | None = html_tag
+        while current_tag is not None:
+            cached_candidates = self._candidates.get(id(current_tag))
+            if cached_candidates is not None:
+                candidates = cached_candidates
+                break
+            uncached_tags.append(current_tag)
+            current_tag = current_tag.parent
+
+        # Then back down, each tag adds its own candidates to those of its parent
+        for tag in reversed(uncached_tags):
+            candidates = (*candidates, *self._get_own_candidates(tag))
+            self._candidates[id(tag)] = candidates
+
+        return list(candidates)
+
+    def _get_own_candidates(self, html_tag: Tag) -> list[str]:
+        """Get the title candidates of a tag itself, and its previous sibling."""
+        candidates = check_candidate(self.target_html_class, html_tag)
+
+        if self.check_sibling:
+            # Same as find_previous_sibling(), without the overhead of bs4's search
+            previous_sibling = html_tag.previous_sibling
+            while previous_sibling is not None and not isinstance(previous_sibling, Tag):
+                previous_sibling = previous_sibling.previous_sibling
+            candidates.extend(check_candidate(self.target_html_class, previous_sibling))
+
+        return candidates
@@ -1,34 +1,58 @@
 """Scraper for IPTV sites to find AceStream streams."""
 
+import re
+import sys
+import time
+from collections.abc import Iterable, Iterator
+from http import HTTPStatus
+
 import requests
 
 from .config import ScrapeSiteIPTV
 from .logger import get_logger
-from .scraper_helpers import check_title_allowed, check_valid_ace_id, check_valid_ace_url, extract_ace_id_from_url
-from .scraper_objects import FoundAceStream, FoundAceStreams
+from .scraper_helpers import (
+    check_title_allowed,
+    check_valid_ace_id,
+    check_valid_ace_url,
+    create_scraped_site,
+    extract_ace_id_from_url,
+    get_conditional_headers,
+    reuse_scraped_site,
+)
+from .scraper_objects import FoundAceStream, FoundAceStreams, ScrapedSite
 
 logger = get_logger(__name__)
 
+IPTV_CHUNK_SIZE = 64 * 1024
 
-def scrape_streams_iptv_sites(sites: list[ScrapeSiteIPTV]) -> list[FoundAceStreams]:
-    """Scrape the streams from the configured IPTV sites."""
-    found_streams: list[FoundAceStreams] = []
+# #EXTINF:<duration> key="value" key="value",<title>, some lists put a comma after the duration too
+# Values can also be single quoted or unquoted, e.g. tvg-id='abc' catchup-days=7
+EXTINF_VALUE = r"""(?:"[^"]*"|'[^']*'|[^\s,"']+)"""
+EXTINF_REGEX = re.compile(rf"^#EXTINF:\s*-?\d*(?:\.\d+)?\s*,?\s*((?:[\w-]+={EXTINF_VALUE}[\s,]*)*),(.*)$")
+EXTINF_ATTRIBUTE_REGEX = re.compile(rf"([\w-]+)=({EXTINF_VALUE})")
 
-    for site in sites:
-        streams = scrape_streams_iptv_site(site)
-        if streams:
-            found_streams.append(streams)
 
-    return found_streams
+class IPTVPlaylistTooLargeError(Exception):
+    """The IPTV playlist is larger than the configured maximum size."""
 
 
-def scrape_streams_iptv_site(site: ScrapeSiteIPTV) -> FoundAceStreams | None:
-    """Scrape the streams from the configured IPTV sites."""
-    streams: list[FoundAceStream] = []
+def scrape_streams_iptv_site(
+    site: ScrapeSiteIPTV,
+    last_scrape: ScrapedSite | None = None,
+    max_size: int = 100 * 1024 * 1024,
+) -> ScrapedSite | None:
+    """Scrape the streams from the configured IPTV sites, the last scrape is reused if the site hasn't changed.
 
+    The playlist is parsed as it is downloaded, playlists larger than max_size bytes are skipped.
+    """
     logger.debug("Scraping streams from IPTV site: %s", site)
     try:
-        response = requests.get(site.url, timeout=10)
+        response = requests.get(
+            site.url,
+            headers=get_conditional_headers(site, last_scrape),
+            timeout=10,
+            stream=True,
+        )
         response.raise_for_status()
         response.encoding = "utf-8"  # Ensure the response is decoded correctly
     except requests.RequestException as e:
@@ -36,53 +60,101 @@ def scrape_streams_iptv_site(site: ScrapeSiteIPTV) -> FoundAceStreams | None:
         logger.error("Error scraping IPTV site %s, %s", site.url, error_short)  # noqa: TRY400 Naa this should be shorter
         return None
 
-    url_section = 2
+    with response:
+        if last_scrape and response.status_code == HTTPStatus.NOT_MODIFIED:
+            logger.debug("IPTV site %s not modified, reusing the last scrape", site.name)
+            return reuse_scraped_site(last_scrape)
+
+        parse_start = time.perf_counter()
+        try:
+            streams = parse_iptv_lines(site, iter_response_lines(response, max_size))
+        except (requests.RequestException, IPTVPlaylistTooLargeError) as e:
+            error_short = type(e).__name__
+            logger.error("Error scraping IPTV site %s, %s", site.url, error_short)  # noqa: TRY400 Naa this should be shorter
+            return None
+        parse_time = time.perf_counter() - parse_start
+
+    logger.debug("Found %d streams on IPTV site %s", len(streams), site.name)
+
+    return create_scraped_site(
+        site,
+        response,
+        FoundAceStreams(
+            site_name=site.name,
+            stream_list=streams,
+        ),
+        content_hash="",  # The playlist is parsed as it downloads, so there is no parse to skip
+        parse_time=parse_time,
+    )
+
+
+def iter_response_lines(response: requests.Response, max_size: int) -> Iterator[str]:
+    """Iterate over the lines of a streamed response, raising IPTVPlaylistTooLargeError past max_size bytes."""
+    content_length = response.headers.get("Content-Length", "")
+    if content_length.isdigit() and int(content_length) > max_size:
+        raise IPTVPlaylistTooLargeError(content_length)
+
+    size = 0
+    for line in response.iter_lines(chunk_size=IPTV_CHUNK_SIZE, decode_unicode=True):
+        size += len(line) + 1  # Close enough to bytes, the Content-Length check above is exact
+        if size > max_size:
+            raise IPTVPlaylistTooLargeError(size)
+        yield line
+
+
+def parse_extinf(line: str) -> tuple[str, dict[str, str]] | None:
+    """Parse an #EXTINF line into its title and attributes, None if it is malformed."""
+    match = EXTINF_REGEX.match(line)
+    if not match:
+        return None
+
+    attributes = {
+        key: value[1:-1] if value[0] in "\"'" else value  # Without the quotes
+        for key, value in EXTINF_ATTRIBUTE_REGEX.findall(match.group(1))
+    }
+    return match.group(2).strip(), attributes
+
+
+def parse_iptv_lines(site: ScrapeSiteIPTV, lines: Iterable[str]) -> list[FoundAceStream]:
+    """Parse the streams from the lines of an IPTV playlist."""
+    streams: list[FoundAceStream] = []
+    title_matcher = site.title_filter.get_matcher()
 
-    lines = response.text.splitlines()
     title = ""
-    ace_id = ""
+    attributes: dict[str, str] = {}
     for line in lines:
-        line_normalised = line.replace("#EXTINF:-1,", "#EXTINF:-1").strip()
-        if line.startswith("#EXTINF:"):
-            ace_id = ""  # Reset
+        line_normalised = line.strip()
+        if line_normalised.startswith("#EXTINF:"):
             title = ""  # Reset
-            parts = line_normalised.split(",")
-            if len(parts) != url_section:
+            extinf = parse_extinf(line_normalised)
+            if not extinf:
                 logger.warning("Malformed line in IPTV stream: %s", line_normalised)
                 continue
 
-            title = parts[1].strip()
-
+            title, attributes = extinf
             if not check_title_allowed(
                 title=title,
-                title_filter=site.title_filter,
+                title_matcher=title_matcher,
             ):
                 title = ""
-                continue
 
-        elif check_valid_ace_url(line_normalised):
+        elif title != "" and check_valid_ace_url(line_normalised):
             ace_id = extract_ace_id_from_url(line_normalised)
 
             if not check_valid_ace_id(ace_id):
                 logger.warning("Invalid Ace ID found in candidate: %s, skipping", ace_id)
-                ace_id = ""
                 continue
 
-        if title != "" and ace_id != "":
             streams.append(
                 FoundAceStream(
                     title=title,
                     ace_id=ace_id,
+                    tvg_id=attributes.get("tvg-id", ""),
+                    # Groups and logos are shared by many streams in big playlists, only keep one copy of each
+                    tvg_logo=sys.intern(attributes.get("tvg-logo", "")),
+                    group_title=sys.intern(attributes.get("group-title", "")),
                 )
             )
+            title = ""  # Only one stream per #EXTINF
 
-    logger.debug("Found %d streams on IPTV site %s", len(streams), site.name)
-
-    return (
-        FoundAceStreams(
-            site_name=site.name,
-            stream_list=streams,
-        )
-        if streams
-        else None
-    )
+    return streams
@@ -1,5 +1,7 @@
 """Custom Pydantic models (objects) for scraping."""
 
+import datetime
+
 from pydantic import BaseModel
 
 
@@ -9,6 +11,9 @@ class FoundAceStream(BaseModel):
     title: str
     ace_id: str
     quality: int = -1
+    tvg_id: str = ""  # From IPTV playlists
+    tvg_logo: str = ""
+    group_title: str = ""
 
 
 class FoundAceStreams(BaseModel):
@@ -32,3 +37,29 @@ class FlatFoundAceStream(BaseModel):
     quality: int
     title: str
     ace_id: str
+    tvg_id: str = ""
+    tvg_logo: str = ""
+    group_title: str = ""
+
+
+class ScrapedSite(BaseModel):
+    """Model for the last successful scrape of a site."""
+
+    url: str
+    fetched_at: datetime.datetime
+    streams: FoundAceStreams
+    etag: str = ""  # Validators for conditional requests
+    last_modified: str = ""
+    content_hash: str = ""  # For sites that don't send validators but serve the same page
+    config_hash: str = ""  # The site config the streams were parsed with, validators are only reused with it
+    parse_time: float = 0.0  # Seconds it took to parse the page
+    parse_skipped: bool = False  # Whether the streams were reused from the scrape before
+
+
+class ScraperStatus(BaseModel):
+    """Model for the state of the scraper."""
+
+    scrape_in_progress: bool = False
+    streams_from_cache: bool = False  # Streams are from a previous run, not scraped since startup
+    last_scrape_started: datetime.datetime | None = None
+    last_scrape_finished: datetime.datetime | None = None
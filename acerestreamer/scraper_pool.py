@@ -0,0 +1,100 @@
+"""Run the scrape of every site concurrently."""
+
+import threading
+import time
+from collections import deque
+from collections.abc import Callable
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from urllib.parse import urlparse
+
+from pydantic import BaseModel
+
+from .logger import get_logger
+from .scraper_objects import ScrapedSite
+
+logger = get_logger(__name__)
+
+
+class ScrapeJob(BaseModel):
+    """Model for a site to scrape, and the function that scrapes it."""
+
+    site_name: str
+    url: str
+    scrape: Callable[[], ScrapedSite | None]
+
+
+def run_scrape_jobs(
+    jobs: list[ScrapeJob],
+    max_workers: int,
+    max_per_host: int,
+    deadline: float,
+) -> list[ScrapedSite | None]:
+    """Run the scrape jobs in a thread pool, returns the results in the same order as the jobs.
+
+    At most max_per_host jobs run against the same host at once, a host's next job is submitted when one of its
+    jobs finishes so jobs for other hosts aren't held up. Jobs that haven't finished by the deadline
+    are abandoned and their result is None, so one slow site can't hold up the rest.
+    """
+    if not jobs:
+        return []
+
+    host_queues: dict[str, deque[int]] = {}  # host: indexes of the jobs waiting for a slot
+    for n, job in enumerate(jobs):
+        host_queues.setdefault(urlparse(job.url).netloc, deque()).append(n)
+
+    futures: list[Future[ScrapedSite | None]] = [Future() for _ in jobs]
+    executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="ace_scraper_site")
+    lock = threading.RLock()  # For the host queues, re-entered if a job finishes before its callback is added
+    stop_event = threading.Event()
+
+    def _run_job(n: int) -> None:
+        job = jobs[n]
+        start = time.monotonic()
+        try:
+            result = job.scrape()
+        except Exception as e:  # noqa: BLE001 Reported with the results
+            futures[n].set_exception(e)
+        else:
+            futures[n].set_result(result)
+        logger.debug("Scraped %s in %.2fs", job.site_name, time.monotonic() - start)
+
+    def _submit_next(host: str) -> None:
+        """Submit the next job for a host, only called when the host has a free slot."""
+        with lock:
+            if stop_event.is_set() or not host_queues[host]:
+                return
+            n = host_queues[host].popleft()
+            executor.submit(_run_job, n).add_done_callback(lambda _: _submit_next(host))
+
+    # Jobs only go to the pool once their host has a free slot, so workers never sit waiting on a busy host
+    for _ in range(max_per_host):
+        for host in host_queues:
+            _submit_next(host)
+
+    _, not_done = wait(futures, timeout=deadline)
+    with lock:
+        stop_event.set()
+    executor.shutdown(wait=False, cancel_futures=True)  # Don't wait for any stragglers
+
+    return _get_results(jobs, futures, not_done, deadline)
+
+
+def _get_results(
+    jobs: list[ScrapeJob],
+    futures: list[Future[ScrapedSite | None]],
+    not_done: set[Future[ScrapedSite | None]],
+    deadline: float,
+) -> list[ScrapedSite | None]:
+    """Get the result of each job, None for the jobs that failed or didn't finish in time."""
+    results: list[ScrapedSite | None] = []
+    for job, future in zip(jobs, futures, strict=True):
+        if future in not_done:
+            logger.warning("Scraping %s didn't finish within the %ss deadline, skipping", job.site_name, deadline)
+            results.append(None)
+        elif future.exception():
+            logger.error("Error scraping %s: %s", job.site_name, future.exception())
+            results.append(None)
+        else:
+            results.append(future.result())
+
+    return results
@@ -0,0 +1,58 @@
+"""StreamRegistry, indexes of the found streams."""
+
+import itertools
+
+from .scraper_objects import FlatFoundAceStream, FoundAceStreams
+
+_generations = itertools.count()
+
+
+class StreamRegistry:
+    """The found streams from a scrape, indexed by ace_id, site and title.
+
+    Built once per scrape and then only read, a new scrape builds a new registry. The quality of the streams
+    isn't kept up to date here, it changes far more often than the streams do.
+    """
+
+    def __init__(self, streams: list[FoundAceStreams] | None = None) -> None:
+        """Init StreamRegistry, indexing the streams."""
+        self.generation = next(_generations)  # Unique per registry, for caching anything built from it
+        self.streams: list[FoundAceStreams] = streams or []
+        self.flat_streams: list[FlatFoundAceStream] = []
+
+        self._by_ace_id: dict[str, FlatFoundAceStream] = {}
+        self._by_site: dict[str, list[FlatFoundAceStream]] = {}
+        self._by_title: dict[str, list[FlatFoundAceStream]] = {}
+
+        for found_streams in self.streams:
+            site_streams = self._by_site.setdefault(found_streams.site_name, [])
+            for stream in found_streams.stream_list:
+                flat_stream = FlatFoundAceStream(
+                    site_name=found_streams.site_name,
+                    quality=stream.quality,
+                    title=stream.title,
+                    ace_id=stream.ace_id,
+                    tvg_id=stream.tvg_id,
+                    tvg_logo=stream.tvg_logo,
+                    group_title=stream.group_title,
+                )
+                self.flat_streams.append(flat_stream)
+                site_streams.append(flat_stream)
+                self._by_ace_id.setdefault(stream.ace_id, flat_stream)  # The first site to list a stream wins
+                self._by_title.setdefault(stream.title.lower(), []).append(flat_stream)
+
+    def __len__(self) -> int:
+        """Get the number of streams."""
+        return len(self.flat_streams)
+
+    def get_by_ace_id(self, ace_id: str) -> FlatFoundAceStream | None:
+        """Get a stream by its Ace ID."""
+        return self._by_ace_id.get(ace_id)
+
+    def get_by_site(self, site_name: str) -> list[FlatFoundAceStream]:
+        """Get the streams found on a site."""
+        return self._by_site.get(site_name, [])
+
+    def get_by_title(self, title: str) -> list[FlatFoundAceStream]:
+        """Get the streams with a title, ignoring case."""
+        return self._by_title.get(title.lower(), [])
@@ -0,0 +1,346 @@
+"""Optional ASGI serving mode, the /hls/ and /ace/c/ reverse proxy runs on an async HTTP client.
+
+Every other route is handed to the Flask app through asgiref's WSGI adapter, so only the streaming routes,
+which spend almost all of their time waiting on the engine, skip the WSGI thread per request.
+Needs the 'asgi' extra: httpx, asgiref and an ASGI server such as uvicorn.
+"""
+
+import asyncio
+import contextlib
+import json
+import time
+from collections.abc import Awaitable, Callable, MutableMapping
+from http import HTTPStatus
+from typing import Any
+
+import httpx
+from asgiref.wsgi import WsgiToAsgi
+
+from . import stream_bp
+from .authentication_bp import get_ip_from_environ, is_ip_allowed
+from .config import TimeoutConf
+from .flask_helpers import FlaskAceReStreamer
+from .logger import get_logger
+from .stream_cache import CachedManifest
+
+logger = get_logger(__name__)
+
+Scope = MutableMapping[str, Any]
+Message = MutableMapping[str, Any]
+Receive = Callable[[], Awaitable[Message]]
+Send = Callable[[Message], Awaitable[None]]
+
+
+def _get_httpx_timeout(timeout_conf: TimeoutConf) -> httpx.Timeout:
+    """Convert our timeout config to httpx's."""
+    return httpx.Timeout(timeout_conf.read, connect=timeout_conf.connect)
+
+
+class AsyncStreamProxy:
+    """ASGI app that proxies /hls/ and /ace/c/ asynchronously, and passes everything else to Flask."""
+
+    def __init__(self, flask_app: FlaskAceReStreamer) -> None:
+        """Init AsyncStreamProxy."""
+        self.flask_app = flask_app
+        self.app_conf = flask_app.aw_conf.app
+        self.server_name: str = flask_app.config["SERVER_NAME"]
+        self.wsgi_app = WsgiToAsgi(flask_app)  # type: ignore[no-untyped-call] # asgiref isn't fully typed
+
+        self._client: httpx.AsyncClient | None = None
+        self._manifest_fetches: dict[str, asyncio.Future[CachedManifest]] = {}
+        self._segment_fetches: dict[str, asyncio.Event] = {}
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        """ASGI entrypoint."""
+        if scope["type"] == "lifespan":
+            await self._lifespan(receive, send)
+            return
+
+        path: str = scope.get("path", "")
+        if scope["type"] == "http" and scope["method"] == "GET":
+            if path.startswith("/hls/"):
+                if await self._auth_ok(scope, send):
+                    await self.hls_stream(path.removeprefix("/hls/"), send)
+                return
+
+            if path.startswith("/ace/c/"):
+                if await self._auth_ok(scope, send):
+                    await self.ace_content(path.removeprefix("/ace/c/"), receive, send)
+                return
+
+        await self.wsgi_app(scope, receive, send)
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        """Get the async client, created on first use so it belongs to the running event loop."""
+        if not self._client:
+            self._client = httpx.AsyncClient(
+                limits=httpx.Limits(max_connections=None, max_keepalive_connections=self.app_conf.ace_pool_size),
+            )
+        return self._client
+
+    async def _lifespan(self, receive: Receive, send: Send) -> None:
+        """Handle ASGI startup and shutdown."""
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                if self._client:
+                    await self._client.aclose()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def _auth_ok(self, scope: Scope, send: Send) -> bool:
+        """Check the IP is allowed, same as assumed_auth_failure() for the Flask routes."""
+        if not self.app_conf.password:
+            return True
+
+        headers = {name.decode("latin-1").lower(): value.decode("latin-1") for name, value in scope["headers"]}
+        client = scope.get("client")
+        environ = {
+            "HTTP_X_FORWARDED_FOR": headers.get("x-forwarded-for"),
+            "HTTP_X_REAL_IP": headers.get("x-real-ip"),
+            "REMOTE_ADDR": client[0] if client else None,
+        }
+        if is_ip_allowed(get_ip_from_environ(environ)):
+            return True
+
+        await send(
+            {
+                "type": "http.response.start",
+                "status": HTTPStatus.UNAUTHORIZED,
+                "headers": [(b"location", b"/"), (b"content-length", b"0")],
+            }
+        )
+        await send({"type": "http.response.body", "body": b""})
+        return False
+
+    async def hls_stream(self, content_id: str, send: Send) -> None:
+        """Reverse proxy the HLS from Ace."""
+        logger.debug("HLS stream requested for path: %s", content_id)
+
+        manifest = stream_bp.manifest_cache.get(content_id) if stream_bp.manifest_cache else None
+
+        if not manifest:
+            fetch = self._manifest_fetches.get(content_id)
+            if fetch:  # Another request is already fetching it, wait for that one
+                manifest = await asyncio.shield(fetch)
+            else:
+                fetch = asyncio.get_running_loop().create_future()
+                self._manifest_fetches[content_id] = fetch
+                try:
+                    manifest = await self._fetch_manifest(content_id)
+                    if stream_bp.manifest_cache:
+                        stream_bp.manifest_cache.put(content_id, manifest)
+                    fetch.set_result(manifest)
+                except BaseException as e:
+                    fetch.set_exception(e)
+                    fetch.exception()  # Mark as retrieved, waiters will see it if there are any
+                    raise
+                finally:
+                    del self._manifest_fetches[content_id]
+
+        if manifest.error:
+            error_body: dict[str, str] = {"error": manifest.error}
+            if manifest.content:
+                error_body["m3u8"] = manifest.content
+            json_headers = [("Content-Type", "application/json")]
+            await self._send_body(send, manifest.status_code, json_headers, json.dumps(error_body).encode())
+            return
+
+        await self._send_body(send, manifest.status_code, manifest.headers, manifest.content.encode())
+
+    async def _fetch_manifest(self, content_id: str) -> CachedManifest:
+        """Fetch a manifest from Ace."""
+        start = time.perf_counter()
+        result = await self._get_from_engines(
+            stream_bp.engine_pool.get_engines(content_id) if stream_bp.engine_pool else [],
+            f"/ace/manifest.m3u8?content_id={content_id}",
+            self.app_conf.manifest_timeout,
+        )
+        latency = time.perf_counter() - start
+        if not result:
+            logger.error("/hls/ reverse proxy failure, no engine answered for %s", content_id)
+            return await asyncio.to_thread(stream_bp.manifest_fetch_failed, content_id)
+
+        resp, engine_address = result
+        try:
+            await resp.aread()
+        except httpx.HTTPError as e:
+            error_short = type(e).__name__
+            logger.error("/hls/ reverse proxy failure %s", error_short)  # noqa: TRY400 Naa this should be shorter
+            return await asyncio.to_thread(stream_bp.manifest_fetch_failed, content_id)
+        finally:
+            await resp.aclose()
+
+        # Quality tracking does disk IO, keep it off the event loop
+        return await asyncio.to_thread(
+            stream_bp.process_manifest,
+            content_id=content_id,
+            status_code=resp.status_code,
+            headers=self._get_reverse_proxy_headers(resp),
+            content=resp.content,
+            server_name=self.server_name,
+            engine_address=engine_address,
+            latency=latency,
+        )
+
+    async def _get_from_engines(
+        self,
+        engines: list[str],
+        path: str,
+        timeout_conf: TimeoutConf,
+    ) -> tuple[httpx.Response, str] | None:
+        """Request a path from the first engine that answers, failing over to the next engine on connection errors.
+
+        The response is streamed, the caller must read or close it.
+        """
+        for engine_address in engines:
+            request = self.client.build_request(
+                "GET", f"{engine_address}{path}", timeout=_get_httpx_timeout(timeout_conf)
+            )
+            try:
+                resp = await self.client.send(request, stream=True)
+            except httpx.HTTPError as e:
+                error_short = type(e).__name__
+                logger.error("Reverse proxy failure from %s, %s", engine_address, error_short)  # noqa: TRY400 Naa this should be shorter
+                if stream_bp.engine_pool:
+                    stream_bp.engine_pool.mark_failure(engine_address)
+                continue
+
+            if stream_bp.engine_pool:
+                stream_bp.engine_pool.mark_success(engine_address)
+            return resp, engine_address
+
+        return None
+
+    async def ace_content(self, path: str, receive: Receive, send: Send) -> None:
+        """Reverse proxy the Ace content, streaming it through."""
+        logger.debug("Ace content requested for path: %s", path)
+
+        segment_cache = stream_bp.segment_cache
+        if segment_cache and not segment_cache.enabled:
+            segment_cache = None
+
+        claimed = False
+        if segment_cache:
+            segment = segment_cache.get(path)
+            fetch = self._segment_fetches.get(path)
+            if not segment and fetch:  # Another request is already fetching it, wait for that one
+                with contextlib.suppress(TimeoutError):
+                    await asyncio.wait_for(fetch.wait(), self.app_conf.content_timeout.read)
+                segment = segment_cache.get(path)
+            elif not segment:
+                self._segment_fetches[path] = asyncio.Event()
+                claimed = True
+
+            if segment:
+                await self._send_body(send, segment.status_code, segment.headers, segment.content)
+                return
+
+        try:
+            # Cancel the transfer if the client goes away, which releases the upstream connection
+            stream_task = asyncio.ensure_future(self._stream_content(path, send, cache=claimed))
+            disconnect_task = asyncio.ensure_future(self._wait_for_disconnect(receive))
+            done, _ = await asyncio.wait((stream_task, disconnect_task), return_when=asyncio.FIRST_COMPLETED)
+            disconnect_task.cancel()
+            if stream_task in done:
+                stream_task.result()  # Raise anything unexpected
+            else:
+                logger.debug("Client disconnected from /ace/c/%s", path)
+                stream_task.cancel()
+                with contextlib.suppress(asyncio.CancelledError):
+                    await stream_task
+        finally:
+            if claimed:
+                self._segment_fetches.pop(path).set()
+
+    async def _stream_content(self, path: str, send: Send, *, cache: bool) -> None:
+        """Stream the content from Ace to the client, filling the segment cache if we claimed the segment."""
+        start = time.perf_counter()
+        result = await self._get_from_engines(
+            stream_bp.engine_pool.get_engines_for_content(path) if stream_bp.engine_pool else [],
+            f"/ace/c/{path}",
+            self.app_conf.content_timeout,
+        )
+        if not result:
+            logger.error("/ace/c/ reverse proxy failure, no engine answered for %s", path)
+            await self._send_body(
+                send,
+                HTTPStatus.INTERNAL_SERVER_ERROR,
+                [("Content-Type", "application/json")],
+                json.dumps({"error": "Failed to fetch HLS stream"}).encode(),
+            )
+            return
+
+        resp, _ = result
+        # Can load the stream's quality from the quality_db, keep it off the event loop
+        await asyncio.to_thread(stream_bp.record_segment_latency, path, time.perf_counter() - start)
+        try:
+            headers = self._get_reverse_proxy_headers(resp)
+            streamed_headers = list(headers)
+
+            # Only forward the length if the body won't be decoded by httpx, otherwise it would be wrong
+            content_length = resp.headers.get("content-length")
+            if content_length and not resp.headers.get("content-encoding"):
+                streamed_headers.append(("Content-Length", content_length))
+
+            segment_cache = stream_bp.segment_cache
+            cache_buffer = bytearray() if cache and segment_cache and resp.status_code == HTTPStatus.OK else None
+
+            await send(
+                {
+                    "type": "http.response.start",
+                    "status": resp.status_code,
+                    "headers": self._encode_headers(streamed_headers),
+                }
+            )
+            async for chunk in resp.aiter_bytes(self.app_conf.ace_content_chunk_size):
+                if cache_buffer is not None and segment_cache:
+                    cache_buffer += chunk
+                    if len(cache_buffer) > segment_cache.max_segment_bytes:
+                        cache_buffer = None  # Too big, just stream it
+                await send({"type": "http.response.body", "body": chunk, "more_body": True})
+            await send({"type": "http.response.body", "body": b""})
+
+            if cache_buffer is not None and segment_cache:
+                segment_cache.put(path, bytes(cache_buffer), resp.status_code, headers)
+        except httpx.HTTPError as e:
+            error_short = type(e).__name__
+            logger.error("/ace/c/ reverse proxy failure mid-stream %s", error_short)  # noqa: TRY400 Naa this should be shorter
+        finally:
+            await resp.aclose()
+
+    @staticmethod
+    async def _wait_for_disconnect(receive: Receive) -> None:
+        """Wait until the client goes away."""
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                return
+
+    @staticmethod
+    def _get_reverse_proxy_headers(resp: httpx.Response) -> list[tuple[str, str]]:
+        """Get the headers from the upstream response that are safe to pass on to the client."""
+        return [
+            (name, value)
+            for (name, value) in resp.headers.items()
+            if name.lower() not in stream_bp.REVERSE_PROXY_EXCLUDED_HEADERS
+        ]
+
+    @staticmethod
+    def _encode_headers(headers: list[tuple[str, str]]) -> list[tuple[bytes, bytes]]:
+        """Encode headers for ASGI."""
+        return [(name.lower().encode("latin-1"), value.encode("latin-1")) for name, value in headers]
+
+    async def _send_body(self, send: Send, status_code: int, headers: list[tuple[str, str]], body: bytes) -> None:
+        """Send a complete response."""
+        await send(
+            {
+                "type": "http.response.start",
+                "status": status_code,
+                "headers": [*self._encode_headers(headers), (b"content-length", str(len(body)).encode())],
+            }
+        )
+        await send({"type": "http.response.body", "body": body})
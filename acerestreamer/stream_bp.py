@@ -1,12 +1,20 @@
 """Main Stream Site Blueprint."""
 
+import functools
+import gzip
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import Callable, Iterator
 from http import HTTPStatus
 from pathlib import Path
 
 import requests
-from flask import Blueprint, Response, jsonify, redirect, render_template
+from flask import Blueprint, Response, jsonify, redirect, render_template, request
 from werkzeug.wrappers import Response as WerkzeugResponse
 
+from .ace_engine import AceEnginePool, create_ace_session
 from .authentication_bp import get_ip_from_request, is_ip_allowed
 from .authentication_helpers import assumed_auth_failure
 from .flask_helpers import get_current_app
@@ -14,22 +22,138 @@ from .html_snippets import get_header_snippet
 from .logger import get_logger
 from .scraper import AceScraper
 from .scraper_helpers import get_streams_as_iptv
+from .stream_cache import CachedManifest, ManifestCache, SegmentCache
+from .stream_prober import AceStreamProber
 
 logger = get_logger(__name__)  # Create a logger: acerestreamer.this_module_name, inherit config from root logger
 
 bp = Blueprint("acerestreamer_scraper", __name__)
 ace_scraper: AceScraper | None = None
+segment_cache: SegmentCache | None = None
+manifest_cache: ManifestCache | None = None
+ace_session: requests.Session | None = None
+engine_pool: AceEnginePool | None = None
+stream_prober: AceStreamProber | None = None
 current_app = get_current_app()
 
+# Built responses, key: (streams version, body, gzipped body, etag), least recently used first
+response_cache: OrderedDict[str, tuple[tuple[int, ...], bytes, bytes, str]] = OrderedDict()
+response_cache_lock = threading.Lock()
+RESPONSE_CACHE_MAX_ENTRIES = 64  # Every combination of /iptv filters is an entry
+RESPONSE_GZIP_MIN_BYTES = 1024  # Smaller bodies aren't worth compressing
+
 REVERSE_PROXY_EXCLUDED_HEADERS = ["content-encoding", "content-length", "transfer-encoding", "connection", "keep-alive"]
-REVERSE_PROXY_TIMEOUT = 10  # Very high but alas
+
+
+def _get_reverse_proxy_headers(resp: requests.Response) -> list[tuple[str, str]]:
+    """Get the headers from the upstream response that are safe to pass on to the client."""
+    return [
+        (name, value)
+        for (name, value) in resp.raw.headers.items()
+        if name.lower() not in REVERSE_PROXY_EXCLUDED_HEADERS
+    ]
+
+
+def _get_from_engines(
+    engines: list[str],
+    path: str,
+    timeout: tuple[float, float],
+    *,
+    stream: bool = False,
+) -> tuple[requests.Response, str] | None:
+    """Request a path from the first engine that answers, failing over to the next engine on connection errors."""
+    if not ace_session or not engine_pool:
+        return None
+
+    for engine_address in engines:
+        try:
+            resp = ace_session.get(f"{engine_address}{path}", timeout=timeout, stream=stream)
+        except requests.RequestException as e:
+            error_short = type(e).__name__
+            logger.error("Reverse proxy failure from %s, %s", engine_address, error_short)  # noqa: TRY400 Naa this should be shorter
+            engine_pool.mark_failure(engine_address)
+            continue
+
+        engine_pool.mark_success(engine_address)
+        return resp, engine_address
+
+    return None
+
+
+def _iter_upstream_content(
+    resp: requests.Response,
+    chunk_size: int,
+    cache_key: str | None = None,
+    cache_headers: list[tuple[str, str]] | None = None,
+    claim: threading.Event | None = None,
+) -> Iterator[bytes]:
+    """Pass through the upstream body chunk by chunk, releasing the upstream connection when done.
+
+    If the client disconnects, the WSGI server closes this generator which runs the finally block.
+    If a cache_key is provided, the body is also collected and put in the segment cache once it is complete,
+    and the claim on it is released.
+    """
+    cache_buffer = bytearray() if cache_key and segment_cache and resp.status_code == HTTPStatus.OK else None
+    try:
+        for chunk in resp.iter_content(chunk_size=chunk_size):
+            if cache_buffer is not None and segment_cache:
+                cache_buffer += chunk
+                if len(cache_buffer) > segment_cache.max_segment_bytes:
+                    cache_buffer = None  # Too big, just stream it
+            yield chunk
+    except requests.RequestException as e:
+        error_short = type(e).__name__
+        logger.error("/ace/c/ reverse proxy failure mid-stream %s", error_short)  # noqa: TRY400 Naa this should be shorter
+    else:
+        if cache_key and cache_buffer is not None and segment_cache:
+            segment_cache.put(cache_key, bytes(cache_buffer), resp.status_code, cache_headers or [])
+    finally:
+        resp.close()
+        if cache_key and claim and segment_cache:
+            segment_cache.release(cache_key, claim)
 
 
 def start_scraper() -> None:
     """Method to 'configure' this module. Needs to be called under `with app.app_context():` from __init__.py."""
     global ace_scraper  # noqa: PLW0603 Necessary evil as far as I can tell, could move to all objects but eh...
     scraper_cache = Path(current_app.instance_path) / "ace_quality_cache.json"
-    ace_scraper = AceScraper(current_app.aw_conf.scraper, scraper_cache)
+    streams_cache = Path(current_app.instance_path) / "ace_scrape_cache.json"
+    ace_scraper = AceScraper(current_app.aw_conf.scraper, scraper_cache, streams_cache)
+    ace_scraper.start_scrape_thread()  # The first scrape runs in the background, so we can serve straight away
+
+
+def start_reverse_proxy() -> None:
+    """Configure the reverse proxy. Needs to be called under `with app.app_context():` from __init__.py."""
+    global segment_cache, manifest_cache, ace_session, engine_pool  # noqa: PLW0603
+    ace_session = create_ace_session(current_app.aw_conf.app)
+    engine_pool = AceEnginePool(
+        addresses=current_app.aw_conf.app.get_ace_addresses(),
+        session=ace_session,
+        health_check_interval=current_app.aw_conf.app.ace_health_check_interval,
+    )
+    engine_pool.start_health_checks()
+    segment_cache = SegmentCache(
+        max_bytes=current_app.aw_conf.app.segment_cache_max_bytes,
+        ttl=current_app.aw_conf.app.segment_cache_ttl,
+        coalesce_timeout=current_app.aw_conf.app.content_timeout.read,
+    )
+    manifest_cache = ManifestCache(max_ttl=current_app.aw_conf.app.manifest_cache_max_ttl)
+
+
+def start_prober() -> None:
+    """Configure the stream prober, after the scraper and reverse proxy. Needs `with app.app_context():`."""
+    global stream_prober  # noqa: PLW0603
+    if not ace_scraper or not engine_pool:
+        logger.error("Stream prober needs the scraper and reverse proxy to be started first.")
+        return
+
+    stream_prober = AceStreamProber(
+        ace_scraper,
+        engine_pool,
+        current_app.aw_conf.app.prober,
+        current_app.aw_conf.app.manifest_timeout,
+    )
+    stream_prober.start_probe_thread()
 
 
 @bp.route("/")
@@ -69,13 +193,24 @@ def iptv() -> Response | WerkzeugResponse:
         logger.error("Scraper object not initialized.")
         return jsonify({"error": "Scraper not initialized"}, HTTPStatus.INTERNAL_SERVER_ERROR)
 
-    streams = ace_scraper.get_streams_flat()
-    hls_path = current_app.config["SERVER_NAME"] + "/hls/"
-    m3u8 = get_streams_as_iptv(streams, hls_path)
-
-    return Response(
-        m3u8,
-        HTTPStatus.OK,
+    site_name = request.args.get("site", "")
+    title = request.args.get("title", "").strip().casefold()
+    min_quality = request.args.get("min_quality", default=1, type=int)  # Unknown (-1) and failing (0) left out
+
+    def _build_iptv(scraper: AceScraper) -> bytes:
+        streams = [
+            stream
+            for stream in scraper.get_streams_flat()
+            if stream.quality >= min_quality
+            and (not site_name or stream.site_name == site_name)
+            and title in stream.title.casefold()
+        ]
+        return get_streams_as_iptv(streams, current_app.config["SERVER_NAME"] + "/hls/").encode()
+
+    return _get_cached_response(
+        f"iptv?site={site_name}&min_quality={min_quality}&title={title}",
+        _build_iptv,
+        mimetype="audio/mpegurl",
     )
 
 
@@ -90,38 +225,93 @@ def hls_stream(path: str) -> Response | WerkzeugResponse:
         logger.error("Scraper object not initialized.")
         return jsonify({"error": "Scraper not initialized"}, HTTPStatus.INTERNAL_SERVER_ERROR)
 
-    url = f"{current_app.aw_conf.app.ace_address}/ace/manifest.m3u8?content_id={path}"
-
     logger.debug("HLS stream requested for path: %s", path)
 
-    try:
-        resp = requests.get(url, timeout=REVERSE_PROXY_TIMEOUT, stream=True)
-    except requests.RequestException as e:
-        error_short = type(e).__name__
-        logger.error("/hls/ reverse proxy failure %s", error_short)  # noqa: TRY400 Naa this should be shorter
-        ace_scraper.increment_quality(path, -5)
-        return jsonify({"error": "Failed to fetch HLS stream"}, HTTPStatus.INTERNAL_SERVER_ERROR)
+    if manifest_cache:
+        manifest = manifest_cache.get_or_fetch(path, lambda: _fetch_manifest(path))
+    else:
+        manifest = _fetch_manifest(path)
 
-    headers = [
-        (name, value)
-        for (name, value) in resp.raw.headers.items()
-        if name.lower() not in REVERSE_PROXY_EXCLUDED_HEADERS
-    ]
+    if manifest.error:
+        error_body = {"error": manifest.error}
+        if manifest.content:
+            error_body["m3u8"] = manifest.content
+        return jsonify(error_body, manifest.status_code)
+
+    return Response(manifest.content, manifest.status_code, manifest.headers)
+
+
+def _fetch_manifest(content_id: str) -> CachedManifest:
+    """Fetch a manifest from Ace, rewrite it to point at us, and update the quality of the stream."""
+    if not engine_pool:
+        return CachedManifest("", HTTPStatus.INTERNAL_SERVER_ERROR, [], error="Reverse proxy not initialized")
+
+    start = time.perf_counter()
+    result = _get_from_engines(
+        engine_pool.get_engines(content_id),
+        f"/ace/manifest.m3u8?content_id={content_id}",
+        current_app.aw_conf.app.manifest_timeout.as_tuple(),
+    )
+    latency = time.perf_counter() - start
+    if not result:
+        logger.error("/hls/ reverse proxy failure, no engine answered for %s", content_id)
+        return manifest_fetch_failed(content_id)
+
+    resp, engine_address = result
+    return process_manifest(
+        content_id=content_id,
+        status_code=resp.status_code,
+        headers=_get_reverse_proxy_headers(resp),
+        content=resp.content,
+        server_name=current_app.config["SERVER_NAME"],
+        engine_address=engine_address,
+        latency=latency,
+    )
 
-    content_str = resp.content.decode("utf-8", errors="replace")
+
+def manifest_fetch_failed(content_id: str) -> CachedManifest:
+    """Record a failure to reach Ace for a manifest."""
+    if ace_scraper:
+        ace_scraper.record_failure(content_id)
+    return CachedManifest("", HTTPStatus.INTERNAL_SERVER_ERROR, [], error="Failed to fetch HLS stream")
+
+
+def process_manifest(  # noqa: PLR0913 Shared between the WSGI and ASGI proxies, so it can't use the response object
+    content_id: str,
+    *,
+    status_code: int,
+    headers: list[tuple[str, str]],
+    content: bytes,
+    server_name: str,
+    engine_address: str = "",
+    latency: float = 0.0,
+) -> CachedManifest:
+    """Validate a manifest from Ace, rewrite it to point at us, and update the quality of the stream.
+
+    The latency is how many seconds Ace took to answer, it counts against the quality of slow streams.
+    """
+    content_str = content.decode("utf-8", errors="replace")
 
     if "#EXTM3U" not in content_str:
-        logger.error("Invalid HLS stream received for path: %s", path)
-        ace_scraper.increment_quality(path, -5)
-        return jsonify({"error": "Invalid HLS stream", "m3u8": content_str}, HTTPStatus.BAD_REQUEST)
+        logger.error("Invalid HLS stream received for path: %s", content_id)
+        if ace_scraper:
+            ace_scraper.record_failure(content_id)
+        return CachedManifest(content_str, HTTPStatus.BAD_REQUEST, [], error="Invalid HLS stream")
+
+    # The segments of this manifest only exist on the engine that served it
+    if engine_pool and engine_address:
+        engine_pool.record_sessions(content_str, engine_address, content_id)
 
     # Replace the base URL in the stream with the new address
     # The docker container for acestream will always be localhost:6878
-    content_str = content_str.replace("http://localhost:6878", current_app.config["SERVER_NAME"])
+    content_str = content_str.replace("http://localhost:6878", server_name)
+    if engine_address:
+        content_str = content_str.replace(engine_address, server_name)
 
-    ace_scraper.increment_quality(path, 1)
+    if ace_scraper:
+        ace_scraper.record_success(content_id, latency)
 
-    return Response(content_str, resp.status_code, headers)
+    return CachedManifest(content_str, status_code, headers)
 
 
 @bp.route("/ace/c/<path:path>")
@@ -131,23 +321,122 @@ def ace_content(path: str) -> Response | WerkzeugResponse:
     if auth_failure:
         return auth_failure
 
-    url = f"{current_app.aw_conf.app.ace_address}/ace/c/{path}"
+    if not engine_pool:
+        logger.error("Reverse proxy not initialized.")
+        return jsonify({"error": "Reverse proxy not initialized"}, HTTPStatus.INTERNAL_SERVER_ERROR)
 
     logger.debug("Ace content requested for path: %s", path)
 
-    try:
-        resp = requests.get(url, timeout=REVERSE_PROXY_TIMEOUT, stream=True)
-    except requests.RequestException as e:
-        error_short = type(e).__name__
-        logger.error("/ace/c/ reverse proxy failure %s", error_short)  # noqa: TRY400 Naa this should be shorter
+    cache_key = None
+    claim = None
+    if segment_cache and segment_cache.enabled:
+        cached_segment, claim = segment_cache.get_or_claim(path)
+        if cached_segment:
+            return Response(cached_segment.content, cached_segment.status_code, cached_segment.headers)
+        if claim:
+            cache_key = path
+
+    start = time.perf_counter()
+    result = _get_from_engines(
+        engine_pool.get_engines_for_content(path),
+        f"/ace/c/{path}",
+        current_app.aw_conf.app.content_timeout.as_tuple(),
+        stream=True,
+    )
+    if not result:
+        logger.error("/ace/c/ reverse proxy failure, no engine answered for %s", path)
+        if cache_key and claim and segment_cache:
+            segment_cache.release(cache_key, claim)
         return jsonify({"error": "Failed to fetch HLS stream"}, HTTPStatus.INTERNAL_SERVER_ERROR)
-    headers = [
-        (name, value)
-        for (name, value) in resp.raw.headers.items()
-        if name.lower() not in REVERSE_PROXY_EXCLUDED_HEADERS
-    ]
 
-    return Response(resp.content, resp.status_code, headers)
+    resp, _ = result
+    record_segment_latency(path, time.perf_counter() - start)
+
+    headers = _get_reverse_proxy_headers(resp)
+    streamed_headers = list(headers)
+
+    # Only forward the length if the body won't be decoded by requests, otherwise it would be wrong
+    content_length = resp.headers.get("content-length")
+    if content_length and not resp.headers.get("content-encoding"):
+        streamed_headers.append(("Content-Length", content_length))
+
+    response = Response(
+        _iter_upstream_content(
+            resp,
+            current_app.aw_conf.app.ace_content_chunk_size,
+            cache_key=cache_key,
+            cache_headers=headers,
+            claim=claim,
+        ),
+        resp.status_code,
+        streamed_headers,
+        direct_passthrough=True,
+    )
+    response.call_on_close(resp.close)
+    if cache_key and claim and segment_cache:  # The body isn't iterated for HEAD requests, or if the client leaves
+        response.call_on_close(functools.partial(segment_cache.release, cache_key, claim))
+    return response
+
+
+def record_segment_latency(path: str, latency: float) -> None:
+    """Record how long a segment took to start arriving, against the stream that its playback session is for."""
+    if not ace_scraper or not engine_pool:
+        return
+
+    content_id = engine_pool.get_content_id(path)
+    if content_id:
+        ace_scraper.record_segment_latency(content_id, latency)
+
+
+def _get_cached_response(
+    key: str,
+    build: Callable[[AceScraper], bytes],
+    mimetype: str,
+) -> Response | WerkzeugResponse:
+    """Get a response, only built again once the streams or their quality have changed.
+
+    The response has a strong ETag, so clients that send If-None-Match get a 304 without a body. Clients that
+    accept gzip get the body that was compressed when it was built.
+    """
+    if not ace_scraper:
+        return jsonify({"error": "Scraper not initialized"}, HTTPStatus.INTERNAL_SERVER_ERROR)
+
+    version = ace_scraper.get_streams_version()  # Before building, so a change during the build isn't missed
+    with response_cache_lock:
+        cached = response_cache.get(key)
+
+    if not cached or cached[0] != version:
+        body = build(ace_scraper)
+        gzip_body = gzip.compress(body, mtime=0) if len(body) >= RESPONSE_GZIP_MIN_BYTES else b""
+        cached = (version, body, gzip_body, hashlib.blake2b(body, digest_size=16).hexdigest())
+
+    with response_cache_lock:
+        response_cache[key] = cached
+        response_cache.move_to_end(key)
+        while len(response_cache) > RESPONSE_CACHE_MAX_ENTRIES:
+            response_cache.popitem(last=False)
+
+    _, body, gzip_body, etag = cached
+    if gzip_body and request.accept_encodings["gzip"]:  # Quality of gzip, 0 if not accepted
+        response = Response(gzip_body, status=HTTPStatus.OK, mimetype=mimetype)
+        response.content_encoding = "gzip"
+        etag = f"{etag}-gzip"  # A different representation needs a different strong ETag
+    else:
+        response = Response(body, status=HTTPStatus.OK, mimetype=mimetype)
+
+    response.vary.add("Accept-Encoding")
+    response.set_etag(etag)
+    response.cache_control.no_cache = True  # Clients revalidate with If-None-Match every time
+    return response.make_conditional(request)
+
+
+def _get_cached_api_response(name: str, build: Callable[[AceScraper], object]) -> Response | WerkzeugResponse:
+    """Get a JSON response, only serialized again once the streams or their quality have changed."""
+    return _get_cached_response(
+        name,
+        lambda scraper: current_app.json.dumps(build(scraper)).encode(),
+        mimetype="application/json",
+    )
 
 
 @bp.route("/api/stream/<path:ace_id>")
@@ -179,12 +468,10 @@ def api_streams_flat() -> Response | WerkzeugResponse:
         logger.error("Scraper object not initialized.")
         return jsonify({"error": "Scraper not initialized"}, HTTPStatus.INTERNAL_SERVER_ERROR)
 
-    streams = ace_scraper.get_streams_flat()
-    streams_serialized = [stream.model_dump() for stream in streams]
-
-    response = jsonify(streams_serialized)
-    response.status_code = HTTPStatus.OK
-    return response
+    return _get_cached_api_response(
+        "streams_flat",
+        lambda scraper: [stream.model_dump() for stream in scraper.get_streams_flat()],
+    )
 
 
 @bp.route("/api/streams/by_site")
@@ -198,12 +485,10 @@ def api_streams() -> Response | WerkzeugResponse:
         logger.error("Scraper object not initialized.")
         return jsonify({"error": "Scraper not initialized"}, HTTPStatus.INTERNAL_SERVER_ERROR)
 
-    streams = ace_scraper.get_streams()
-    streams_serialized = [stream.model_dump() for stream in streams]
-
-    response = jsonify(streams_serialized)
-    response.status_code = HTTPStatus.OK
-    return response
+    return _get_cached_api_response(
+        "streams_by_site",
+        lambda scraper: [stream.model_dump() for stream in scraper.get_streams()],
+    )
 
 
 @bp.route("/api/streams/health")
@@ -223,3 +508,42 @@ def api_streams_health() -> Response | WerkzeugResponse:
     response.status_code = HTTPStatus.OK
 
     return response
+
+
+@bp.route("/api/scraper/status")
+def api_scraper_status() -> Response | WerkzeugResponse:
+    """API endpoint to get the status of the scraper, whether a scrape is in progress."""
+    auth_failure = assumed_auth_failure()
+    if auth_failure:
+        return auth_failure
+
+    if not ace_scraper:
+        logger.error("Scraper object not initialized.")
+        return jsonify({"error": "Scraper not initialized"}, HTTPStatus.INTERNAL_SERVER_ERROR)
+
+    response = jsonify(ace_scraper.get_status().model_dump(mode="json"))
+    response.status_code = HTTPStatus.OK
+    return response
+
+
+@bp.route("/api/proxy/stats")
+def api_proxy_stats() -> Response | WerkzeugResponse:
+    """API endpoint to get the reverse proxy cache counters."""
+    auth_failure = assumed_auth_failure()
+    if auth_failure:
+        return auth_failure
+
+    if not segment_cache or not manifest_cache or not engine_pool:
+        logger.error("Reverse proxy not initialized.")
+        return jsonify({"error": "Reverse proxy not initialized"}, HTTPStatus.INTERNAL_SERVER_ERROR)
+
+    response = jsonify(
+        {
+            "segment_cache": segment_cache.get_stats(),
+            "manifest_cache": manifest_cache.get_stats(),
+            "engines": engine_pool.get_stats(),
+            "prober": stream_prober.get_stats() if stream_prober else {},
+        }
+    )
+    response.status_code = HTTPStatus.OK
+    return response
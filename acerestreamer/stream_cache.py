@@ -0,0 +1,277 @@
+"""Caches for the reverse proxy, so concurrent viewers of a stream only hit the Ace engine once."""
+
+import re
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import Callable
+from typing import NamedTuple
+
+from .logger import get_logger
+
+logger = get_logger(__name__)
+
+TARGET_DURATION_REGEX = re.compile(r"^#EXT-X-TARGETDURATION:\s*(\d+(?:\.\d+)?)", re.MULTILINE)
+MANIFEST_DEFAULT_TTL = 1.0  # Seconds, used for errors and manifests without a target duration
+
+
+class CachedSegment(NamedTuple):
+    """A cached /ace/c/ response."""
+
+    content: bytes
+    status_code: int
+    headers: list[tuple[str, str]]
+    expires: float
+
+
+class CachedManifest(NamedTuple):
+    """A rewritten /hls/ manifest, or the error from fetching it."""
+
+    content: str
+    status_code: int
+    headers: list[tuple[str, str]]
+    error: str = ""  # Empty if the manifest is valid
+
+
+class SegmentCache:
+    """In-process LRU cache for /ace/c/ segments, bounded by bytes, with request coalescing.
+
+    The first request for a segment that isn't cached becomes the 'leader' and fetches it from the engine,
+    any other request for the same segment waits for the leader to finish and is served from the cache.
+    """
+
+    def __init__(self, max_bytes: int, ttl: float, coalesce_timeout: float) -> None:
+        """Init SegmentCache, a max_bytes of 0 disables caching."""
+        self.max_bytes = max_bytes
+        self.max_segment_bytes = max_bytes // 4  # Don't let a single segment flush most of the cache
+        self.ttl = ttl
+        self.coalesce_timeout = coalesce_timeout
+
+        self._segments: OrderedDict[str, CachedSegment] = OrderedDict()
+        self._in_flight: dict[str, threading.Event] = {}
+        self._lock = threading.Lock()
+
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    @property
+    def enabled(self) -> bool:
+        """Whether the cache is enabled."""
+        return self.max_bytes > 0
+
+    def get(self, key: str) -> CachedSegment | None:
+        """Get a segment from the cache without waiting on, or claiming, an in-flight fetch."""
+        with self._lock:
+            segment = self._get_locked(key)
+            if segment:
+                self.hits += 1
+            else:
+                self.misses += 1
+            return segment
+
+    def get_or_claim(self, key: str) -> tuple[CachedSegment | None, threading.Event | None]:
+        """Get a segment from the cache, or claim the right to fetch it.
+
+        Returns the cached segment (if any) and the claim if the caller is now responsible for fetching the segment.
+        A caller that claims a segment must call release() with the claim once it is done, put() before that if
+        it succeeded.
+        """
+        with self._lock:
+            segment = self._get_locked(key)
+            if segment:
+                self.hits += 1
+                return segment, None
+
+            event = self._in_flight.get(key)
+            if not event:
+                self.misses += 1
+                claim = self._in_flight[key] = threading.Event()
+                return None, claim
+
+            self.coalesced += 1
+
+        # Another request is fetching this segment, wait for it outside of the lock
+        event.wait(self.coalesce_timeout)
+
+        with self._lock:
+            segment = self._get_locked(key)
+            if not segment:
+                self.misses += 1
+            return segment, None
+
+    def put(self, key: str, content: bytes, status_code: int, headers: list[tuple[str, str]]) -> None:
+        """Add a segment to the cache, evicting the least recently used segments if needed."""
+        if len(content) > self.max_segment_bytes:
+            logger.debug("Segment %s too large to cache: %d bytes", key, len(content))
+            return
+
+        with self._lock:
+            self._remove_locked(key)
+            self._segments[key] = CachedSegment(
+                content=content,
+                status_code=status_code,
+                headers=headers,
+                expires=time.monotonic() + self.ttl,
+            )
+            self.current_bytes += len(content)
+
+            while self.current_bytes > self.max_bytes:
+                evicted_key = next(iter(self._segments))
+                self._remove_locked(evicted_key)
+                self.evictions += 1
+
+    def release(self, key: str, claim: threading.Event) -> None:
+        """Release a claim on a segment, waking any requests waiting on it.
+
+        Releasing a claim more than once is fine, a newer claim on the same segment is left alone.
+        """
+        with self._lock:
+            if self._in_flight.get(key) is claim:
+                del self._in_flight[key]
+
+        claim.set()
+
+    def get_stats(self) -> dict[str, int]:
+        """Get the cache counters, for sizing the cache."""
+        with self._lock:
+            return {
+                "max_bytes": self.max_bytes,
+                "current_bytes": self.current_bytes,
+                "segments": len(self._segments),
+                "in_flight": len(self._in_flight),
+                "hits": self.hits,
+                "misses": self.misses,
+                "coalesced": self.coalesced,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
+
+    def _get_locked(self, key: str) -> CachedSegment | None:
+        """Get a segment, must hold the lock."""
+        segment = self._segments.get(key)
+        if not segment:
+            return None
+
+        if segment.expires < time.monotonic():
+            self._remove_locked(key)
+            self.expirations += 1
+            return None
+
+        self._segments.move_to_end(key)
+        return segment
+
+    def _remove_locked(self, key: str) -> None:
+        """Remove a segment, must hold the lock."""
+        segment = self._segments.pop(key, None)
+        if segment:
+            self.current_bytes -= len(segment.content)
+
+
+class ManifestCache:
+    """Short lived cache for /hls/ manifests, with single-flight fetching per content_id.
+
+    A manifest is cached for half of its target segment duration (capped at max_ttl), any number of players
+    polling the same content_id in that window cost one upstream request.
+    """
+
+    def __init__(self, max_ttl: float) -> None:
+        """Init ManifestCache, a max_ttl of 0 disables caching."""
+        self.max_ttl = max_ttl
+
+        self._manifests: dict[str, tuple[float, CachedManifest]] = {}
+        self._fetch_locks: dict[str, threading.Lock] = {}  # Only for content_ids with getters in flight
+        self._fetch_waiters: dict[str, int] = {}
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def get_or_fetch(self, content_id: str, fetch: Callable[[], CachedManifest]) -> CachedManifest:
+        """Get a manifest from the cache, or fetch it. Only one fetch per content_id runs at a time."""
+        if self.max_ttl <= 0:
+            return fetch()
+
+        manifest = self.get(content_id)
+        if manifest:
+            return manifest
+
+        with self._lock:
+            fetch_lock = self._fetch_locks.setdefault(content_id, threading.Lock())
+            self._fetch_waiters[content_id] = self._fetch_waiters.get(content_id, 0) + 1
+
+        try:
+            with fetch_lock:
+                # If another request fetched the manifest while we were waiting, use that
+                with self._lock:
+                    manifest = self._get_locked(content_id)
+                    if manifest:
+                        self.coalesced += 1
+                        return manifest
+
+                manifest = fetch()
+                self.put(content_id, manifest)
+        finally:
+            with self._lock:  # The last getter out removes the fetch lock
+                self._fetch_waiters[content_id] -= 1
+                if not self._fetch_waiters[content_id]:
+                    del self._fetch_waiters[content_id]
+                    del self._fetch_locks[content_id]
+
+        return manifest
+
+    def get(self, content_id: str) -> CachedManifest | None:
+        """Get a manifest from the cache if it hasn't expired."""
+        with self._lock:
+            manifest = self._get_locked(content_id)
+            if manifest:
+                self.hits += 1
+            else:
+                self.misses += 1
+            return manifest
+
+    def put(self, content_id: str, manifest: CachedManifest) -> None:
+        """Add a manifest to the cache, for half of its target duration."""
+        if self.max_ttl <= 0:
+            return
+
+        with self._lock:
+            self._sweep_locked()
+            self._manifests[content_id] = (time.monotonic() + self._get_ttl(manifest), manifest)
+
+    def get_stats(self) -> dict[str, int]:
+        """Get the cache counters."""
+        with self._lock:
+            return {
+                "manifests": len(self._manifests),
+                "hits": self.hits,
+                "misses": self.misses,
+                "coalesced": self.coalesced,
+            }
+
+    def _get_ttl(self, manifest: CachedManifest) -> float:
+        """Get the TTL for a manifest, half of the target duration."""
+        ttl = MANIFEST_DEFAULT_TTL
+        if not manifest.error:
+            match = TARGET_DURATION_REGEX.search(manifest.content)
+            if match:
+                ttl = float(match.group(1)) / 2
+
+        return min(ttl, self.max_ttl)
+
+    def _get_locked(self, content_id: str) -> CachedManifest | None:
+        """Get a manifest if it hasn't expired, must hold the lock."""
+        entry = self._manifests.get(content_id)
+        if not entry or entry[0] < time.monotonic():
+            return None
+        return entry[1]
+
+    def _sweep_locked(self) -> None:
+        """Remove expired manifests, must hold the lock."""
+        now = time.monotonic()
+        for content_id in [content_id for content_id, (expires, _) in self._manifests.items() if expires < now]:
+            del self._manifests[content_id]
@@ -0,0 +1,163 @@
+"""AceStreamProber, tries streams in the background so their quality is known before anyone watches them."""
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+import requests
+
+from .ace_engine import AceEnginePool
+from .config import ProberConf, TimeoutConf
+from .logger import get_logger
+from .scraper import AceScraper
+
+logger = get_logger(__name__)
+
+
+class AceStreamProber:
+    """Probes the streams that have never been tried, or not for a while, by fetching their manifest from the engine.
+
+    Each run probes at most batch_size streams, starting one every delay seconds with at most concurrency running
+    at once, so viewers still get the engine. A probe is a manifest fetch like a player's, its result and latency
+    are recorded the same way. The playback session the probe starts is stopped straight after, so at most
+    concurrency probe sessions use the engine. Streams aren't blamed when the engine can't be reached.
+    """
+
+    def __init__(
+        self,
+        ace_scraper: AceScraper,
+        engine_pool: AceEnginePool,
+        prober_conf: ProberConf,
+        timeout: TimeoutConf,
+    ) -> None:
+        """Init AceStreamProber, call start_probe_thread() to probe every interval."""
+        self.ace_scraper = ace_scraper
+        self.engine_pool = engine_pool
+        self.interval = prober_conf.interval
+        self.batch_size = prober_conf.batch_size
+        self.concurrency = prober_conf.concurrency
+        self.delay = prober_conf.delay
+        self.stale_after = prober_conf.stale_after
+        self.timeout = timeout.as_tuple()
+
+        self._stats = {"runs": 0, "probes": 0, "successes": 0, "failures": 0, "engine_errors": 0}
+        self._lock = threading.Lock()  # For the stats
+        self._stop_event = threading.Event()
+        self._probe_thread: threading.Thread | None = None
+
+    def run_probes(self) -> None:
+        """Probe the streams that most need it, returns once the probes are done."""
+        ace_ids = self.ace_scraper.get_ace_ids_to_probe(self.stale_after, self.batch_size)
+        self._count("runs")
+        if not ace_ids:
+            return
+
+        logger.info("Probing %d streams", len(ace_ids))
+        with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="ace_prober") as executor:
+            for n, ace_id in enumerate(ace_ids):
+                if n and self._stop_event.wait(self.delay):  # Rate limit, and stop promptly
+                    break
+                executor.submit(self.probe, ace_id)
+
+    def probe(self, ace_id: str) -> None:
+        """Fetch a stream's manifest from the engine it belongs to, and record the result."""
+        self._count("probes")
+        for engine_address in self.engine_pool.get_engines(ace_id):
+            start = time.perf_counter()
+            try:
+                success = self._fetch_manifest(engine_address, ace_id)
+            except requests.ReadTimeout:  # The engine is there, the stream didn't start in time
+                logger.debug("Probe of %s timed out", ace_id)
+                self._record(ace_id, success=False)
+                return
+            except requests.RequestException as e:
+                error_short = type(e).__name__
+                logger.error("Probe failure from %s, %s", engine_address, error_short)  # noqa: TRY400 Naa this should be shorter
+                self.engine_pool.mark_failure(engine_address)
+                continue
+
+            latency = time.perf_counter() - start
+            self.engine_pool.mark_success(engine_address)
+            self._record(ace_id, success=success, latency=latency)
+            return
+
+        self._count("engine_errors")
+
+    def _fetch_manifest(self, engine_address: str, ace_id: str) -> bool:
+        """Start a playback session for a stream and fetch its manifest, returns whether it is valid.
+
+        The session is stopped once the manifest is fetched, the engine would keep it downloading until its
+        idle timeout otherwise.
+        """
+        resp = self.engine_pool.session.get(
+            f"{engine_address}/ace/manifest.m3u8?content_id={ace_id}&format=json",
+            timeout=self.timeout,
+        )
+        try:
+            playback = resp.json().get("response") or {}
+        except (ValueError, AttributeError):
+            return False
+        if not resp.ok or not playback.get("playback_url"):
+            return False
+
+        try:
+            resp = self.engine_pool.session.get(
+                _on_engine(engine_address, playback["playback_url"]),
+                timeout=self.timeout,
+            )
+            return resp.ok and "#EXTM3U" in resp.text
+        finally:
+            self._stop_session(engine_address, playback.get("command_url", ""))
+
+    def _stop_session(self, engine_address: str, command_url: str) -> None:
+        """Stop a playback session, a session that can't be stopped times out on the engine eventually."""
+        if not command_url:
+            return
+
+        try:
+            self.engine_pool.session.get(f"{_on_engine(engine_address, command_url)}?method=stop", timeout=self.timeout)
+        except requests.RequestException as e:
+            error_short = type(e).__name__
+            logger.warning("Couldn't stop probe session on %s, %s", engine_address, error_short)
+
+    def _record(self, ace_id: str, *, success: bool, latency: float = 0.0) -> None:
+        if success:
+            self.ace_scraper.record_success(ace_id, latency)
+            self._count("successes")
+        else:
+            self.ace_scraper.record_failure(ace_id)
+            self._count("failures")
+
+    def _count(self, stat: str) -> None:
+        with self._lock:
+            self._stats[stat] += 1
+
+    def get_stats(self) -> dict[str, int]:
+        """Get the probe counters."""
+        with self._lock:
+            return dict(self._stats)
+
+    def start_probe_thread(self) -> None:
+        """Start the background thread that probes every interval."""
+        if self._probe_thread or self.interval <= 0:
+            return
+
+        self._probe_thread = threading.Thread(target=self._probe_loop, name="ace_prober", daemon=True)
+        self._probe_thread.start()
+
+    def stop_probe_thread(self) -> None:
+        """Stop the background probe thread, probes that have started are finished."""
+        self._stop_event.set()
+
+    def _probe_loop(self) -> None:
+        while not self._stop_event.wait(self.interval):
+            try:
+                self.run_probes()
+            except Exception:
+                logger.exception("Error probing streams, will try again next interval")
+
+
+def _on_engine(engine_address: str, url: str) -> str:
+    """Point a URL from the engine at the address we reach it on, the engine only knows its own address."""
+    return f"{engine_address}{urlparse(url).path}"
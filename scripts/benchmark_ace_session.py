@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""Benchmark bare requests.get against the pooled keep-alive engine session, using a local stub engine.
+
+Usage: uv run python scripts/benchmark_ace_session.py [requests] [threads]
+"""
+
+import statistics
+import sys
+import threading
+import time
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+from acerestreamer.ace_engine import create_ace_session
+from acerestreamer.config import AppConf
+
+SEGMENT = b"\0" * (512 * 1024)
+MANIFEST = b"#EXTM3U\n#EXT-X-TARGETDURATION:4\n#EXTINF:4.0,\nhttp://localhost:6878/ace/c/bench/1.ts\n"
+
+
+class _StubEngineHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # Keep-alive
+    disable_nagle_algorithm = True  # Headers and body are separate writes
+
+    def do_GET(self) -> None:
+        body = MANIFEST if self.path.startswith("/ace/manifest.m3u8") else SEGMENT
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args: object) -> None:
+        pass
+
+
+def _run(name: str, get: Callable[[str], requests.Response], url: str, n_requests: int, n_threads: int) -> None:
+    latencies: list[float] = []
+
+    def _one(_: int) -> None:
+        start = time.perf_counter()
+        resp = get(url)
+        resp.raise_for_status()
+        latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        list(executor.map(_one, range(n_requests)))
+    total = time.perf_counter() - start
+
+    latencies.sort()
+    print(
+        f"{name:<28} total {total:7.3f}s"
+        f"  mean {statistics.mean(latencies) * 1000:7.3f}ms"
+        f"  p50 {latencies[len(latencies) // 2] * 1000:7.3f}ms"
+        f"  p95 {latencies[int(len(latencies) * 0.95)] * 1000:7.3f}ms"
+    )
+
+
+def main() -> None:
+    """Run the benchmark."""
+    n_requests = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    n_threads = int(sys.argv[2]) if len(sys.argv) > 2 else 8  # noqa: PLR2004
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _StubEngineHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    address = f"http://127.0.0.1:{server.server_address[1]}"
+
+    app_conf = AppConf(ace_address=address, ace_pool_size=n_threads)
+    session = create_ace_session(app_conf)
+    timeout = app_conf.content_timeout.as_tuple()
+
+    print(f"{n_requests} requests, {n_threads} threads, stub engine at {address}")
+    for path in ("/ace/manifest.m3u8?content_id=bench", "/ace/c/bench/1.ts"):
+        url = address + path
+        print(path)
+        _run("  requests.get", lambda url: requests.get(url, timeout=timeout), url, n_requests, n_threads)
+        _run("  pooled session", lambda url: session.get(url, timeout=timeout), url, n_requests, n_threads)
+
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
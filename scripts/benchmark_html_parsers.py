@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+"""Benchmark the HTML parser backends and the ace link prefilter against the test sites in tests/test_sites.
+
+Usage: uv run --extra lxml python scripts/benchmark_html_parsers.py [repeats]
+"""
+
+import importlib.util
+import sys
+import time
+from collections.abc import Callable
+from functools import partial
+from pathlib import Path
+
+from acerestreamer.config import ScrapeSiteHTML, ScrapeSiteIPTV, TitleFilter
+from acerestreamer.scraper_html import parse_streams_html
+from acerestreamer.scraper_iptv import parse_iptv_lines
+
+TEST_SITES_LOCATION = Path(__file__).parent.parent / "tests" / "test_sites"
+
+# The same as README_dev.md
+HTML_SITES = [
+    ScrapeSiteHTML(
+        name="site1",
+        url="http://localhost:8999/site1/index.html",
+        target_class="column_title",
+        check_sibling=True,
+    ),
+    ScrapeSiteHTML(
+        name="site2",
+        url="http://localhost:8999/site2/index.html",
+        target_class="streamtext",
+        check_sibling=True,
+        title_filter=TitleFilter(regex_postprocessing="Server \\d+: "),
+    ),
+    ScrapeSiteHTML(name="site3", url="http://localhost:8999/site3/index.html"),
+]
+IPTV_SITE = ScrapeSiteIPTV(name="site4", url="http://localhost:8999/site4/list.m3u8")
+
+
+def _time_ms(repeats: int, func: Callable[[], object]) -> float:
+    start = time.perf_counter()
+    for _ in range(repeats):
+        func()
+    return (time.perf_counter() - start) / repeats * 1000
+
+
+def main() -> None:
+    """Run the benchmark."""
+    repeats = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+
+    html_parsers = ["html.parser"]
+    if importlib.util.find_spec("lxml"):
+        html_parsers.append("lxml")
+    else:
+        print("lxml isn't installed, only benchmarking html.parser")
+
+    print(f"{repeats} repeats, mean ms per parse")
+    for site in HTML_SITES:
+        html = (TEST_SITES_LOCATION / site.name / "index.html").read_text()
+        for html_parser in html_parsers:
+            for prefilter_links in (False, True):
+                parse_site = site.model_copy(update={"html_parser": html_parser, "prefilter_links": prefilter_links})
+                mean_ms = _time_ms(repeats, partial(parse_streams_html, parse_site, html))
+                prefilter = "prefilter" if prefilter_links else "find_all"
+                print(f"{site.name:<6} {html_parser:<12} {prefilter:<10} {mean_ms:7.3f}ms")
+
+    lines = (TEST_SITES_LOCATION / IPTV_SITE.name / "list.m3u8").read_text().splitlines()
+    mean_ms = _time_ms(repeats, partial(parse_iptv_lines, IPTV_SITE, lines))
+    print(f"{IPTV_SITE.name:<6} {'m3u8':<12} {'':<10} {mean_ms:7.3f}ms")
+
+
+if __name__ == "__main__":
+    main()
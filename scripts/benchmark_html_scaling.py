@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+"""Benchmark how the HTML scrape time scales with the number of ace links on a page, using synthetic pages.
+
+Usage: uv run python scripts/benchmark_html_scaling.py [html_parser]
+"""
+
+import sys
+import time
+
+from acerestreamer.config import ScrapeSiteHTML
+from acerestreamer.scraper_html import get_html_parser, parse_streams_html
+
+LINK_COUNTS = [1000, 2500, 5000, 10000, 20000]
+
+
+def _make_page(n_links: int) -> str:
+    """Make a page with a row per link, every link is listed twice like sites that have a 'popular' section."""
+    rows = "".join(
+        f'<div class="row"><span class="title">Stream {i}</span>'
+        f'<div><a href="acestream://{i:040x}">Play</a> <a href="/info/{i}">Info</a></div></div>'
+        for i in range(n_links)
+    )
+    popular = "".join(f'<li><a href="acestream://{i:040x}">Play</a></li>' for i in range(0, n_links, 10))
+    return f'<html><body><div class="title">Streams</div><ul>{popular}</ul><div class="rows">{rows}</div></body></html>'
+
+
+def main() -> None:
+    """Run the benchmark."""
+    html_parser = get_html_parser(sys.argv[1] if len(sys.argv) > 1 else "html.parser")
+    site = ScrapeSiteHTML(
+        name="Synthetic",
+        url="http://localhost/synthetic.html",
+        target_class="title",
+        check_sibling=True,
+        html_parser=html_parser,
+    )
+
+    print(f"html_parser {html_parser}")
+    for n_links in LINK_COUNTS:
+        html = _make_page(n_links)
+        start = time.perf_counter()
+        streams = parse_streams_html(site, html)
+        total = time.perf_counter() - start
+        print(
+            f"{n_links:>6} links  {len(streams):>6} streams  total {total:7.3f}s"
+            f"  per link {total / n_links * 1_000_000:7.1f}us"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -3,15 +3,33 @@
 Fixtures defined in a conftest.py can be used by any test in that package without needing to import them.
 """
 
+import json
 import shutil
+import threading
+import time
+from functools import partial
+from http.server import BaseHTTPRequestHandler, SimpleHTTPRequestHandler, ThreadingHTTPServer
 from pathlib import Path
+from urllib.parse import parse_qs, urlparse
 
 import pytest
 
 from acerestreamer import create_app
-from acerestreamer.config import load_config
+from acerestreamer.config import AceScrapeConf, ScrapeSiteHTML, ScrapeSiteIPTV, TitleFilter, load_config
 
 TEST_CONFIGS_LOCATION = Path.cwd() / "tests" / "configs"
+TEST_SITES_LOCATION = Path.cwd() / "tests" / "test_sites"
+
+STUB_SEGMENT_CONTENT = bytes(range(256)) * 1024  # 256 KiB
+STUB_MANIFEST = """#EXTM3U
+#EXT-X-VERSION:3
+#EXT-X-TARGETDURATION:4
+#EXT-X-MEDIA-SEQUENCE:1
+#EXTINF:4.000000,
+http://localhost:6878/ace/c/stubsession/1.ts
+#EXTINF:4.000000,
+http://localhost:6878/ace/c/stubsession/2.ts
+"""
 
 
 def pytest_configure():
@@ -56,3 +74,142 @@ def place_test_config():
         shutil.copyfile(filepath, config_path)
 
     return _place_test_config
+
+
+class StubAceEngine:
+    """A tiny stand in for the AceStream engine, serves a manifest and segments."""
+
+    def __init__(self) -> None:
+        """Start the stub engine on a random port."""
+        self.requests: list[str] = []
+        self.fail_content_ids: set[str] = set()
+        self.manifest_delay = 0.0  # Seconds, like an engine starting a stream
+        self.max_concurrent_manifests = 0
+        self.stopped_sessions: list[str] = []  # Playback sessions stopped with command_url?method=stop
+        self._concurrent_manifests = 0
+        self._lock = threading.Lock()
+
+        stub = self
+
+        class _Handler(BaseHTTPRequestHandler):
+            def do_GET(self) -> None:
+                stub.requests.append(self.path)
+                parsed = urlparse(self.path)
+                query = parse_qs(parsed.query)
+                if parsed.path == "/ace/manifest.m3u8" and query.get("format") == ["json"]:
+                    self._send_playback_session(query.get("content_id", [""])[0])
+                elif parsed.path.startswith("/ace/cmd/"):
+                    stub.stopped_sessions.append(parsed.path.split("/")[-1])
+                    self._send(json.dumps({"response": "ok", "error": None}).encode(), "application/json")
+                elif parsed.path == "/ace/manifest.m3u8" or parsed.path.startswith("/ace/m/"):
+                    with stub._lock:
+                        stub._concurrent_manifests += 1
+                        stub.max_concurrent_manifests = max(stub.max_concurrent_manifests, stub._concurrent_manifests)
+                    time.sleep(stub.manifest_delay)
+                    with stub._lock:
+                        stub._concurrent_manifests -= 1
+
+                    content_id = query.get("content_id", [""])[0] or parsed.path.split("/")[-1].removesuffix(".m3u8")
+                    body = b"not a manifest" if content_id in stub.fail_content_ids else STUB_MANIFEST.encode()
+                    self._send(body, "application/vnd.apple.mpegurl")
+                elif parsed.path.startswith("/ace/c/"):
+                    self._send(STUB_SEGMENT_CONTENT, "video/mp2t")
+                else:
+                    self.send_error(404)
+
+            def _send_playback_session(self, content_id: str) -> None:
+                """Like format=json, the URLs are on the engine's own address, not the one the stub is reached on."""
+                response = {
+                    "playback_url": f"http://127.0.0.1:6878/ace/m/{content_id}.m3u8",
+                    "command_url": f"http://127.0.0.1:6878/ace/cmd/{content_id}",
+                }
+                self._send(json.dumps({"response": response, "error": None}).encode(), "application/json")
+
+            def _send(self, body: bytes, content_type: str) -> None:
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args, **kwargs) -> None:
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+        self.address = f"http://127.0.0.1:{self.server.server_address[1]}"
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        """Stop the stub engine."""
+        self.server.shutdown()
+        self.server.server_close()
+
+    def count(self, path_prefix: str) -> int:
+        """Count the requests the engine received that start with a path prefix."""
+        return len([path for path in self.requests if path.startswith(path_prefix)])
+
+
+@pytest.fixture
+def stub_engine():
+    """A stub AceStream engine running on localhost."""
+    engine = StubAceEngine()
+    yield engine
+    engine.stop()
+
+
+@pytest.fixture
+def app_with_engine(tmp_path, get_test_config, stub_engine):
+    """An app pointed at the stub AceStream engine."""
+    test_config = get_test_config("testing_true_valid.toml")
+    test_config.app.ace_address = stub_engine.address
+    return create_app(test_config=test_config, instance_path=tmp_path)
+
+
+class _QuietHTTPRequestHandler(SimpleHTTPRequestHandler):
+    def log_message(self, *args, **kwargs) -> None:
+        pass
+
+
+@pytest.fixture
+def test_sites_server():
+    """Serve tests/test_sites over HTTP, like scripts/run-test-webservers.sh. Returns the base URL."""
+    handler = partial(_QuietHTTPRequestHandler, directory=str(TEST_SITES_LOCATION))
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def scrape_conf(test_sites_server):
+    """Scraper config for the test sites, the same as README_dev.md."""
+    return AceScrapeConf(
+        html=[
+            ScrapeSiteHTML(
+                name="Scrape Site Page 1",
+                url=f"{test_sites_server}/site1/index.html",
+                target_class="column_title",
+                check_sibling=True,
+            ),
+            ScrapeSiteHTML(
+                name="Scrape Site Page 2",
+                url=f"{test_sites_server}/site2/index.html",
+                target_class="streamtext",
+                check_sibling=True,
+                title_filter=TitleFilter(regex_postprocessing="Server \\d+: "),
+            ),
+            ScrapeSiteHTML(
+                name="Scrape Site Page 3",
+                url=f"{test_sites_server}/site3/index.html",
+            ),
+        ],
+        iptv_m3u8=[
+            ScrapeSiteIPTV(
+                name="IPTV List",
+                url=f"{test_sites_server}/site4/list.m3u8",
+            ),
+        ],
+    )
@@ -0,0 +1,70 @@
+"""Tests for the AceStream engine pool."""
+
+from http import HTTPStatus
+
+import requests
+
+from acerestreamer import create_app
+from acerestreamer.ace_engine import AceEnginePool
+
+from .conftest import STUB_MANIFEST, StubAceEngine
+
+ENGINES = ["http://engine1:6878", "http://engine2:6878", "http://engine3:6878"]
+CONTENT_IDS = [f"{n:040x}" for n in range(300)]
+
+
+def test_engine_pool_affinity():
+    """TEST: A content id always maps to the same engine, and content ids are spread across engines."""
+    pool = AceEnginePool(ENGINES, requests.Session(), health_check_interval=0)
+
+    first_choices = [pool.get_engines(content_id)[0] for content_id in CONTENT_IDS]
+    assert first_choices == [pool.get_engines(content_id)[0] for content_id in CONTENT_IDS]
+    for engine in ENGINES:
+        assert first_choices.count(engine) > len(CONTENT_IDS) / 6
+
+    # Removing an engine only moves the content ids that were on it
+    smaller_pool = AceEnginePool(ENGINES[:2], requests.Session(), health_check_interval=0)
+    for content_id, engine in zip(CONTENT_IDS, first_choices, strict=True):
+        if engine != ENGINES[2]:
+            assert smaller_pool.get_engines(content_id)[0] == engine
+
+
+def test_engine_pool_failover():
+    """TEST: Unhealthy engines are tried last, and come back once they are healthy."""
+    pool = AceEnginePool(ENGINES, requests.Session(), health_check_interval=0)
+    content_id = CONTENT_IDS[0]
+    engines = pool.get_engines(content_id)
+
+    pool.mark_failure(engines[0])
+    assert pool.get_engines(content_id) == [*engines[1:], engines[0]]
+
+    pool.mark_success(engines[0])
+    assert pool.get_engines(content_id) == engines
+
+
+def test_engine_pool_sessions():
+    """TEST: Content is routed to the engine that served the manifest."""
+    pool = AceEnginePool(ENGINES, requests.Session(), health_check_interval=0)
+    pool.record_sessions(STUB_MANIFEST, ENGINES[2])
+
+    assert pool.get_engines_for_content("stubsession/1.ts")[0] == ENGINES[2]
+
+
+def test_proxy_failover(tmp_path, get_test_config, stub_engine):
+    """TEST: When an engine is down the proxy uses the next one, and segments follow the manifest."""
+    other_engine = StubAceEngine()
+    other_engine.stop()  # Nothing is listening here anymore
+
+    test_config = get_test_config("testing_true_valid.toml")
+    test_config.app.ace_addresses = [other_engine.address, stub_engine.address]
+    app = create_app(test_config=test_config, instance_path=tmp_path)
+    client = app.test_client()
+
+    for content_id in CONTENT_IDS[:10]:
+        assert client.get(f"/hls/{content_id}").status_code == HTTPStatus.OK
+
+    assert client.get("/ace/c/stubsession/1.ts").status_code == HTTPStatus.OK
+    assert client.get("/api/proxy/stats").json["engines"] == {
+        other_engine.address: False,
+        stub_engine.address: True,
+    }
@@ -1,6 +1,9 @@
 from pathlib import Path
 
-from acerestreamer.config import load_config
+import pytest
+from pydantic import ValidationError
+
+from acerestreamer.config import TitleFilter, load_config
 
 
 def test_load_missing_config(tmp_path):
@@ -8,3 +11,27 @@ def test_load_missing_config(tmp_path):
     missing_config = Path(tmp_path) / "missing_config.toml"
     config = load_config(missing_config)
     config.write_config(missing_config)
+
+
+def test_title_filter():
+    """Test the compiled title filter matches words case insensitively, in order of precedence."""
+    title_matcher = TitleFilter(
+        always_exclude_words=["Replay"],
+        always_include_words=["Final"],
+        exclude_words=["women"],
+        include_words=["Football", "soccer"],
+        regex_postprocessing=r"Server \d+: ",
+    ).get_matcher()
+
+    assert title_matcher.check_title_allowed("FOOTBALL: Team A v Team B")
+    assert title_matcher.check_title_allowed("Women's Cup Final")  # Always include beats exclude
+    assert not title_matcher.check_title_allowed("Football Final (replay)")  # Always exclude beats always include
+    assert not title_matcher.check_title_allowed("Women's Football")
+    assert not title_matcher.check_title_allowed("Tennis")
+    assert title_matcher.postprocess_title("Server 2: Soccer ") == "Soccer"
+
+
+def test_title_filter_invalid_regex():
+    """Test an invalid regex_postprocessing fails when the config is loaded."""
+    with pytest.raises(ValidationError):
+        TitleFilter(regex_postprocessing="Server (")
@@ -0,0 +1,456 @@
+"""Tests for the AceStream scraper."""
+
+import gzip
+import time
+from http import HTTPStatus
+
+import pytest
+from bs4 import BeautifulSoup
+
+from acerestreamer import scraper_html, scraper_iptv, stream_bp
+from acerestreamer.config import ScrapeSiteHTML, ScrapeSiteIPTV, TitleFilter
+from acerestreamer.scraper import AceScraper
+from acerestreamer.scraper_helpers import get_streams_as_iptv
+from acerestreamer.scraper_html import TitleCandidateSearch, parse_streams_html
+from acerestreamer.scraper_iptv import parse_iptv_lines, scrape_streams_iptv_site
+from acerestreamer.scraper_objects import FlatFoundAceStream, FoundAceStreams
+from acerestreamer.scraper_pool import ScrapeJob, run_scrape_jobs
+from acerestreamer.scraper_registry import StreamRegistry
+
+
+def _count_streams(scraper: AceScraper) -> int:
+    return sum(len(found_streams.stream_list) for found_streams in scraper.streams)
+
+
+def test_scraper(scrape_conf, tmp_path):
+    """TEST: Streams are found on all the test sites."""
+    scraper = AceScraper(scrape_conf, tmp_path / "ace_quality_cache.json")
+    scraper.run_scrape()
+
+    assert [found_streams.site_name for found_streams in scraper.streams] == [
+        "Scrape Site Page 1",
+        "Scrape Site Page 2",
+        "Scrape Site Page 3",
+        "IPTV List",
+    ]
+    assert all(found_streams.stream_list for found_streams in scraper.streams)
+
+
+def test_rescrape_replaces_streams(scrape_conf, tmp_path):
+    """TEST: A second scrape replaces the streams rather than adding duplicates."""
+    scraper = AceScraper(scrape_conf, tmp_path / "ace_quality_cache.json")
+    scraper.run_scrape()
+    n_streams = _count_streams(scraper)
+    old_streams = scraper.streams
+
+    scraper.run_scrape()
+
+    assert _count_streams(scraper) == n_streams
+    assert scraper.streams is not old_streams
+
+
+def test_scrape_thread(scrape_conf, tmp_path, mocker):
+    """TEST: The background thread rescrapes on the interval."""
+    scrape_conf.scrape_interval = 0.01
+    scraper = AceScraper(scrape_conf, tmp_path / "ace_quality_cache.json")
+    run_scrape = mocker.patch.object(scraper, "run_scrape")
+
+    scraper.start_scrape_thread()
+    scraper._scrape_thread.join(0.2)
+    scraper.stop_scrape_thread()
+    scraper._scrape_thread.join(1)
+
+    assert run_scrape.call_count > 1
+    assert not scraper._scrape_thread.is_alive()
+
+
+def test_startup_from_cache(scrape_conf, tmp_path):
+    """TEST: The streams from the last run are served until a new scrape is done."""
+    scraper = AceScraper(scrape_conf, tmp_path / "ace_quality_cache.json", tmp_path / "ace_scrape_cache.json")
+    scraper.run_scrape()
+    assert not scraper.get_status().streams_from_cache
+
+    restarted_scraper = AceScraper(scrape_conf, tmp_path / "ace_quality_cache.json", tmp_path / "ace_scrape_cache.json")
+
+    assert restarted_scraper.streams == scraper.streams
+    assert restarted_scraper.get_status().streams_from_cache
+
+
+def test_scraper_status_api(client):
+    """TEST: The status API reports the first scrape, which runs in the background after startup."""
+    for _ in range(100):
+        response = client.get("/api/scraper/status")
+        if response.json["last_scrape_finished"]:
+            break
+        time.sleep(0.05)
+
+    assert response.status_code == HTTPStatus.OK
+    assert response.json["scrape_in_progress"] is False
+    assert response.json["streams_from_cache"] is False
+    assert response.json["last_scrape_finished"] is not None
+
+
+@pytest.mark.parametrize("path", ["/api/streams/flat", "/api/streams/by_site"])
+def test_streams_api_etag(client, scrape_conf, tmp_path, monkeypatch, path):
+    """TEST: The streams APIs send a strong ETag, and a new one once a quality changes."""
+    scraper = AceScraper(scrape_conf, tmp_path / "ace_quality_cache.json")
+    scraper.run_scrape()
+    monkeypatch.setattr(stream_bp, "ace_scraper", scraper)
+
+    response = client.get(path)
+    etag = response.headers["ETag"]
+    assert response.status_code == HTTPStatus.OK
+    assert not etag.startswith("W/")
+
+    response = client.get(path, headers={"If-None-Match": etag})
+    assert response.status_code == HTTPStatus.NOT_MODIFIED
+    assert response.data == b""
+
+    scraper.record_success("4000000000000000000000000000000000000001", latency=0.1)
+    response = client.get(path, headers={"If-None-Match": etag})
+    assert response.status_code == HTTPStatus.OK
+    assert response.headers["ETag"] != etag
+
+
+def test_iptv_playlist(client, scrape_conf, tmp_path, monkeypatch):
+    """TEST: The IPTV playlist is filtered by the query, cached with a strong ETag, and gzipped when accepted."""
+    scraper = AceScraper(scrape_conf, tmp_path / "ace_quality_cache.json")
+    scraper.run_scrape()
+    monkeypatch.setattr(stream_bp, "ace_scraper", scraper)
+    ace_id = "4000000000000000000000000000000000000001"
+    scraper.record_success(ace_id, latency=0.1)
+
+    response = client.get("/iptv")
+    assert response.status_code == HTTPStatus.OK
+    assert response.text == f'#EXTM3U\n#EXTINF:-1 group-title="IPTV List",IPTV1\nhttp://127.0.0.1:5100/hls/{ace_id}\n'
+
+    response = client.get("/iptv", headers={"If-None-Match": response.headers["ETag"]})
+    assert response.status_code == HTTPStatus.NOT_MODIFIED
+
+    n_streams = len(scraper.get_streams_flat())
+    response = client.get("/iptv?min_quality=-1", headers={"Accept-Encoding": "gzip"})
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert response.headers["ETag"].endswith('-gzip"')
+    playlist = gzip.decompress(response.data).decode()
+    assert playlist.count("#EXTINF") == n_streams
+    assert playlist.startswith('#EXTM3U\n#EXTINF:-1 group-title="IPTV List",IPTV1')  # The best quality first
+
+    assert client.get("/iptv?min_quality=-1&site=IPTV List&title=iptv2").text.count("#EXTINF") == 1
+    assert client.get("/iptv?min_quality=-1&site=Not a site").text == "#EXTM3U\n"
+
+
+def test_iptv_attributes():
+    """TEST: Playlist entries carry the guide and group attributes, quotes in them can't break the line."""
+    stream = FlatFoundAceStream(
+        site_name="IPTV List",
+        quality=50,
+        title="Channel 1",
+        ace_id="4000000000000000000000000000000000000001",
+        tvg_id="channel1.uk",
+        tvg_logo="http://example.com/logo.png",
+        group_title='Sports "HD"',
+    )
+
+    assert get_streams_as_iptv([stream], "http://localhost/hls/").splitlines()[1] == (
+        '#EXTINF:-1 tvg-id="channel1.uk" tvg-logo="http://example.com/logo.png" group-title="Sports \'HD\'",Channel 1'
+    )
+
+
+def _slow_job(site_name, url, delay):
+    def _scrape():
+        time.sleep(delay)
+        return FoundAceStreams(site_name=site_name, stream_list=[])
+
+    return ScrapeJob(site_name=site_name, url=url, scrape=_scrape)
+
+
+def test_scrape_jobs_concurrent():
+    """TEST: Sites are scraped concurrently, results keep the order of the sites."""
+    jobs = [_slow_job(f"site{n}", f"http://host{n}/", 0.2) for n in range(5)]
+
+    start = time.monotonic()
+    results = run_scrape_jobs(jobs, max_workers=5, max_per_host=1, deadline=10)
+
+    assert time.monotonic() - start < 0.8  # noqa: PLR2004 One at a time would be 1s
+    assert [result.site_name for result in results] == [f"site{n}" for n in range(5)]
+
+
+def test_scrape_jobs_per_host_limit():
+    """TEST: Sites on the same host are limited."""
+    jobs = [_slow_job(f"site{n}", "http://samehost/", 0.1) for n in range(3)]
+
+    start = time.monotonic()
+    run_scrape_jobs(jobs, max_workers=3, max_per_host=1, deadline=10)
+
+    assert time.monotonic() - start >= 0.3  # noqa: PLR2004
+
+
+def test_scrape_jobs_busy_host_doesnt_block():
+    """TEST: Jobs waiting on a busy host don't hold workers, so sites on other hosts aren't delayed."""
+    finished_at = []
+
+    def _scrape_other():
+        finished_at.append(time.monotonic())
+        return FoundAceStreams(site_name="other", stream_list=[])
+
+    jobs = [_slow_job(f"site{n}", "http://busyhost/", 0.3) for n in range(3)]
+    jobs.append(ScrapeJob(site_name="other", url="http://otherhost/", scrape=_scrape_other))
+
+    start = time.monotonic()
+    results = run_scrape_jobs(jobs, max_workers=2, max_per_host=1, deadline=10)
+
+    assert finished_at[0] - start < 0.2  # noqa: PLR2004 Behind the busy host it would be 0.3s
+    assert [result.site_name for result in results] == ["site0", "site1", "site2", "other"]
+
+
+def test_scrape_jobs_deadline():
+    """TEST: A slow site doesn't hold up the rest."""
+    jobs = [_slow_job("slow", "http://slow/", 2), _slow_job("fast", "http://fast/", 0)]
+
+    start = time.monotonic()
+    results = run_scrape_jobs(jobs, max_workers=2, max_per_host=1, deadline=0.2)
+
+    assert time.monotonic() - start < 1
+    assert results[0] is None
+    assert results[1].site_name == "fast"
+
+
+def test_failed_site_uses_last_scrape(scrape_conf, tmp_path):
+    """TEST: A site that fails to scrape keeps its streams from the last successful scrape."""
+    scraper = AceScraper(scrape_conf, tmp_path / "ace_quality_cache.json", tmp_path / "ace_scrape_cache.json")
+    scraper.run_scrape()
+    streams = scraper.streams
+
+    scrape_conf.html[0].url = "http://127.0.0.1:1/nothing_here"
+    scraper = AceScraper(scrape_conf, tmp_path / "ace_quality_cache.json", tmp_path / "ace_scrape_cache.json")
+    fetched_at = scraper._scrape_cache.get("Scrape Site Page 1").fetched_at
+    scraper.run_scrape()
+
+    assert scraper.streams == streams
+    assert scraper._scrape_cache.get("Scrape Site Page 1").fetched_at == fetched_at
+    assert scraper._scrape_cache.get("IPTV List").fetched_at > fetched_at
+
+
+def test_get_streams_doesnt_change_registry(scrape_conf, tmp_path):
+    """TEST: Streams are returned with their current quality without it ending up in the registry or scrape cache."""
+    scraper = AceScraper(scrape_conf, tmp_path / "ace_quality_cache.json", tmp_path / "ace_scrape_cache.json")
+    scraper.run_scrape()
+    site_name = scraper.streams[0].site_name
+    ace_id = scraper.streams[0].stream_list[0].ace_id
+
+    scraper.record_success(ace_id, 0.1)
+    assert scraper.get_streams()[0].stream_list[0].quality == 74  # noqa: PLR2004
+
+    assert scraper.streams[0].stream_list[0].quality == -1
+    assert scraper._scrape_cache.get(site_name).streams.stream_list[0].quality == -1
+
+
+def test_removed_site_dropped_from_cache(scrape_conf, tmp_path):
+    """TEST: Sites removed from the config aren't served from the cache."""
+    scraper = AceScraper(scrape_conf, tmp_path / "ace_quality_cache.json", tmp_path / "ace_scrape_cache.json")
+    scraper.run_scrape()
+
+    scrape_conf.iptv_m3u8 = []
+    scraper = AceScraper(scrape_conf, tmp_path / "ace_quality_cache.json", tmp_path / "ace_scrape_cache.json")
+
+    assert "IPTV List" not in [found_streams.site_name for found_streams in scraper.streams]
+
+
+def test_unmodified_site_not_reparsed(scrape_conf, tmp_path, mocker):
+    """TEST: Sites that haven't changed since the last scrape answer 304 and aren't parsed again."""
+    scraper = AceScraper(scrape_conf, tmp_path / "ace_quality_cache.json", tmp_path / "ace_scrape_cache.json")
+    scraper.run_scrape()
+    streams = scraper.streams
+    assert scraper._scrape_cache.get("IPTV List").last_modified
+
+    process_candidates = mocker.spy(scraper_html, "process_candidates")
+    parse_iptv_lines = mocker.spy(scraper_iptv, "parse_iptv_lines")
+    conditional_headers = mocker.spy(scraper_html, "get_conditional_headers")
+    scraper.run_scrape()
+
+    assert scraper.streams == streams
+    assert len(conditional_headers.spy_return_list) == len(scrape_conf.html)
+    assert all(headers["If-Modified-Since"] for headers in conditional_headers.spy_return_list)
+    process_candidates.assert_not_called()
+    parse_iptv_lines.assert_not_called()
+
+
+def test_changed_site_config_reparsed(scrape_conf, tmp_path):
+    """TEST: A site whose config changed is parsed again after a restart, even though the page would answer 304."""
+    scraper = AceScraper(scrape_conf, tmp_path / "ace_quality_cache.json", tmp_path / "ace_scrape_cache.json")
+    scraper.run_scrape()
+    site_name = scrape_conf.html[0].name
+    assert scraper._registry.get_by_site(site_name)
+
+    scrape_conf.html[0] = scrape_conf.html[0].model_copy(
+        update={"title_filter": TitleFilter(include_words=["zzzznotthere"])}
+    )
+    restarted_scraper = AceScraper(scrape_conf, tmp_path / "ace_quality_cache.json", tmp_path / "ace_scrape_cache.json")
+    restarted_scraper.run_scrape()
+
+    assert restarted_scraper._registry.get_by_site(site_name) == []
+    assert not restarted_scraper._scrape_cache.get(site_name).parse_skipped
+
+
+def test_unchanged_content_not_reparsed(scrape_conf, tmp_path, mocker, caplog):
+    """TEST: HTML sites that don't send validators but serve the same page aren't parsed again."""
+    scraper = AceScraper(scrape_conf, tmp_path / "ace_quality_cache.json", tmp_path / "ace_scrape_cache.json")
+    scraper.run_scrape()
+    streams = scraper.streams
+    for site_name, scraped_site in scraper._scrape_cache.sites.items():
+        scraper._scrape_cache.sites[site_name] = scraped_site.model_copy(update={"etag": "", "last_modified": ""})
+
+    process_candidates = mocker.spy(scraper_html, "process_candidates")
+    with caplog.at_level("INFO"):
+        scraper.run_scrape()
+
+    assert scraper.streams == streams
+    assert all(scraper._scrape_cache.get(site.name).parse_skipped for site in scrape_conf.html)
+    assert scraper._scrape_cache.get("Scrape Site Page 1").last_modified  # Validators picked up again
+    assert "Skipped parsing 3 unchanged sites" in caplog.text
+    process_candidates.assert_not_called()
+
+
+def test_title_candidate_search():
+    """TEST: Title candidates come from the link's tagged ancestors and, optionally, their previous siblings."""
+    soup = BeautifulSoup(
+        """
+        <div class="title">Page</div>
+        <div class="row">
+            <span class="title">Stream 1</span>
+            <div class="title"><a href="acestream://1">Link 1</a></div>
+        </div>
+        <div class="row">
+            <span class="title">Stream 2</span>
+            <div><a href="acestream://2">Link 2</a></div>
+        </div>
+        """,
+        "html.parser",
+    )
+    link_1, link_2 = soup.find_all("a")
+
+    title_search = TitleCandidateSearch("title")
+    assert title_search.get_candidates(link_1) == ["Link 1"]
+    assert title_search.get_candidates(link_2) == []
+
+    title_search = TitleCandidateSearch("title", check_sibling=True)
+    assert title_search.get_candidates(link_1) == ["Page", "Link 1", "Stream 1"]
+    assert title_search.get_candidates(link_2) == ["Stream 2"]
+
+
+@pytest.mark.parametrize(("html_parser", "prefilter_links"), [("html.parser", True), ("lxml", False), ("lxml", True)])
+def test_html_parser_options(scrape_conf, tmp_path, html_parser, prefilter_links):
+    """TEST: The faster parser and the link prefilter find the same streams, lxml falls back if not installed."""
+    scraper = AceScraper(scrape_conf, tmp_path / "ace_quality_cache.json")
+    scraper.run_scrape()
+
+    scrape_conf.html_parser = html_parser
+    for site in scrape_conf.html:
+        site.prefilter_links = prefilter_links
+    other_scraper = AceScraper(scrape_conf, tmp_path / "ace_quality_cache.json")
+    other_scraper.run_scrape()
+
+    assert other_scraper.streams == scraper.streams
+
+
+def test_duplicate_links_and_common_titles():
+    """TEST: A link listed twice is one stream, and titles that every link shares aren't used."""
+    ace_id_1 = "1" * 40
+    ace_id_2 = "2" * 40
+    html = f"""
+        <div class="title">Streams
+            <div><span class="title">Stream 1</span><a href="acestream://{ace_id_1}">Play</a></div>
+            <div><span class="title">Stream 2</span><a href="acestream://{ace_id_2}">Play</a></div>
+            <div><span class="title">Stream 1 Again</span><a href="acestream://{ace_id_1}">Play</a></div>
+        </div>
+    """
+    site = ScrapeSiteHTML(
+        name="Test",
+        url="http://localhost",
+        target_class="title",
+        check_sibling=True,
+        html_parser="html.parser",
+    )
+
+    streams = parse_streams_html(site, html)
+
+    assert [(stream.title, stream.ace_id) for stream in streams] == [("Stream 1", ace_id_1), ("Stream 2", ace_id_2)]
+
+
+def test_iptv_extinf_attributes():
+    """TEST: #EXTINF attributes are kept quoted or not, titles can have commas, and each #EXTINF is one stream."""
+    ace_id_1 = "1" * 40
+    ace_id_2 = "2" * 40
+    ace_id_3 = "3" * 40
+    ace_id_4 = "4" * 40
+    ace_id_5 = "5" * 40
+    lines = [
+        "#EXTM3U",
+        '#EXTINF:-1 tvg-id="one.uk" tvg-logo="http://logo/one.png" group-title="Sport",Team A, Team B',
+        "#EXTVLCOPT:network-caching=1000",
+        f"acestream://{ace_id_1}",
+        "",
+        "#EXTINF:-1 this isn't valid",
+        f"acestream://{ace_id_2}",
+        "#EXTINF:-1,Stream 2",
+        f"acestream://{ace_id_2}",
+        "#EXTINF:-1 tvg-id=three,Stream 3",
+        f"acestream://{ace_id_3}",
+        '#EXTINF:0 tvg-id="four" catchup-days=7,Stream 4',
+        f"acestream://{ace_id_4}",
+        "#EXTINF:-1 tvg-id='five',Stream 5",
+        f"acestream://{ace_id_5}",
+        "",
+    ]
+    site = ScrapeSiteIPTV(name="Test", url="http://localhost/list.m3u8")
+
+    streams = parse_iptv_lines(site, lines)
+
+    assert [stream.model_dump(exclude={"quality"}) for stream in streams] == [
+        {
+            "title": "Team A, Team B",
+            "ace_id": ace_id_1,
+            "tvg_id": "one.uk",
+            "tvg_logo": "http://logo/one.png",
+            "group_title": "Sport",
+        },
+        {"title": "Stream 2", "ace_id": ace_id_2, "tvg_id": "", "tvg_logo": "", "group_title": ""},
+        {"title": "Stream 3", "ace_id": ace_id_3, "tvg_id": "three", "tvg_logo": "", "group_title": ""},
+        {"title": "Stream 4", "ace_id": ace_id_4, "tvg_id": "four", "tvg_logo": "", "group_title": ""},
+        {"title": "Stream 5", "ace_id": ace_id_5, "tvg_id": "five", "tvg_logo": "", "group_title": ""},
+    ]
+
+
+def test_iptv_max_size(scrape_conf):
+    """TEST: IPTV playlists larger than the max size aren't scraped."""
+    site = scrape_conf.iptv_m3u8[0]
+
+    assert scrape_streams_iptv_site(site)
+    assert scrape_streams_iptv_site(site, max_size=100) is None
+
+
+def test_iptv_no_streams(scrape_conf):
+    """TEST: A playlist with no streams left after the title filter is a successful scrape, not a failure."""
+    site = scrape_conf.iptv_m3u8[0].model_copy(update={"title_filter": TitleFilter(include_words=["zzzznotthere"])})
+
+    scraped_site = scrape_streams_iptv_site(site)
+    assert scraped_site
+    assert scraped_site.streams.stream_list == []
+
+
+def test_stream_registry(scrape_conf, tmp_path):
+    """TEST: Streams can be looked up by ace_id, site and title, with their current quality."""
+    scraper = AceScraper(scrape_conf, tmp_path / "ace_quality_cache.json")
+    scraper.run_scrape()
+    ace_id = "4000000000000000000000000000000000000001"
+    scraper.record_success(ace_id, latency=0.1)
+
+    stream = scraper.get_stream_by_ace_id(ace_id)
+    assert (stream.site_name, stream.title, stream.quality) == ("IPTV List", "IPTV1", 74)
+    assert scraper.get_stream_by_ace_id("f" * 40).site_name == "Unknown"
+
+    registry = StreamRegistry(scraper.streams)
+    assert len(registry) == len(scraper.get_streams_flat())
+    assert registry.get_by_site("IPTV List")[0].ace_id == ace_id
+    assert [stream.ace_id for stream in registry.get_by_title("iptv1")] == [ace_id]
+    assert registry.get_by_site("Not a site") == []
@@ -0,0 +1,221 @@
+"""Tests for AceQuality."""
+
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from acerestreamer.scraper_health import AceQuality
+from acerestreamer.scraper_health_db import AceQualityDB
+
+ACE_ID = "4000000000000000000000000000000000000001"
+OTHER_ACE_ID = "4000000000000000000000000000000000000002"
+THIRD_ACE_ID = "4000000000000000000000000000000000000003"
+
+
+def test_quality_saved_in_background(tmp_path):
+    """TEST: Quality changes aren't written on the request path, the background thread saves them."""
+    cache_file = tmp_path / "ace_quality_cache.json"
+    ace_quality = AceQuality(cache_file)
+    ace_quality.save_interval = 0.05
+
+    ace_quality.record_success(ACE_ID, latency=0.1)
+    assert not cache_file.exists()
+
+    for _ in range(100):
+        if cache_file.exists():
+            break
+        time.sleep(0.05)
+
+    assert json.loads(cache_file.read_text())[ACE_ID]["successes"] == 1
+    assert not cache_file.with_suffix(".tmp").exists()
+    assert AceQuality(cache_file).get_quality(ACE_ID) == 74  # noqa: PLR2004
+
+
+def test_quality_saved_at_threshold(tmp_path):
+    """TEST: Enough changes save straight away, and flush() saves anything left over."""
+    cache_file = tmp_path / "ace_quality_cache.json"
+    ace_quality = AceQuality(cache_file)
+    ace_quality.save_interval = 60
+    ace_quality.save_threshold = 2
+
+    ace_quality.record_success(ACE_ID, latency=0.1)
+    ace_quality.record_failure(ACE_ID)
+    for _ in range(100):
+        if cache_file.exists():
+            break
+        time.sleep(0.05)
+    assert list(json.loads(cache_file.read_text())) == [ACE_ID]
+
+    ace_quality.record_success(OTHER_ACE_ID, latency=0.1)
+    ace_quality.flush()
+    assert sorted(json.loads(cache_file.read_text())) == [ACE_ID, OTHER_ACE_ID]
+
+    assert AceQuality(cache_file).get_snapshot() == ace_quality.get_snapshot()
+
+
+def test_quality_reads_dont_write():
+    """TEST: Getting the quality of an unknown stream doesn't add it."""
+    ace_quality = AceQuality(None)
+
+    assert ace_quality.get_quality(ACE_ID) == ace_quality.default_quality
+    assert ace_quality.get_snapshot() == {}
+
+
+def test_quality_concurrent_records():
+    """TEST: Results from many threads aren't lost, and snapshots can be taken while they happen."""
+    ace_quality = AceQuality(None)
+    ace_ids = [f"{n:040x}" for n in range(64)]
+
+    def _record() -> None:
+        for _ in range(10):
+            for ace_id in ace_ids:
+                ace_quality.record_success(ace_id, latency=0.1)
+                ace_quality.get_snapshot()
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        for future in [executor.submit(_record) for _ in range(8)]:
+            future.result()
+
+    for stats in ace_quality._get_stats_snapshot().values():
+        assert stats.successes == pytest.approx(80, rel=1e-3)  # Less a little decay while the test runs
+    assert ace_quality.get_version()[0] == 8 * 10 * 64  # Every result changes the version
+
+
+def test_quality_decays(tmp_path):
+    """TEST: Old results count for less, so a stream that failed a lot recovers once it works again."""
+    cache_file = tmp_path / "ace_quality_cache.json"
+    old_failures = {"successes": 0, "failures": 24, "manifest_latency": 0, "segment_latency": 0}
+    cache_file.write_text(
+        json.dumps(
+            {
+                ACE_ID: {**old_failures, "updated_at": time.time() - 3 * AceQuality.half_life},
+                OTHER_ACE_ID: {**old_failures, "updated_at": time.time()},
+            }
+        )
+    )
+    ace_quality = AceQuality(cache_file)
+
+    assert ace_quality.get_quality(ACE_ID) == 0
+    ace_quality.record_success(ACE_ID, latency=0.1)
+    ace_quality.record_success(OTHER_ACE_ID, latency=0.1)
+    assert ace_quality.get_quality(ACE_ID) == 30  # noqa: PLR2004 The 24 failures count as 3
+    assert ace_quality.get_quality(OTHER_ACE_ID) == 0  # Still mostly failures
+
+
+def test_quality_latency():
+    """TEST: Streams that are slow to start, or slow to deliver segments, score lower."""
+    ace_quality = AceQuality(None)
+
+    ace_quality.record_success(ACE_ID, latency=0.1)
+    assert ace_quality.get_quality(ACE_ID) == 74  # noqa: PLR2004
+
+    ace_quality.record_success(OTHER_ACE_ID, latency=ace_quality.slow_manifest_latency)
+    assert ace_quality.get_quality(OTHER_ACE_ID) == 56  # noqa: PLR2004
+
+    ace_quality.record_segment_latency(ACE_ID, latency=ace_quality.slow_segment_latency)
+    assert ace_quality.get_quality(ACE_ID) == 56  # noqa: PLR2004
+
+
+def test_quality_latency_not_a_result():
+    """TEST: Recording a segment latency doesn't count as the stream being tried, so the prober still probes it."""
+    ace_quality = AceQuality(None)
+
+    ace_quality.record_segment_latency(ACE_ID, latency=0.1)
+    assert ace_quality.get_last_tried(ACE_ID) == 0
+    assert ace_quality.get_quality(ACE_ID) == ace_quality.default_quality
+
+    ace_quality.record_success(OTHER_ACE_ID, latency=0.1)
+    last_tried = ace_quality.get_last_tried(OTHER_ACE_ID)
+    ace_quality.record_segment_latency(OTHER_ACE_ID, latency=0.1)
+    assert ace_quality.get_last_tried(OTHER_ACE_ID) == last_tried
+
+
+def test_quality_failing_streams():
+    """TEST: Streams that only fail, or nearly always fail, score 0 so they're left out of the IPTV playlist."""
+    ace_quality = AceQuality(None)
+
+    ace_quality.record_failure(ACE_ID)
+    assert ace_quality.get_quality(ACE_ID) == 0
+    for _ in range(4):
+        ace_quality.record_failure(ACE_ID)
+    assert ace_quality.get_quality(ACE_ID) == 0
+
+    for _ in range(10):
+        ace_quality.record_failure(OTHER_ACE_ID)
+    ace_quality.record_success(OTHER_ACE_ID, latency=0.1)
+    assert ace_quality.get_quality(OTHER_ACE_ID) == 0
+    ace_quality.record_success(OTHER_ACE_ID, latency=0.1)
+    assert ace_quality.get_quality(OTHER_ACE_ID) > 0
+
+
+def test_quality_old_cache_file(tmp_path):
+    """TEST: A cache file from before the counters still loads."""
+    cache_file = tmp_path / "ace_quality_cache.json"
+    cache_file.write_text(json.dumps({ACE_ID: 99, OTHER_ACE_ID: -1, THIRD_ACE_ID: 0}))
+
+    assert AceQuality(cache_file).get_snapshot() == {ACE_ID: 89, THIRD_ACE_ID: 0}
+
+
+def test_quality_db(tmp_path):
+    """TEST: The sqlite backend saves qualities with their history, and loads them for the streams in use."""
+    db_file = tmp_path / "ace_quality_cache.db"
+    ace_quality = AceQuality(None, AceQualityDB(db_file, default_quality=AceQuality.default_quality))
+
+    ace_quality.record_scrape({ACE_ID: "site1"})
+    ace_quality.record_success(ACE_ID, latency=0.1)
+    ace_quality.record_success(ACE_ID, latency=0.1)
+    ace_quality.record_failure(ACE_ID)
+    ace_quality.record_success(OTHER_ACE_ID, latency=0.1)
+    ace_quality.record_success(OTHER_ACE_ID, latency=0.1)
+    ace_quality.flush()
+
+    quality_db = AceQualityDB(db_file, default_quality=AceQuality.default_quality)
+    history = quality_db.get_history(ACE_ID)
+    assert history
+    assert history["quality"] == 62  # noqa: PLR2004
+    assert history["successes"] == 2  # noqa: PLR2004
+    assert history["failures"] == 1
+    assert history["site_name"] == "site1"
+    assert history["last_seen"]
+
+    ace_quality = AceQuality(None, quality_db)
+    assert ace_quality.get_snapshot() == {}  # Nothing is loaded up front
+    ace_quality.load_qualities([ACE_ID])
+    assert ace_quality.get_snapshot() == {ACE_ID: 62}
+    ace_quality.record_success(OTHER_ACE_ID, latency=0.1)  # Loaded from the db before recording
+    assert ace_quality.get_quality(OTHER_ACE_ID) == 86  # noqa: PLR2004
+
+
+def test_quality_db_retention(tmp_path):
+    """TEST: Streams that haven't been found in retention_scrapes scrapes are forgotten."""
+    quality_db = AceQualityDB(tmp_path / "ace_quality_cache.db", default_quality=-1, retention_scrapes=2)
+    ace_quality = AceQuality(None, quality_db)
+
+    ace_quality.record_scrape({ACE_ID: "site1", OTHER_ACE_ID: "site1"})
+    ace_quality.record_success(OTHER_ACE_ID, latency=0.1)
+    ace_quality.flush()
+
+    ace_quality.record_scrape({ACE_ID: "site1"})
+    assert quality_db.count() == 2  # noqa: PLR2004
+
+    ace_quality.record_scrape({ACE_ID: "site1"})
+    assert quality_db.count() == 1
+    assert quality_db.get_history(OTHER_ACE_ID) is None
+    assert OTHER_ACE_ID not in ace_quality.get_snapshot()
+
+
+def test_quality_db_imports_cache_file(tmp_path):
+    """TEST: Switching to the sqlite backend keeps the qualities from the cache file."""
+    cache_file = tmp_path / "ace_quality_cache.json"
+    cache_file.write_text(json.dumps({ACE_ID: 99, "not an ace id": 10}))
+
+    quality_db = AceQualityDB(cache_file.with_suffix(".db"), default_quality=-1)
+    assert quality_db.is_empty()
+    ace_quality = AceQuality(cache_file, quality_db)
+    assert not quality_db.is_empty()
+
+    assert list(quality_db.get_all_stats()) == [ACE_ID]
+    ace_quality.load_qualities([ACE_ID])
+    assert ace_quality.get_snapshot() == {ACE_ID: 89}
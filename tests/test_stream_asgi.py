@@ -0,0 +1,74 @@
+"""Tests for the optional ASGI reverse proxy mode."""
+
+import asyncio
+from http import HTTPStatus
+
+import pytest
+
+from acerestreamer import create_asgi_app
+
+from .conftest import STUB_SEGMENT_CONTENT
+
+httpx = pytest.importorskip("httpx")
+pytest.importorskip("asgiref")
+
+ACE_ID = "1000000000000000000000000000000000000001"
+
+
+@pytest.fixture
+def asgi_app(tmp_path, get_test_config, stub_engine):
+    """An ASGI app pointed at the stub AceStream engine."""
+    test_config = get_test_config("testing_true_valid.toml")
+    test_config.app.ace_address = stub_engine.address
+    return create_asgi_app(test_config=test_config, instance_path=tmp_path)
+
+
+def _get_all(asgi_app, paths):
+    """Request all the paths concurrently against the ASGI app."""
+
+    async def _run():
+        transport = httpx.ASGITransport(app=asgi_app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://testserver") as client:
+            return await asyncio.gather(*(client.get(path) for path in paths))
+
+    return asyncio.run(_run())
+
+
+def test_asgi_hls_stream(asgi_app, stub_engine):
+    """TEST: Concurrent manifest requests are fetched once and rewritten, quality is tracked."""
+    responses = _get_all(asgi_app, [f"/hls/{ACE_ID}"] * 5)
+
+    for response in responses:
+        assert response.status_code == HTTPStatus.OK
+        assert b"http://localhost:6878" not in response.content
+        assert b"/ace/c/stubsession/1.ts" in response.content
+
+    assert stub_engine.count("/ace/manifest.m3u8") == 1
+    assert asgi_app.flask_app.test_client().get("/api/streams/health").json[ACE_ID] == 74  # noqa: PLR2004
+
+
+def test_asgi_ace_content(asgi_app, stub_engine):
+    """TEST: Concurrent segment requests are streamed through and coalesced into one upstream fetch."""
+    responses = _get_all(asgi_app, ["/ace/c/stubsession/1.ts"] * 5)
+
+    for response in responses:
+        assert response.status_code == HTTPStatus.OK
+        assert response.content == STUB_SEGMENT_CONTENT
+
+    assert stub_engine.count("/ace/c/stubsession/1.ts") == 1
+
+
+def test_asgi_flask_passthrough(asgi_app):
+    """TEST: Other routes are served by the Flask app."""
+    (response,) = _get_all(asgi_app, ["/api/streams/health"])
+    assert response.status_code == HTTPStatus.OK
+
+
+def test_asgi_auth(asgi_app):
+    """TEST: The streaming routes still need authentication."""
+    asgi_app.app_conf.password = "testpassword"
+
+    responses = _get_all(asgi_app, [f"/hls/{ACE_ID}", "/ace/c/stubsession/1.ts"])
+
+    for response in responses:
+        assert response.status_code == HTTPStatus.UNAUTHORIZED
@@ -0,0 +1,121 @@
+"""Tests for the reverse proxy caches."""
+
+import threading
+import time
+
+from acerestreamer.stream_cache import MANIFEST_DEFAULT_TTL, CachedManifest, ManifestCache, SegmentCache
+
+
+def test_segment_cache_lru_eviction():
+    """TEST: The least recently used segment is evicted when the cache is over its byte limit."""
+    cache = SegmentCache(max_bytes=40, ttl=60, coalesce_timeout=1)
+
+    for key in ("a", "b", "c", "d"):
+        _, claim = cache.get_or_claim(key)
+        cache.put(key, b"0123456789", 200, [])
+        cache.release(key, claim)
+
+    cache.get_or_claim("a")  # Touch a so b is the oldest
+
+    _, claim = cache.get_or_claim("e")
+    cache.put("e", b"0123456789", 200, [])
+    cache.release("e", claim)
+
+    assert cache.get_or_claim("b")[1]
+    assert cache.get_or_claim("a")[0] is not None
+    assert cache.evictions == 1
+    assert cache.current_bytes == 40  # noqa: PLR2004
+
+
+def test_segment_cache_ttl():
+    """TEST: Expired segments are not served."""
+    cache = SegmentCache(max_bytes=100, ttl=0, coalesce_timeout=1)
+    cache.put("a", b"data", 200, [])
+    time.sleep(0.01)
+
+    segment, claim = cache.get_or_claim("a")
+    assert segment is None
+    assert claim
+    assert cache.expirations == 1
+    assert cache.current_bytes == 0
+
+
+def test_segment_cache_release_twice():
+    """TEST: Releasing a claim again doesn't release a newer claim on the same segment."""
+    cache = SegmentCache(max_bytes=100, ttl=60, coalesce_timeout=5)
+
+    _, first_claim = cache.get_or_claim("a")
+    cache.release("a", first_claim)
+    _, second_claim = cache.get_or_claim("a")
+    cache.release("a", first_claim)
+
+    assert second_claim
+    assert not second_claim.is_set()
+    assert cache.get_stats()["in_flight"] == 1
+
+
+def test_segment_cache_too_large():
+    """TEST: Segments bigger than a quarter of the cache are not cached."""
+    cache = SegmentCache(max_bytes=100, ttl=60, coalesce_timeout=1)
+    cache.put("a", b"0" * 26, 200, [])
+
+    assert cache.current_bytes == 0
+
+
+def test_segment_cache_coalescing():
+    """TEST: Concurrent misses for the same segment wait for the first fetch."""
+    cache = SegmentCache(max_bytes=100, ttl=60, coalesce_timeout=5)
+
+    segment, claim = cache.get_or_claim("a")
+    assert segment is None
+    assert claim
+
+    results = []
+
+    def _waiter() -> None:
+        results.append(cache.get_or_claim("a"))
+
+    threads = [threading.Thread(target=_waiter) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+
+    time.sleep(0.05)
+    cache.put("a", b"data", 200, [])
+    cache.release("a", claim)
+
+    for thread in threads:
+        thread.join()
+
+    assert all(segment and segment.content == b"data" and not claim for segment, claim in results)
+    assert cache.misses == 1
+    assert cache.coalesced == 5  # noqa: PLR2004
+
+
+def test_manifest_cache_ttl_from_target_duration():
+    """TEST: Manifests are cached for half of their target duration, capped by max_ttl."""
+    cache = ManifestCache(max_ttl=5)
+
+    assert cache._get_ttl(CachedManifest("#EXTM3U\n#EXT-X-TARGETDURATION:4\n", 200, [])) == 2  # noqa: PLR2004
+    assert cache._get_ttl(CachedManifest("#EXTM3U\n#EXT-X-TARGETDURATION:30\n", 200, [])) == 5  # noqa: PLR2004
+    assert cache._get_ttl(CachedManifest("#EXTM3U\n", 200, [])) == MANIFEST_DEFAULT_TTL
+
+
+def test_manifest_cache_single_flight():
+    """TEST: Concurrent requests for a manifest only fetch it once."""
+    cache = ManifestCache(max_ttl=5)
+    fetches = []
+
+    def _fetch() -> CachedManifest:
+        fetches.append(1)
+        time.sleep(0.05)
+        return CachedManifest("#EXTM3U\n#EXT-X-TARGETDURATION:4\n", 200, [])
+
+    threads = [threading.Thread(target=cache.get_or_fetch, args=("a", _fetch)) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(fetches) == 1
+    assert cache.get_stats()["coalesced"] + cache.get_stats()["hits"] == 4  # noqa: PLR2004
+    assert not cache._fetch_locks  # Removed by the last getter
@@ -0,0 +1,64 @@
+"""Tests for the background stream prober."""
+
+import requests
+
+from acerestreamer.ace_engine import AceEnginePool
+from acerestreamer.config import ProberConf, TimeoutConf
+from acerestreamer.scraper import AceScraper
+from acerestreamer.stream_prober import AceStreamProber
+
+
+def _make_prober(scrape_conf, tmp_path, address, **prober_settings):
+    scraper = AceScraper(scrape_conf, tmp_path / "ace_quality_cache.json")
+    scraper.run_scrape()
+    engine_pool = AceEnginePool([address], requests.Session(), health_check_interval=0)
+    prober_conf = ProberConf(delay=0, **prober_settings)
+    return scraper, AceStreamProber(scraper, engine_pool, prober_conf, TimeoutConf(connect=1, read=2))
+
+
+def _get_probed_ids(stub_engine):
+    return {
+        path.split("content_id=")[-1].removesuffix("&format=json")
+        for path in stub_engine.requests
+        if path.startswith("/ace/manifest.m3u8")
+    }
+
+
+def test_prober_records_quality(scrape_conf, tmp_path, stub_engine):
+    """TEST: Never tried streams are probed first, a batch at a time, and their quality is recorded."""
+    scraper, prober = _make_prober(scrape_conf, tmp_path, stub_engine.address, batch_size=3)
+    failing_id = scraper.get_ace_ids_to_probe(stale_after=0, limit=1)[0]
+    stub_engine.fail_content_ids.add(failing_id)
+
+    prober.run_probes()
+    assert stub_engine.count("/ace/manifest.m3u8") == 3  # noqa: PLR2004
+    assert prober.get_stats()["successes"] == 2  # noqa: PLR2004
+    assert prober.get_stats()["failures"] == 1
+    assert scraper.get_stream_by_ace_id(failing_id).quality == 0
+    assert len(stub_engine.stopped_sessions) == 3  # noqa: PLR2004 The probes don't leave the engine playing
+
+    first_probed = _get_probed_ids(stub_engine)
+    prober.run_probes()
+    assert len(_get_probed_ids(stub_engine) - first_probed) == 3  # noqa: PLR2004 The next streams in line
+
+    n_streams = len({stream.ace_id for stream in scraper.get_streams_flat()})
+    assert len(scraper.get_ace_ids_to_probe(stale_after=60 * 60, limit=100)) == n_streams - 6
+
+
+def test_prober_concurrency(scrape_conf, tmp_path, stub_engine):
+    """TEST: No more than concurrency probes run at once."""
+    _, prober = _make_prober(scrape_conf, tmp_path, stub_engine.address, batch_size=6, concurrency=2)
+    stub_engine.manifest_delay = 0.1
+
+    prober.run_probes()
+    assert stub_engine.count("/ace/manifest.m3u8") == 6  # noqa: PLR2004
+    assert stub_engine.max_concurrent_manifests == 2  # noqa: PLR2004
+
+
+def test_prober_engine_down(scrape_conf, tmp_path):
+    """TEST: Streams aren't blamed when the engine can't be reached."""
+    scraper, prober = _make_prober(scrape_conf, tmp_path, "http://127.0.0.1:9", batch_size=2)
+
+    prober.run_probes()
+    assert prober.get_stats()["engine_errors"] == 2  # noqa: PLR2004
+    assert {stream.quality for stream in scraper.get_streams_flat()} == {-1}
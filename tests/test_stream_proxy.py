@@ -0,0 +1,119 @@
+"""Tests for the HLS and Ace content reverse proxy."""
+
+from http import HTTPStatus
+
+import requests
+
+from acerestreamer import stream_bp
+
+from .conftest import STUB_SEGMENT_CONTENT
+
+ACE_ID = "1000000000000000000000000000000000000001"
+CHUNK_SIZE = 1024
+
+
+def test_ace_content_streamed(app_with_engine):
+    """TEST: Ace content is streamed through in chunks with the upstream Content-Length."""
+    app_with_engine.aw_conf.app.ace_content_chunk_size = CHUNK_SIZE
+    client = app_with_engine.test_client()
+
+    response = client.get("/ace/c/stubsession/1.ts", buffered=False)
+    assert response.status_code == HTTPStatus.OK
+    assert response.is_streamed
+    assert response.headers["Content-Length"] == str(len(STUB_SEGMENT_CONTENT))
+
+    chunks = list(response.response)
+    assert len(chunks) > 1
+    assert max(len(chunk) for chunk in chunks) <= CHUNK_SIZE
+    assert b"".join(chunks) == STUB_SEGMENT_CONTENT
+    response.close()
+
+
+def test_ace_content_client_disconnect(app_with_engine, mocker):
+    """TEST: The upstream connection is released when the client goes away mid-stream."""
+    client = app_with_engine.test_client()
+    close_spy = mocker.spy(requests.Response, "close")
+
+    response = client.get("/ace/c/stubsession/1.ts", buffered=False)
+    next(iter(response.response))
+    response.close()
+
+    assert close_spy.call_count >= 1
+
+
+def test_hls_stream(app_with_engine):
+    """TEST: The manifest is rewritten to point at this server."""
+    client = app_with_engine.test_client()
+
+    response = client.get(f"/hls/{ACE_ID}")
+    assert response.status_code == HTTPStatus.OK
+    assert b"http://localhost:6878" not in response.data
+    assert app_with_engine.config["SERVER_NAME"].encode() + b"/ace/c/stubsession/1.ts" in response.data
+
+
+def test_ace_content_latency(app_with_engine, mocker):
+    """TEST: Segment latency is recorded against the stream whose manifest started the playback session."""
+    client = app_with_engine.test_client()
+    record_spy = mocker.spy(stream_bp.ace_scraper, "record_segment_latency")
+
+    client.get(f"/hls/{ACE_ID}")
+    response = client.get("/ace/c/stubsession/1.ts")
+    assert response.status_code == HTTPStatus.OK
+
+    record_spy.assert_called_once_with(ACE_ID, mocker.ANY)
+
+
+def test_ace_content_cached(app_with_engine, stub_engine):
+    """TEST: Repeat requests for a segment are served from the segment cache."""
+    client = app_with_engine.test_client()
+
+    for _ in range(3):
+        response = client.get("/ace/c/stubsession/1.ts")
+        assert response.status_code == HTTPStatus.OK
+        assert response.data == STUB_SEGMENT_CONTENT
+
+    assert stub_engine.count("/ace/c/stubsession/1.ts") == 1
+
+    stats = client.get("/api/proxy/stats").json["segment_cache"]
+    assert stats["hits"] == 2  # noqa: PLR2004
+    assert stats["misses"] == 1
+    assert stats["current_bytes"] == len(STUB_SEGMENT_CONTENT)
+
+
+def test_ace_content_head(app_with_engine, stub_engine):
+    """TEST: A HEAD request doesn't leave the segment claimed, so the next GET doesn't wait for it."""
+    client = app_with_engine.test_client()
+
+    response = client.head("/ace/c/stubsession/1.ts")
+    assert response.status_code == HTTPStatus.OK
+    response.close()  # What the WSGI server does once the headers are sent
+    assert client.get("/api/proxy/stats").json["segment_cache"]["in_flight"] == 0
+
+    response = client.get("/ace/c/stubsession/1.ts")
+    assert response.data == STUB_SEGMENT_CONTENT
+    assert stub_engine.count("/ace/c/stubsession/1.ts") == 2  # noqa: PLR2004 The HEAD didn't cache anything
+
+
+def test_hls_stream_cached(app_with_engine, stub_engine):
+    """TEST: Players polling the same manifest cost one upstream request and one quality update."""
+    client = app_with_engine.test_client()
+
+    for _ in range(5):
+        response = client.get(f"/hls/{ACE_ID}")
+        assert response.status_code == HTTPStatus.OK
+
+    assert stub_engine.count("/ace/manifest.m3u8") == 1
+    assert client.get("/api/streams/health").json[ACE_ID] == 74  # noqa: PLR2004 One fast success
+
+
+def test_hls_stream_invalid(app_with_engine, stub_engine):
+    """TEST: An invalid manifest is reported, and lowers the quality once."""
+    stub_engine.fail_content_ids.add(ACE_ID)
+    client = app_with_engine.test_client()
+
+    for _ in range(3):
+        response = client.get(f"/hls/{ACE_ID}")
+        assert response.json[0]["error"] == "Invalid HLS stream"
+
+    assert stub_engine.count("/ace/manifest.m3u8") == 1
+    assert client.get("/api/streams/health").json[ACE_ID] == 0  # Only failures